@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import sys, time, random, uuid, json, tempfile, pathlib, logging
+
+from pony.orm import db_session
+
+import codec
+
+
+__author__ = 'Christian Glöckner'
+__licence__ = 'MIT'
+
+
+# ---------------------------------------------------------------------
+
+def measure(func, repeat):
+    """ Return average runtime of func in microseconds. """
+    start = time.perf_counter()
+    for i in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000000
+
+
+def makeToken(token_id, scene_id=1):
+    """ Create realistic token record. """
+    return {
+        'id'     : token_id,
+        'scene'  : scene_id,
+        'url'    : '/asset/gm/game/{0}.png'.format(random.randrange(100)),
+        'posx'   : random.randrange(1000),
+        'posy'   : random.randrange(560),
+        'zorder' : random.randrange(-10, 10),
+        'size'   : random.randrange(20, 200),
+        'rotate' : random.choice([0.0, 45.0, 90.0]),
+        'flipx'  : random.choice([False, True]),
+        'locked' : False,
+        'timeid' : time.time(),
+        'back'   : None,
+        'text'   : random.choice(['', 'Goblin', 'Wizard']),
+        'color'  : random.choice(['', '#FF0000'])
+    }
+
+
+def makeMove(token_id, player_uuid):
+    """ Create realistic partial record of a moved token. """
+    return {
+        'id'   : token_id,
+        'uuid' : player_uuid,
+        'posx' : random.randrange(1000),
+        'posy' : random.randrange(560)
+    }
+
+
+# ---------------------------------------------------------------------
+
+def makePayloads():
+    """ Create realistic REFRESH and UPDATE payloads. """
+    player_uuid = uuid.uuid4().hex
+    return {
+        'REFRESH (50 tokens)'  : {
+            'OPID'       : 'REFRESH',
+            'tokens'     : [makeToken(i) for i in range(50)],
+            'background' : 1
+        },
+        'REFRESH (500 tokens)' : {
+            'OPID'       : 'REFRESH',
+            'tokens'     : [makeToken(i) for i in range(500)],
+            'background' : 1
+        },
+        'UPDATE (1 move)'      : {
+            'OPID'   : 'UPDATE',
+            'tokens' : [makeMove(1, player_uuid)]
+        },
+        'UPDATE (20 moves)'    : {
+            'OPID'   : 'UPDATE',
+            'tokens' : [makeMove(i, player_uuid) for i in range(20)]
+        }
+    }
+
+
+def benchCodec(repeat=1000):
+    """ Compare websocket encodings on REFRESH and UPDATE payloads. """
+    payloads = makePayloads()
+
+    print('{0:<22} {1:<8} {2:>10} {3:>12} {4:>12}'.format('payload', 'codec', 'bytes', 'encode [us]', 'decode [us]'))
+    for label in payloads:
+        data = payloads[label]
+        for name in codec.codecs:
+            c = codec.codecs[name]
+            raw = c.encode(data)
+            encode = measure(lambda: c.encode(data), repeat)
+            # @NOTE: only client frames are decoded by the server, so the
+            # frame is decoded as plain JSON here
+            decode = measure(lambda: codec.codecs['json'].decode(raw), repeat)
+            print('{0:<22} {1:<8} {2:>10} {3:>12.1f} {4:>12.1f}'.format(label, name, len(raw), encode, decode))
+
+
+def benchJson(repeat=1000):
+    """ Compare available JSON libraries on REFRESH and UPDATE payloads. """
+    libs = {
+        'json' : (lambda d: json.dumps(d), json.loads)
+    }
+    if codec.orjson is not None:
+        libs['orjson'] = (lambda d: codec.orjson.dumps(d).decode('utf-8'), codec.orjson.loads)
+    if codec.ujson is not None:
+        libs['ujson'] = (codec.ujson.dumps, codec.ujson.loads)
+    print('codec module uses "{0}"'.format(codec.backend))
+    
+    payloads = makePayloads()
+    print('{0:<22} {1:<8} {2:>12} {3:>12}'.format('payload', 'library', 'dumps [us]', 'loads [us]'))
+    for label in payloads:
+        data = payloads[label]
+        for name in libs:
+            dumps, loads = libs[name]
+            raw = dumps(data)
+            encode = measure(lambda: dumps(data), repeat)
+            decode = measure(lambda: loads(raw), repeat)
+            print('{0:<22} {1:<8} {2:>12.1f} {3:>12.1f}'.format(label, name, encode, decode))
+
+
+# ---------------------------------------------------------------------
+
+def makeEngine(root, argv=list()):
+    """ Create quiet engine inside the given directory, including a GM
+    'foo' with a game 'bar'. Returns engine and game cache. """
+    from engine import Engine
+    from utils import PathApi
+    
+    paths = PathApi(appname='unittest', root=root)
+    for w in ['verbs', 'adjectives', 'nouns']:
+        with open(paths.getFancyUrlPath() / '{0}.txt'.format(w), 'w') as h:
+            h.write('demo')
+    
+    # @NOTE: loggers are global, so drop handlers of previous engines
+    for name in ['info_log', 'error_log', 'access_log', 'warning_log', 'logins_log', 'auth_log']:
+        logging.getLogger(name).handlers.clear()
+    
+    engine = Engine(argv=['--quiet'] + argv, pref_dir=root)
+    # @NOTE: avoid network access
+    engine.getPublicIp = lambda: '?.?.?.?'
+    engine.getCountryFromIp = lambda ip: 'unknown'
+    
+    with db_session:
+        gm = engine.main_db.GM(name='foo', url='foo', sid='123456')
+        gm.postSetup()
+    gm_cache = engine.cache.get(gm)
+    gm_cache.connect_db()
+    with db_session:
+        game = gm_cache.db.Game(url='bar', gm_url='foo')
+        game.postSetup()
+        scene = gm_cache.db.Scene(game=game)
+        gm_cache.db.commit()
+        game.active = scene.id
+    
+    return engine, gm_cache.getFromUrl('bar')
+
+
+def createTokensOneByOne(game_cache, urls, posx, posy, size):
+    """ Former token creation: one commit per token. """
+    db = game_cache.parent.db
+    n = len(urls)
+    with db_session:
+        g = db.Game.select(lambda g: g.url == game_cache.url).first()
+        s = db.Scene.select(lambda s: s.id == g.active).first()
+        for k, url in enumerate(urls):
+            x, y = db.Token.getPosByDegree((posx, posy), k, n)
+            t = db.Token(scene=s.id, timeid=time.time(), url=url, size=size,
+                posx=x, posy=y)
+            db.commit()
+            if s.backing is None:
+                t.size = -1
+            if t.size == -1:
+                s.backing = t
+            t.to_dict()
+
+
+def benchCreate(repeat=5):
+    """ Compare bulk token creation with creating tokens one by one. """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine, game_cache = makeEngine(pathlib.Path(tmpdir))
+        player = game_cache.insert('arthur', 'red', True)
+        
+        print('{0:>7} {1:>16} {2:>16}'.format('tokens', 'one by one [ms]', 'bulk [ms]'))
+        for n in [1, 10, 100, 500]:
+            urls = ['/token/{0}.png'.format(i) for i in range(n)]
+            data = {'posx': 500, 'posy': 300, 'size': 60, 'urls': urls}
+            
+            single = measure(lambda: createTokensOneByOne(game_cache, urls, 500, 300, 60), repeat)
+            bulk   = measure(lambda: game_cache.onCreateToken(player, data), repeat)
+            print('{0:>7} {1:>16.2f} {2:>16.2f}'.format(n, single / 1000, bulk / 1000))
+        
+        game_cache.cleanup()
+
+
+def cloneSceneOneByOne(game_cache, scene_id):
+    """ Former scene cloning: one entity per token, broadcast inside the
+    database session. """
+    db = game_cache.parent.db
+    with db_session:
+        g = db.Game.select(lambda g: g.url == game_cache.url).first()
+        s = db.Scene.select(lambda s: s.id == scene_id).first()
+        game_cache.dropScene()
+        clone = db.Scene(game=g)
+        for t in s.tokens:
+            if t.size != -1:
+                db.Token(scene=clone, url=t.url, posx=t.posx, posy=t.posy,
+                    zorder=t.zorder, size=t.size, rotate=t.rotate,
+                    flipx=t.flipx, locked=t.locked, text=t.text,
+                    color=t.color)
+        db.commit()
+        g.active = clone.id
+        g.order.append(clone.id)
+        game_cache.broadcastSceneSwitch(g)
+
+
+def benchClone(repeat=5):
+    """ Compare bulk scene cloning with cloning tokens one by one. """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        engine, game_cache = makeEngine(pathlib.Path(tmpdir))
+        player = game_cache.insert('arthur', 'red', True)
+        
+        print('{0:>7} {1:>16} {2:>16}'.format('tokens', 'one by one [ms]', 'bulk [ms]'))
+        for n in [10, 100, 500]:
+            # populate a fresh scene
+            game_cache.onCreateScene(player, {})
+            urls = ['/token/{0}.png'.format(i) for i in range(n)]
+            game_cache.onCreateToken(player, {'posx': 500, 'posy': 300, 'size': 60, 'urls': urls})
+            game_cache.flush()
+            with db_session:
+                scene_id = game_cache.parent.db.Game.select(lambda g: g.url == game_cache.url).first().active
+            
+            single = measure(lambda: cloneSceneOneByOne(game_cache, scene_id), repeat)
+            bulk   = measure(lambda: game_cache.onCloneScene(player, {'scene': scene_id}), repeat)
+            print('{0:>7} {1:>16.2f} {2:>16.2f}'.format(n, single / 1000, bulk / 1000))
+        
+        game_cache.cleanup()
+
+
+def benchLogins(repeat=2000):
+    """ Compare player logins with synchronous and queued logging. """
+    print('{0:<8} {1:>14} {2:>14}'.format('logging', 'login [us]', 'flush [us]'))
+    for label, argv in [('sync', ['--sync-logs']), ('queued', [])]:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            engine, game_cache = makeEngine(pathlib.Path(tmpdir), argv)
+            engine.logging.flush()
+            
+            def login():
+                # @NOTE: offline players are replaced
+                player = game_cache.insert('arthur', 'red', False)
+                engine.logging.warning('{0} logged in'.format(player.name))
+            
+            login_time = measure(login, repeat)
+            start = time.perf_counter()
+            engine.logging.flush()
+            flush_time = (time.perf_counter() - start) / repeat * 1000000
+            print('{0:<8} {1:>14.1f} {2:>14.1f}'.format(label, login_time, flush_time))
+            
+            game_cache.cleanup()
+
+
+def benchHashing(num_images=1000, size=128 * 1024):
+    """ Compare hashing a game's images inside the hub with hashing them
+    on the threadpool. The hub's responsiveness is measured by the max.
+    delay of a ticking greenlet. """
+    import os, gevent
+    from engine import Engine
+    from utils import HashingApi
+    
+    def run(func):
+        """ Return total time and longest gap between two ticks in ms. """
+        ticks = list()
+        def tick():
+            while True:
+                ticks.append(time.perf_counter())
+                gevent.sleep(0.001)
+        ticker = gevent.spawn(tick)
+        gevent.sleep(0)
+        start = time.perf_counter()
+        func()
+        total = time.perf_counter() - start
+        ticks.append(time.perf_counter())
+        ticker.kill()
+        stall = max(b - a for a, b in zip(ticks, ticks[1:]))
+        return total * 1000, stall * 1000
+    
+    with tempfile.TemporaryDirectory() as tmpdir:
+        root  = pathlib.Path(tmpdir)
+        paths = list()
+        for i in range(num_images):
+            paths.append(root / '{0}.png'.format(i))
+            with open(paths[-1], 'wb') as h:
+                h.write(os.urandom(size))
+        
+        def serial():
+            for path in paths:
+                with open(path, 'rb') as h:
+                    Engine.getMd5(h)
+        
+        print('{0} images with {1} KiB each'.format(num_images, size // 1024))
+        print('{0:<12} {1:>12} {2:>16}'.format('method', 'total [ms]', 'max stall [ms]'))
+        total, stall = run(serial)
+        print('{0:<12} {1:>12.1f} {2:>16.1f}'.format('hub', total, stall))
+        for threads in [1, 2, 4, 8]:
+            api = HashingApi(threads=threads)
+            total, stall = run(lambda: api.getMd5s(paths))
+            print('{0:<12} {1:>12.1f} {2:>16.1f}'.format('{0} threads'.format(threads), total, stall))
+
+
+# ---------------------------------------------------------------------
+
+benchmarks = {
+    'codec'  : benchCodec,
+    'json'   : benchJson,
+    'create' : benchCreate,
+    'clone'  : benchClone,
+    'logins'  : benchLogins,
+    'hashing' : benchHashing
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks)
+    for name in names:
+        if name not in benchmarks:
+            print('Unknown benchmark "{0}", available: {1}'.format(name, ', '.join(benchmarks)))
+            sys.exit(1)
+        print('=' * 80)
+        print(name)
+        print('=' * 80)
+        benchmarks[name]()
@@ -7,15 +7,16 @@ Copyright (c) 2020-2021 Christian Glöckner
 License: MIT (see LICENSE for details)
 """
 
-import time, requests, uuid, json, random, os, flag
+import time, requests, uuid, random, os, flag, collections
 
 from bottle import request
 import gevent
 
-from gevent import lock
+from gevent import lock, queue, event
 from geventwebsocket.exceptions import WebSocketError
 
-from orm import db_session, createGmDatabase
+from orm import db_session, createGmDatabase, closeConnections
+import codec
 
 
 __author__ = 'Christian Glöckner'
@@ -23,11 +24,39 @@ __licence__ = 'MIT'
 
 
 
+class TokenBucket(object):
+    """ Rate limiter which allows a burst of actions and refills at a
+    fixed rate (per second).
+    """
+    
+    def __init__(self, rate, burst):
+        self.rate   = rate
+        self.burst  = burst
+        self.tokens = burst
+        self.last   = time.monotonic()
+        
+    def take(self):
+        """ Consume a token if possible. Returns 0 if allowed, otherwise
+        the number of seconds until the next token is available. """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last   = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# ---------------------------------------------------------------------
+
 class PlayerCache(object):
     """Holds a single player.
     """
     instance_count = 0 # instance counter for server status
     
+    # rate-limited actions of these OPIDs are dropped instead of deferred
+    droppable = ['PING', 'SELECT', 'RANGE', 'BEACON']
+    
     def __init__(self, engine, parent, name, color, is_gm):
         PlayerCache.instance_count += 1
         
@@ -36,7 +65,7 @@ class PlayerCache(object):
         self.name     = name
         self.color    = color
         self.uuid     = uuid.uuid4().hex # used for HTML DOM id
-        self.selected = list()
+        self.selected = set() # ids of selected tokens
         self.index    = parent.getNextId() # used for ordering players in the UI
         self.is_gm    = is_gm # whether this player is the GM or not
         self.timeid   = time.time() # NOTE: currently not used but could be useful later
@@ -52,10 +81,27 @@ class PlayerCache(object):
         
         # add login to stats
         login_data = [self.is_gm, time.time(), self.country, self.ip, PlayerCache.instance_count]
-        self.engine.logging.logins(json.dumps(login_data))
+        self.engine.logging.logins(codec.dumps(login_data))
         
         self.lock     = lock.RLock()
         self.socket   = None
+        self.codec    = codec.negotiate(None) # websocket encoding (see EngineCache.listen)
+        
+        # outbound frames are sent by a dedicated writer greenlet
+        self.outbox    = queue.Queue(self.engine.websocket['queue_size']) # state frames
+        self.ephemeral = collections.OrderedDict() # (OPID, sender) => latest ephemeral frame
+        self.wakeup    = event.Event() # set if any frame is pending
+        self.writer    = None
+        self.dropped   = 0 # number of frames dropped due to overflow
+        self.discarded = 0 # number of ephemeral frames replaced or evicted
+        self.read_size = 0 # size of the last incoming frame (see Engine.metrics)
+        
+        # incoming actions are rate-limited per OPID (see Engine.ratelimit)
+        self.buckets   = dict()
+        self.limited   = {
+            'dropped'  : collections.Counter(), # OPID => number of dropped actions
+            'deferred' : collections.Counter()  # OPID => number of delayed actions
+        }
         
         self.dispatch_map = {
             'PING'   : self.parent.onPing,
@@ -99,17 +145,109 @@ class PlayerCache(object):
         #with self.lock:# note: atm deadlocking
         raw = self.socket.receive()
         if raw is not None:
+            self.read_size = len(raw)
             # parse data
-            return json.loads(raw)
+            return self.codec.decode(raw)
         
     def write(self, data):
         """ Write JSON object to socket. """
         # dump data
-        raw = json.dumps(data)
+        raw = self.codec.encode(data)
         # send data
-        #with self.lock: # note: atm deadlocking
-        if self.socket is not None:
-            self.socket.send(raw)
+        self.send(raw)
+        
+    def send(self, raw):
+        """ Enqueue serialized frame. The frame is sent by the writer
+        greenlet, so this never blocks on a slow client.
+        """
+        if self.socket is None:
+            return
+        if self.writer is None or self.writer.dead:
+            self.writer = gevent.spawn(self.drain)
+        try:
+            self.outbox.put_nowait(raw)
+        except queue.Full:
+            self.onOverflow()
+            return
+        self.wakeup.set()
+        
+    def sendEphemeral(self, key, raw):
+        """ Enqueue serialized ephemeral frame (e.g. a beacon). Only the
+        latest frame per key is kept, and these frames are only sent if
+        no state frames are pending. If too many keys are pending, the
+        oldest frame is dropped.
+        """
+        if self.socket is None:
+            return
+        if self.writer is None or self.writer.dead:
+            self.writer = gevent.spawn(self.drain)
+        if key in self.ephemeral:
+            # coalesce with previous frame of that sender
+            del self.ephemeral[key]
+            self.discarded += 1
+        self.ephemeral[key] = raw
+        while len(self.ephemeral) > self.engine.websocket['ephemeral_size']:
+            self.ephemeral.popitem(last=False)
+            self.discarded += 1
+        self.wakeup.set()
+        
+    def onOverflow(self):
+        """ Handle frame that does not fit into the outbound queue. """
+        self.dropped += 1
+        if self.engine.websocket['overflow'] == 'drop':
+            if self.dropped == 1:
+                self.engine.logging.warning('Outbound queue of {0} by {1} is full, dropping frames'.format(self.name, self.ip))
+            return
+        
+        # client cannot keep up: hang up and let the handler logout
+        self.engine.logging.warning('Outbound queue of {0} by {1} is full, disconnecting'.format(self.name, self.ip))
+        self.hangup()
+        
+    def hangup(self):
+        """ Close the socket and stop sending. """
+        socket = self.socket
+        self.socket = None
+        if socket is not None and not socket.closed:
+            try:
+                socket.close()
+            except WebSocketError:
+                pass
+        self.stopWriter()
+        
+    def drain(self):
+        """ Writer greenlet: sends queued state frames in order. Ephemeral
+        frames are sent if no state frame is pending. """
+        while True:
+            if not self.outbox.empty():
+                raw = self.outbox.get_nowait()
+            elif len(self.ephemeral) > 0:
+                key, raw = self.ephemeral.popitem(last=False)
+            else:
+                self.wakeup.clear()
+                self.wakeup.wait()
+                continue
+            socket = self.socket
+            if socket is None:
+                break
+            try:
+                socket.send(raw)
+            except WebSocketError as error:
+                self.engine.logging.warning('WebSocket died while writing: {0}'.format(error))
+                self.socket = None
+                break
+            self.dropped = 0
+        
+        # discard pending frames
+        while not self.outbox.empty():
+            self.outbox.get_nowait()
+        self.ephemeral.clear()
+        
+    def stopWriter(self):
+        """ Stop the writer greenlet (if running). """
+        writer = self.writer
+        self.writer = None
+        if writer is not None and writer is not gevent.getcurrent():
+            writer.kill(block=False)
         
     def fetch(self, data, key):
         """ Try to fetch key from data or raise ProtocolError. """
@@ -120,6 +258,54 @@ class PlayerCache(object):
             # reraise since it's unexpected
             raise
         
+    def throttle(self, opid):
+        """ Apply rate limit of the given OPID. Returns False if the action
+        is dropped. Other actions are deferred until they are allowed, which
+        also stops reading from this socket in the meantime. """
+        bucket = self.buckets.get(opid)
+        if bucket is None:
+            limit = self.engine.ratelimit.get(opid)
+            if limit is None or limit[0] <= 0:
+                # unlimited
+                return True
+            bucket = TokenBucket(*limit)
+            self.buckets[opid] = bucket
+        
+        wait = bucket.take()
+        if wait == 0.0:
+            return True
+        
+        if opid in PlayerCache.droppable:
+            self.limited['dropped'][opid] += 1
+            if self.limited['dropped'][opid] == 1:
+                self.engine.logging.warning('Player {0} by {1} exceeded the rate limit of {2}, dropping actions'.format(self.name, self.ip, opid))
+            return False
+        
+        self.limited['deferred'][opid] += 1
+        while wait > 0.0:
+            gevent.sleep(wait)
+            wait = bucket.take()
+        return True
+        
+    def dispatch(self, opid, func, data):
+        """ Call handler and record its latency. """
+        db    = self.parent.parent.db
+        stat  = db.local_stats[None]
+        db_start = stat.sum_time or 0.0
+        start = time.perf_counter()
+        try:
+            func(self, data)
+        finally:
+            wall = time.perf_counter() - start
+            # @NOTE: pony's statistics are greenlet-local
+            stat = db.local_stats[None]
+            db_time = (stat.sum_time or 0.0) - db_start
+            if db_time < 0.0:
+                # statistics were reset meanwhile
+                db_time = stat.sum_time or 0.0
+            game = '{0}/{1}'.format(self.parent.parent.url, self.parent.url)
+            self.engine.metrics.recordAction(opid, game, wall, db_time, self.read_size)
+        
     def handle_async(self):
         """ Runs a greenlet to handle asyncronously. """
         self.greenlet = gevent.Greenlet(run=self.handle)
@@ -138,16 +324,160 @@ class PlayerCache(object):
                 # dispatch operation
                 opid = self.fetch(data, 'OPID')
                 func = self.dispatch_map[opid]
-                func(self, data)
+                if self.throttle(opid):
+                    self.dispatch(opid, func, data)
             
         except Exception as error:
             self.engine.logging.warning('WebSocket died: {0}'.format(error))
             self.socket = None
-
+        
+        self.stopWriter()
+        
         # remove player
         self.parent.logout(self)
 
 
+# ---------------------------------------------------------------------
+
+class GridIndex(object):
+    """ Uniform grid of token ids by position, used for range queries.
+    """
+    cell_size = 64 # px, scene is 16x9 cells
+    
+    def __init__(self):
+        self.cells   = dict() # (x, y) => set of token ids
+        self.cell_of = dict() # token id => (x, y)
+        
+    def getCell(self, x, y):
+        return (int(x) // self.cell_size, int(y) // self.cell_size)
+        
+    def insert(self, token_id, x, y):
+        cell = self.getCell(x, y)
+        self.cells.setdefault(cell, set()).add(token_id)
+        self.cell_of[token_id] = cell
+        
+    def remove(self, token_id):
+        cell = self.cell_of.pop(token_id, None)
+        if cell is None:
+            return
+        ids = self.cells[cell]
+        ids.discard(token_id)
+        if len(ids) == 0:
+            del self.cells[cell]
+        
+    def move(self, token_id, x, y):
+        if self.cell_of.get(token_id) == self.getCell(x, y):
+            return
+        self.remove(token_id)
+        self.insert(token_id, x, y)
+        
+    def query(self, left, top, width, height):
+        """ Return ids of all tokens within cells touching the given
+        rectangle. """
+        x0, y0 = self.getCell(left, top)
+        x1, y1 = self.getCell(left + width, top + height)
+        found = set()
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                found.update(self.cells.get((x, y), ()))
+        return found
+
+
+# ---------------------------------------------------------------------
+
+class SceneCache(object):
+    """ In-memory table of a scene's tokens using the token id as key.
+    Each token is stored as a dict (see Token.to_dict). Changed tokens
+    are marked as dirty until they are written to the GM's database.
+    Serialized REFRESH frames are kept until the scene changes.
+    """
+    
+    def __init__(self, scene_id, background, tokens):
+        self.id         = scene_id
+        self.background = background # id of the background token
+        self.tokens     = dict()
+        self.dirty      = set() # ids of tokens not written to the database yet
+        self.version    = 0      # increased with every change
+        self.frames     = dict() # codec name => (version, REFRESH frame)
+        self.grid       = GridIndex() # positions of all non-background tokens
+        
+        for data in tokens:
+            self.tokens[data['id']] = data
+            self.reindex(data['id'])
+        
+    @staticmethod
+    def load(scene):
+        """ Create table from a scene entity. """
+        background = scene.backing.id if scene.backing is not None else None
+        tokens = [t.to_dict() for t in scene.tokens.order_by(lambda t: t.id)]
+        return SceneCache(scene.id, background, tokens)
+        
+    def get(self, token_id):
+        return self.tokens.get(token_id, None)
+        
+    def insert(self, token):
+        """ Add a token entity, which was just created. """
+        self.tokens[token.id] = token.to_dict()
+        if token.size == -1:
+            self.background = token.id
+        self.reindex(token.id)
+        self.version += 1
+        
+    def update(self, token_id, changes):
+        """ Apply changes (see Token.getChanges) to a token. """
+        self.tokens[token_id].update(changes)
+        self.dirty.add(token_id)
+        if 'posx' in changes or 'posy' in changes or 'size' in changes:
+            self.reindex(token_id)
+        self.version += 1
+        
+    def remove(self, token_id):
+        del self.tokens[token_id]
+        self.dirty.discard(token_id)
+        self.grid.remove(token_id)
+        if self.background == token_id:
+            self.background = None
+        self.version += 1
+        
+    def getData(self):
+        return list(self.tokens.values())
+        
+    def reindex(self, token_id):
+        """ Update the token's grid position. Backgrounds are not
+        indexed, because they cannot be range selected. """
+        t = self.tokens[token_id]
+        if t['size'] == -1:
+            self.grid.remove(token_id)
+        else:
+            self.grid.move(token_id, t['posx'], t['posy'])
+        
+    def query(self, left, top, width, height):
+        """ Return ids of all tokens (except backgrounds) which are
+        located inside the given rectangle. """
+        found = set()
+        for token_id in self.grid.query(left, top, width, height):
+            t = self.tokens[token_id]
+            if left <= t['posx'] <= left + width and top <= t['posy'] <= top + height:
+                found.add(token_id)
+        return found
+        
+    def getRefresh(self):
+        return {
+            'OPID'       : 'REFRESH',
+            'tokens'     : self.getData(),
+            'background' : self.background
+        }
+        
+    def getRefreshFrame(self, c):
+        """ Return REFRESH frame serialized by the given codec. The frame
+        is only serialized once per version. """
+        frame = self.frames.get(c.name)
+        if frame is None or frame[0] != self.version:
+            frame = (self.version, c.encode(self.getRefresh()))
+            self.frames[c.name] = frame
+        return frame[1]
+
+
 # ---------------------------------------------------------------------
 
 class GameCache(object):
@@ -165,6 +495,15 @@ class GameCache(object):
         self.next_id = 0 # used for player indexing in UI
 
         self.playback  = None
+        
+        self.scene   = None # in-memory table of the active scene (see getScene)
+        self.timeid  = None # game's timeid, which was not written to the database yet
+        self.flusher = None # greenlet for writing dirty data to the database
+        
+        self.pending = dict() # token id => latest record awaiting broadcast
+        self.ticker  = None   # greenlet for broadcasting pending updates
+        
+        self.last_access = time.time() # used for idle eviction (see GmCache.evictIdle)
 
         #self.engine.logging.info('GameCache {0} for GM {1} created'.format(self.url, self.parent.url))
         if num_generated > 0:
@@ -189,13 +528,13 @@ class GameCache(object):
             for new_index, n in enumerate(tmp):
                 self.players[n].index = new_index
 
+    def getAssets(self):
+        """ Return the game's asset index (see utils.AssetIndex). """
+        return self.engine.getAssets(self.parent.url, self.url)
+
     def getAllSlots(self):
-        root = self.engine.paths.getGamePath(self.parent.url, self.url)
-        slots = list()
-        for slot_id in range(self.engine.file_limit['num_music']):
-            if os.path.exists(root / '{0}.mp3'.format(slot_id)):
-                slots.append(slot_id)
-        return slots
+        num_music = self.engine.file_limit['num_music']
+        return [slot_id for slot_id in self.getAssets().getSlots() if slot_id < num_music]
 
     def uploadMusic(self, handle):
         root = self.engine.paths.getGamePath(self.parent.url, self.url)
@@ -212,6 +551,7 @@ class GameCache(object):
                 # save file
                 fname = root / '{0}.mp3'.format(next_slot)
                 handle.save(destination=str(fname), overwrite=True)
+                self.getAssets().addMusic(next_slot, os.stat(fname))
 
         return next_slot
 
@@ -224,7 +564,146 @@ class GameCache(object):
                 fname = root / '{0}.mp3'.format(int(slot_id))
                 if os.path.exists(fname):
                     os.remove(fname)
-    
+                self.getAssets().removeMusic(int(slot_id))
+
+    # --- scene state implementation ----------------------------------
+
+    def getScene(self):
+        """ Return the in-memory table of the active scene. The table is
+        loaded from the GM's database on first access. Returns None if
+        the game or its active scene cannot be found.
+        """
+        with self.lock:
+            if self.scene is None:
+                with db_session:
+                    g = self.parent.db.Game.select(lambda g: g.url == self.url).first()
+                    if g is None:
+                        return None
+                    s = self.parent.db.Scene.select(lambda s: s.id == g.active).first()
+                    if s is None:
+                        return None
+                    self.scene = SceneCache.load(s)
+            return self.scene
+
+    def dropScene(self):
+        """ Write all pending changes and forget the active scene's table.
+        This is necessary whenever the active scene is switched.
+        """
+        with self.lock:
+            self.flush()
+            self.scene = None
+
+    def touch(self, now):
+        """ Mark the game as being used. The timeid is written to the
+        database with the next flush. """
+        with self.lock:
+            self.timeid = now
+            self.scheduleFlush()
+
+    def rememberToken(self, token):
+        """ Add a newly created token to the active scene's table. """
+        with self.lock:
+            if self.scene is not None and token.scene.id == self.scene.id:
+                self.scene.insert(token)
+
+    def forgetToken(self, token_id):
+        """ Remove a deleted token from the active scene's table. """
+        with self.lock:
+            if self.scene is not None and self.scene.get(token_id) is not None:
+                self.scene.remove(token_id)
+
+    def scheduleFlush(self):
+        """ Trigger writing dirty data to the GM's database soon. """
+        with self.lock:
+            if self.flusher is None:
+                delay = self.engine.storage['flush_delay']
+                self.flusher = gevent.spawn_later(delay, self.flush)
+
+    def flush(self):
+        """ Write the game's timeid and all dirty tokens of the active
+        scene to the GM's database. """
+        with self.lock:
+            if self.flusher is not None and self.flusher is not gevent.getcurrent():
+                self.flusher.kill(block=False)
+            self.flusher = None
+
+            timeid  = self.timeid
+            scene   = self.scene
+            records = dict()
+            if scene is not None:
+                for tid in scene.dirty:
+                    records[tid] = scene.tokens[tid]
+
+            if timeid is None and len(records) == 0:
+                return
+
+            ids = list(records)
+            with db_session:
+                if timeid is not None:
+                    g = self.parent.db.Game.select(lambda g: g.url == self.url).first()
+                    if g is not None:
+                        g.timeid = max(g.timeid, timeid)
+
+                # @NOTE: tokens may have been deleted in the meantime
+                for t in self.parent.db.Token.select(lambda t: t.id in ids):
+                    data = records[t.id]
+                    t.set(posx=data['posx'], posy=data['posy'],
+                        zorder=data['zorder'], size=data['size'],
+                        rotate=data['rotate'], flipx=data['flipx'],
+                        locked=data['locked'], timeid=data['timeid'],
+                        text=data['text'], color=data['color'])
+
+            # @NOTE: changes are only dropped after they were committed,
+            # otherwise they are written by the next flush
+            if scene is not None:
+                scene.dirty.difference_update(ids)
+            self.timeid = None
+
+    # --- broadcast tick implementation -------------------------------
+
+    def queueUpdate(self, tokens):
+        """ Queue (partial) token records for the next broadcast tick.
+        Records of the same token and sender are merged (last write wins). If
+        ticking is disabled, the records are broadcast immediately.
+        """
+        tick_rate = self.engine.websocket['tick_rate']
+        if tick_rate <= 0:
+            self.broadcast({
+                'OPID'    : 'UPDATE',
+                'tokens'  : tokens
+            })
+            return
+        
+        with self.lock:
+            for token in tokens:
+                record = self.pending.get(token['id'])
+                if record is not None and record['uuid'] != token['uuid']:
+                    # @NOTE: a record carries a single sender, whose client
+                    # ignores its own (predicted) positions; so another
+                    # sender's changes must not be merged into it
+                    self.tick()
+                # merge partial records field by field
+                self.pending.setdefault(token['id'], dict()).update(token)
+            if self.ticker is None and len(self.pending) > 0:
+                self.ticker = gevent.spawn_later(1.0 / tick_rate, self.tick)
+
+    def tick(self):
+        """ Broadcast all pending token updates as a single frame. """
+        with self.lock:
+            if self.ticker is not None and self.ticker is not gevent.getcurrent():
+                self.ticker.kill(block=False)
+            self.ticker = None
+            
+            if len(self.pending) == 0:
+                return
+            tokens = list(self.pending.values())
+            self.pending.clear()
+            
+            self.fanOut({
+                'OPID'    : 'UPDATE',
+                'tokens'  : tokens
+            })
+
     # --- cache implementation ----------------------------------------
 
     def insert(self, name, color, is_gm):
@@ -265,7 +744,7 @@ class GameCache(object):
         result = dict()
         with self.lock:
             for name in self.players:
-                result[name] = self.players[name].selected
+                result[name] = list(self.players[name].selected)
         return result
         
     def remove(self, name):
@@ -305,6 +784,7 @@ class GameCache(object):
         
         player.write({
             'OPID'     : 'ACCEPT',
+            'codec'    : player.codec.name,
             'players'  : self.getData(),
             'rolls'    : rolls,
             'urls'     : list(set(urls)), # drop duplicates
@@ -312,7 +792,7 @@ class GameCache(object):
             'playback' : self.playback
         });
         
-        player.write(self.fetchRefresh(g.active))
+        self.sendRefresh([player], g.active)
         
         # broadcast join to all players
         self.broadcast({
@@ -353,6 +833,11 @@ class GameCache(object):
             'uuid'    : player.uuid
         })
         
+        with self.lock:
+            if len(self.players) == 0:
+                # nobody is playing: persist and free the scene's table
+                self.dropScene()
+        
     def disconnect(self, uuid):
         """ Close single socket. """ 
         with self.lock:
@@ -373,26 +858,50 @@ class GameCache(object):
         with self.lock:
             for name in self.players:
                 p = self.players[name]
-                if p.socket != None and not p.socket.closed:
-                    p.socket.close()
+                p.hangup()
             self.players.clear()
+            self.pending.clear()
+            if self.ticker is not None:
+                self.ticker.kill(block=False)
+                self.ticker = None
+            self.dropScene()
     
     def broadcast(self, data):
         """ Broadcast given data to all clients. """
-        # dump once, send multiple times
-        raw = json.dumps(data)
-        
-        with self.lock:
-            force_logout = list()
-            # broadcast
-            for name in self.players:
-                s = self.players[name].socket
-                try:
-                    #self.players[name].write(data)
-                    if s is not None:
-                        s.send(raw)
-                except WebSocketError:
-                    pass
+        # @NOTE: pending updates go first to keep the order of frames,
+        # e.g. a deleted token must not be updated afterwards
+        self.tick()
+        self.fanOut(data)
+        
+    def broadcastEphemeral(self, data, sender):
+        """ Broadcast given ephemeral data to all clients. Such frames
+        are coalesced per OPID and sender and may be dropped, so they
+        never delay state changes. """
+        self.fanOut(data, key=(data['OPID'], sender))
+        
+    def fanOut(self, data, recipients=None, key=None):
+        """ Enqueue given data for all (or the given) clients. If a key is
+        given, the data is enqueued as ephemeral frame. """
+        start = time.perf_counter()
+        if recipients is None:
+            with self.lock:
+                recipients = list(self.players.values())
+        
+        # dump once per encoding, send multiple times
+        frames = dict()
+        for p in recipients:
+            raw = frames.get(p.codec.name)
+            if raw is None:
+                raw = p.codec.encode(data)
+                frames[p.codec.name] = raw
+            # @NOTE: frames are only enqueued, writer greenlets do the sending
+            if key is None:
+                p.send(raw)
+            else:
+                p.sendEphemeral(key, raw)
+        
+        size = sum(len(raw) for raw in frames.values())
+        self.engine.metrics.recordBroadcast(time.perf_counter() - start, size)
         
     def broadcastTokenUpdate(self, player, since):
         """ Broadcast updated tokens. """
@@ -400,17 +909,18 @@ class GameCache(object):
         all_data = list()    
         
         now = time.time()
-        with db_session:
-            g = self.parent.db.Game.select(lambda g: g.url == self.url).first()
-            if g is None:
+        with self.lock:
+            scene = self.getScene()
+            if scene is None:
                 self.engine.logging.warning('A token update broadcast could not be performed at {0}/{1} by {2}, because the game was not found'.format(self.parent.url, self.url, self.engine.getClientIp(request)))
                 return;
-            g.timeid = now
+            self.touch(now)
             
-            for t in self.parent.db.Token.select(lambda t: t.scene.id == g.active and t.timeid >= since):
-                tmp = t.to_dict()
-                tmp['uuid'] = player.uuid
-                all_data.append(tmp)
+            for t in scene.getData():
+                if t['timeid'] >= since:
+                    tmp = dict(t)
+                    tmp['uuid'] = player.uuid
+                    all_data.append(tmp)
 
         # broadcast update
         self.broadcast({
@@ -420,14 +930,35 @@ class GameCache(object):
         
     def broadcastSceneSwitch(self, game):
         """ Broadcast scene switch. """
-        # collect all tokens for the given scene
-        refresh_data = self.fetchRefresh(game.active)
+        # @NOTE: pending updates go first (see broadcast)
+        self.tick()
+        
+        with self.lock:
+            recipients = list(self.players.values())
         
         # broadcast switch
-        self.broadcast(refresh_data);
+        self.sendRefresh(recipients, game.active)
+        
+    def sendRefresh(self, recipients, scene_id):
+        """ Send a full refresh on all tokens to the given players. The
+        active scene's REFRESH is served from its serialized frames. """
+        with self.lock:
+            scene = self.getScene()
+            if scene is not None and scene.id == scene_id:
+                for p in recipients:
+                    p.send(scene.getRefreshFrame(p.codec))
+                return
+        
+        self.fanOut(self.fetchRefresh(scene_id), recipients)
 
     def fetchRefresh(self, scene_id):
         """ Performs a full refresh on all tokens. """  
+        # serve active scene from memory
+        with self.lock:
+            scene = self.getScene()
+            if scene is not None and scene.id == scene_id:
+                return scene.getRefresh()
+        
         tokens = list()
         background_id = 0
         with db_session:
@@ -455,9 +986,9 @@ class GameCache(object):
         # pong!
         try:
             player.timeid = time.time() # NOTE: currently not used but could be useful later
-            player.write({
+            player.sendEphemeral(('PING', player.uuid), player.codec.encode({
                 'OPID'    : 'PING'
-            }); 
+            }))
         except:
             # player quit (broken socket or invalid JSON data)
             self.logout(player)
@@ -500,14 +1031,14 @@ class GameCache(object):
     def onSelect(self, player, data):
         """ Handle player selecting a token. """
         # store selection
-        player.selected = data['selected']
+        player.selected = set(data['selected'])
         
         # broadcast selection
-        self.broadcast({
+        self.broadcastEphemeral({
             'OPID'     : 'SELECT',
             'color'    : player.color,
-            'selected' : player.selected,
-        });
+            'selected' : list(player.selected),
+        }, player.uuid)
         
     def onRange(self, player, data):
         """ Handle player selecting multiple tokens. """
@@ -524,32 +1055,26 @@ class GameCache(object):
         
         now = time.time()
         # query inside given rectangle
-        with db_session:
-            g = self.parent.db.Game.select(lambda g: g.url == self.url).first()
-            if g is None:
-                self.engine.logging.warning('Player {0} tried range select at {1}/{2} by {3}, but the game was not found'.format(player.name, self.parent.url, self.url, player.ip))
-                return
-            g.timeid = now
-            
-            s = self.parent.db.Scene.select(lambda s: s.id == g.active).first()
+        with self.lock:
+            s = self.getScene()
             if s is None:
-                self.engine.logging.warning('Player {0} tried range select at {1}/{2} in scene #{3} by {4}, but the scene was not found'.format(player.name, self.parent.url, self.url, g.active, player.ip))
+                self.engine.logging.warning('Player {0} tried range select at {1}/{2} by {3}, but the scene was not found'.format(player.name, self.parent.url, self.url, player.ip))
                 return
+            self.touch(now)
                 
-            token_ids = player.selected if adding else list()
-            for t in self.parent.db.Token.select(lambda t: t.scene == s and left <= t.posx and t.posx <= left + width and top <= t.posy and t.posy <= top + height): 
-                if t.size != -1:
-                    token_ids.append(t.id)
+            token_ids = s.query(left, top, width, height)
+            if adding:
+                token_ids |= player.selected
         
         # store selection
         player.selected = token_ids
         
         # broadcast selection
-        self.broadcast({
+        self.broadcastEphemeral({
             'OPID'     : 'SELECT',
             'color'    : player.color,
-            'selected' : player.selected,
-        });
+            'selected' : list(player.selected),
+        }, player.uuid)
         
     def onOrder(self, player, data):
         """ Handle reordering a player box. """
@@ -590,80 +1115,78 @@ class GameCache(object):
         """ Handle player changing token data. """
         # fetch changes' data
         changes = data['changes']
-        changes.sort(key=lambda elem: elem['id'])
-        ids = [item['id'] for item in changes]
         update = list()
+        missing = dict() # tokens outside the active scene
         
         now = time.time()
-        with db_session:
-            g = self.parent.db.Game.select(lambda g: g.url == self.url).first()
-            if g is None:
+        with self.lock:
+            scene = self.getScene()
+            if scene is None:
                 self.engine.logging.warning('Player {0} tried to update token data at {1}/{2} by {3}, but the game was not found'.format(player.name, self.parent.url, self.url, player.ip))
                 return;
-            g.timeid = now
+            self.touch(now)
             
-            # iterate provided tokens
-            tokens = self.parent.db.Token.select(lambda t: t.id in ids)
-
-            for i, token in enumerate(tokens):
+            # apply changes to the scene's in-memory table
+            for data in changes:
+                token = scene.get(data['id'])
                 if token is None:
-                    # ignore deleted token
+                    missing[data['id']] = data
                     continue
                 
-                data = changes[i]
-                # fetch changed data (accepting None)
-                posx   = data.get('posx')
-                posy   = data.get('posy')
-                pos    = None if posx is None or posy is None else (posx, posy)
-                zorder = data.get('zorder')
-                size   = data.get('size')
-                rotate = data.get('rotate')
-                flipx  = data.get('flipx')
-                locked = data.get('locked')
-                text   = data.get('text')
-                label  = None if text is None else (text, player.color)
-                if token.update(timeid=now, pos=pos, zorder=zorder, size=size,
-                    rotate=rotate, flipx=flipx, locked=locked, label=label):
-                    # add to broadcast data
-                    tmp = token.to_dict()
-                    tmp['uuid'] = player.uuid
-                    update.append(tmp)
-
-            """
-            for data in changes:
-                t = self.parent.db.Token.select(lambda t: t.id == data['id']).first()
-                if t is None:
-                    # ignore deleted token
-                    continue
-                # fetch changed data (accepting None)
-                posx   = data.get('posx')
-                posy   = data.get('posy')
-                pos    = None if posx is None or posy is None else (posx, posy)
-                zorder = data.get('zorder')
-                size   = data.get('size')
-                rotate = data.get('rotate')
-                flipx  = data.get('flipx')
-                locked = data.get('locked')
-                text   = data.get('text')
-                label  = None if text is None else (text, player.color)
-                t.update(timeid=now, pos=pos, zorder=zorder, size=size,
-                    rotate=rotate, flipx=flipx, locked=locked, label=label)
-            """
+                diff = self.parent.db.Token.getChanges(token, now,
+                    **self.getUpdateArgs(player, data))
+                if len(diff) > 0:
+                    scene.update(token['id'], diff)
+                    # add changed fields to broadcast data
+                    update.append(self.getDelta(token['id'], player, diff))
             
-        # broadcast tokens
-        # self.broadcastTokenUpdate(player, tokens)
-        
-        self.broadcast({
-            'OPID'    : 'UPDATE',
-            'tokens'  : update
-        });
+            if len(update) > 0:
+                self.scheduleFlush()
+        
+        if len(missing) > 0:
+            # @NOTE: tokens of other scenes are not hold in memory
+            ids = list(missing)
+            with db_session:
+                for token in self.parent.db.Token.select(lambda t: t.id in ids):
+                    diff = self.parent.db.Token.getChanges(token.to_dict(), now,
+                        **self.getUpdateArgs(player, missing[token.id]))
+                    if len(diff) > 0:
+                        token.set(**diff)
+                        # add changed fields to broadcast data
+                        update.append(self.getDelta(token.id, player, diff))
+        
+        self.queueUpdate(update)
+
+    @staticmethod
+    def getDelta(token_id, player, diff):
+        """ Create partial token record holding only the changed fields. """
+        delta = {key: diff[key] for key in diff if key != 'timeid'}
+        delta['id']   = token_id
+        delta['uuid'] = player.uuid
+        return delta
+        
+    @staticmethod
+    def getUpdateArgs(player, data):
+        """ Fetch changed data (accepting None) for Token.update. """
+        posx   = data.get('posx')
+        posy   = data.get('posy')
+        text   = data.get('text')
+        return {
+            'pos'    : None if posx is None or posy is None else (posx, posy),
+            'zorder' : data.get('zorder'),
+            'size'   : data.get('size'),
+            'rotate' : data.get('rotate'),
+            'flipx'  : data.get('flipx'),
+            'locked' : data.get('locked'),
+            'label'  : None if text is None else (text, player.color)
+        }
         
     def onCreateToken(self, player, data):
         """ Handle player creating tokens. """
         # fetch token data
         posx = data['posx']
         posy = data['posy']
-        size = data['size']
+        size = int(data['size'])
         urls = data['urls']
         labels = ['' for u in urls]
         color  = ''
@@ -675,6 +1198,7 @@ class GameCache(object):
         now = time.time()
         n = len(urls)
         tokens = list()
+        self.flush()
         with db_session:
             g = self.parent.db.Game.select(lambda g: g.url == self.url).first()
             if g is None:
@@ -687,24 +1211,41 @@ class GameCache(object):
                 self.engine.logging.warning('Player {0} tried creating a tokens at {1}/{2}, but the scene #{4} was not found'.format(player.name, self.parent.url, self.url, g.active))
                 return
             
-            for k, url in enumerate(urls):
-                # create tokens in circle
-                x, y = self.parent.db.Token.getPosByDegree((posx, posy), k, n)
-                t = self.parent.db.Token(scene=s.id, timeid=now, url=url,
-                    size=size, posx=x, posy=y, text=labels[k], color=color)
-                
-                self.parent.db.commit()
-                
+            # create tokens in circle
+            positions = self.parent.db.Token.getPosInCircle((posx, posy), n)
+            first = 0
+            if size == -1:
+                # @NOTE: each background replaces the previous one, so
+                # only the last one is created
+                first = max(0, n - 1)
+            created = list()
+            for k in range(first, n):
+                x, y = positions[k]
+                created.append(self.parent.db.Token(scene=s.id, timeid=now,
+                    url=urls[k], size=size, posx=x, posy=y, text=labels[k],
+                    color=color))
+            
+            if len(created) > 0:
                 # use first token as background if necessary
-                if s.backing is None:
-                    t.size = -1
-
-                # apply as background if size equals -1
-                if t.size == -1:
+                background = None
+                if size == -1:
+                    background = created[-1]
+                elif s.backing is None:
+                    background = created[0]
+                    background.size = -1
+                
+                # apply as background
+                if background is not None:
                     if s.backing is not None:
+                        self.forgetToken(s.backing.id)
                         s.backing.delete()
-                    s.backing = t
-                
+                    s.backing = background
+            
+            # write all tokens at once
+            self.parent.db.commit()
+            
+            for t in created:
+                self.rememberToken(t)
                 tokens.append(t.to_dict())
         
         # broadcast creation
@@ -723,6 +1264,7 @@ class GameCache(object):
         # create tokens
         tokens = list()
         now = time.time()
+        self.flush()
         with db_session: 
             g = self.parent.db.Game.select(lambda g: g.url == self.url).first() 
             if g is None:
@@ -735,19 +1277,30 @@ class GameCache(object):
                 self.engine.logging.warning('Player {0} tried clone tokens at {1}/{2} by {4}, but the scene #{3} was not found'.format(player.name, self.parent.url, self.url, g.active, player.ip))
                 return;
             
-            # iterate provided tokens
+            # fetch all provided tokens at once
+            found = dict()
+            for t in self.parent.db.Token.select(lambda t: t.id in ids):
+                found[t.id] = t
+            
+            positions = self.parent.db.Token.getPosInCircle((posx, posy), len(ids))
+            created   = list()
             for k, tid in enumerate(ids):
-                t = self.parent.db.Token.select(lambda t: t.id == tid).first()
+                t = found.get(tid)
                 if t is None:
                     # ignore, t was deleted in the meantime
                     continue
                 # clone token
-                pos = self.parent.db.Token.getPosByDegree((posx, posy), k, len(ids))
-                t = self.parent.db.Token(scene=s, url=t.url, posx=pos[0], posy=pos[1],
-                    zorder=t.zorder, size=t.size, rotate=t.rotate, flipx=t.flipx,
-                    timeid=now, text=t.text, color=t.color)
-                
-                self.parent.db.commit()
+                pos = positions[k]
+                created.append(self.parent.db.Token(scene=s, url=t.url,
+                    posx=pos[0], posy=pos[1], zorder=t.zorder, size=t.size,
+                    rotate=t.rotate, flipx=t.flipx, timeid=now, text=t.text,
+                    color=t.color))
+            
+            # write all clones at once
+            self.parent.db.commit()
+            
+            for t in created:
+                self.rememberToken(t)
                 tokens.append(t.to_dict())
         
         # broadcast creation
@@ -761,11 +1314,18 @@ class GameCache(object):
         # delete tokens
         tokens = data['tokens']
         ids    = list()
+        self.flush()
         with db_session:
+            # fetch all provided tokens at once
+            found = dict()
+            for t in self.parent.db.Token.select(lambda t: t.id in tokens):
+                found[t.id] = t
+            
             for tid in tokens:
-                t = self.parent.db.Token.select(lambda t: t.id == tid).first()
+                t = found.pop(tid, None)
                 if t is not None and not t.locked:
                     ids.append(tid)
+                    self.forgetToken(tid)
                     t.delete()
 
         if len(ids) > 0:
@@ -781,7 +1341,7 @@ class GameCache(object):
         data['color'] = player.color
         data['uuid']  = player.uuid
         # broadcast beacon
-        self.broadcast(data)
+        self.broadcastEphemeral(data, player.uuid)
 
     def onMusic(self, player, data):
         """ Handle player uploaded music. """
@@ -813,6 +1373,7 @@ class GameCache(object):
             g.timeid = now
             
             # create new, active scene at the end of the scene list
+            self.dropScene()
             scene = self.parent.db.Scene(game=g)
             self.parent.db.commit()
             g.active = scene.id
@@ -889,6 +1450,7 @@ class GameCache(object):
                 self.engine.logging.warning('GM tried to activate a scene but scene not found {0}'.format(player.ip))
                 return
             # active scene
+            self.dropScene()
             g.active = scene_id
             self.parent.db.commit()
             # broadcast scene switch
@@ -916,20 +1478,19 @@ class GameCache(object):
                 self.engine.logging.warning('GM tried to clone a scene but scene not found {0}'.format(player.ip))
                 return
             # clone scene and its tokens (except background)
-            clone = self.parent.db.Scene(game=g)
-            for t in s.tokens:
-                if t.size != -1:
-                   self.parent.db.Token(
-                        scene=clone, url=t.url, posx=t.posx, posy=t.posy,
-                        zorder=t.zorder, size=t.size, rotate=t.rotate,
-                        flipx=t.flipx, locked=t.locked, text=t.text,
-                        color=t.color
-                    )
-            self.parent.db.commit()
+            self.dropScene()
+            clone  = self.parent.db.Scene(game=g)
+            tokens = s.cloneTokens(clone, now)
             g.active = clone.id
             g.order.append(clone.id)
-            # broadcast scene switch
-            self.broadcastSceneSwitch(g)
+            self.parent.db.commit()
+            
+            # the clone's table is already known
+            with self.lock:
+                self.scene = SceneCache(clone.id, None, tokens)
+        
+        # broadcast scene switch
+        self.broadcastSceneSwitch(g)
         
     def onDeleteScene(self, player, data):
         """ GM: Delete a given scene. """
@@ -952,6 +1513,7 @@ class GameCache(object):
             if s is None: 
                 self.engine.logging.warning('GM tried to delete a scene but scene not found {0}'.format(player.ip))
                 return
+            self.dropScene()
             s.preDelete()
             s.delete()
             self.parent.db.commit()
@@ -994,23 +1556,63 @@ class GmCache(object):
         self.lock   = lock.RLock()
         self.url    = gm.url
         self.games  = dict()
-        self.db     = None # needs connect_db to be run (but outside a db_session)
+        self.urls   = None # urls of all GM's games, queried on demand (see hasGame)
+        self._db    = None # opened on demand (see db)
+        self.db_lock = lock.RLock() # only used while creating the database
         
         #self.engine.logging.info('GmCache {0} with {0} created'.format(self.url, self.db_path))
         
-    def connect_db(self):
-        # connect to GM's database 
-        self.db = createGmDatabase(self.engine, str(self.db_path))
+    @property
+    def db(self):
+        """ GM's database, which is opened on first access and kept in
+        the engine's pool of open databases. """
+        db = self._db
+        if db is None:
+            # @NOTE: a database cannot be created from within a db_session,
+            # so this is done by another greenlet, which must not wait for
+            # any lock that the caller may hold
+            db = gevent.spawn(self.connect_db).get()
+        return db
         
-        # add all existing games to the cache
-        with db_session:
-            for game in self.db.Game.select():
-                self.insert(game)
-                # reorder scenes by ID if necessary
-                if game.order == list():
-                    game.reorderScenes()
+    def connect_db(self):
+        """ Connect to GM's database and add it to the engine's pool of
+        open databases. Returns the database. """
+        # @NOTE: games are loaded on demand (see getFromUrl)
+        with self.db_lock:
+            db = self._db
+            if db is None:
+                db = createGmDatabase(self.engine, str(self.db_path))
+                self._db = db
+                opened = True
+            else:
+                opened = False
+        if opened:
+            self.engine.cache.useDatabase(self)
         
         #self.engine.logging.info('GmCache {0} with {0} loaded'.format(self.url, self.db_path))
+        return db
+        
+    def close_db(self):
+        """ Unload all games, close the connections to the GM's database and
+        drop its mapping.
+        """
+        with self.lock:
+            # @NOTE: this writes all pending changes
+            for url in list(self.games):
+                self.evict(url)
+            # @NOTE: a pony mapping is bound to a single database file, so
+            # it cannot be shared between GMs; it is recreated on demand
+            # (which takes a few ms), so memory scales with open databases
+            with self.db_lock:
+                db, self._db = self._db, None
+            if db is not None:
+                closeConnections(db)
+        self.engine.cache.releaseDatabase(self)
+        
+    def hasPlayers(self):
+        """ Return whether any of the GM's loaded games has players. """
+        # @NOTE: no lock required, because this does not yield
+        return any(len(game_cache.players) > 0 for game_cache in self.games.values())
         
     # --- cache implementation ----------------------------------------
         
@@ -1020,22 +1622,96 @@ class GmCache(object):
         with self.lock:
             if url in self.games:
                 raise KeyError(url)
-            self.games[url] = GameCache(self.engine, self, game)
-            return self.games[url]
+            game_cache = GameCache(self.engine, self, game)
+            self.games[url] = game_cache
+            if self.urls is not None:
+                self.urls.add(url)
+        self.engine.cache.scheduleSweep()
+        return game_cache
+        
+    def load(self, url):
+        """ Insert game from the GM's database into the cache. Returns None
+        if there is no such game. """
+        with self.lock:
+            with db_session:
+                game = self.db.Game.select(lambda g: g.url == url).first()
+                if game is None:
+                    return None
+                # reorder scenes by ID if necessary
+                if game.order == list():
+                    game.reorderScenes()
+                return self.insert(game)
         
     def get(self, game):
         return self.getFromUrl(game.url)
         
     def getFromUrl(self, url):
         with self.lock:
-            try:
-                return self.games[url]
-            except KeyError:
-                return None
+            game_cache = self.games.get(url)
+            if game_cache is None:
+                game_cache = self.load(url)
+            if game_cache is not None:
+                game_cache.last_access = time.time()
+            return game_cache
         
     def remove(self, game):
         with self.lock:
             del self.games[game.url]
+        self.forget(game.url)
+        
+    def forget(self, url):
+        """ Drop all data kept for the given game besides its cache. """
+        game_url = '{0}/{1}'.format(self.url, url)
+        self.engine.checksums.pop(game_url, None)
+        self.engine.assets.pop(game_url, None)
+        self.engine.metrics.forgetGame(game_url)
+        
+    def evict(self, url):
+        """ Write and unload game from the cache (if loaded). """
+        with self.lock:
+            game_cache = self.games.pop(url, None)
+        if game_cache is not None:
+            game_cache.cleanup()
+            # write pending checksums before dropping them
+            index = self.engine.checksums.get('{0}/{1}'.format(self.url, url))
+            if index is not None:
+                index.save(self.engine.paths.getMd5Path(self.url, url))
+            self.forget(url)
+        
+    def drop(self, url):
+        """ Unload game and forget its url, e.g. because it was deleted. """
+        self.evict(url)
+        with self.lock:
+            if self.urls is not None:
+                self.urls.discard(url)
+        
+    def hasGame(self, url):
+        """ Return whether the GM has a game with the given url. The urls
+        are queried from the database once and kept up to date by insert
+        and drop. """
+        with self.lock:
+            if self.urls is None:
+                with db_session:
+                    self.urls = set(g.url for g in self.db.Game.select())
+            return url in self.urls
+        
+    def evictIdle(self, now):
+        """ Unload all games without players, which were not accessed
+        recently. Returns the number of games which are still loaded. """
+        timeout = self.engine.storage['idle_timeout']
+        with self.lock:
+            idle = [url for url, game_cache in self.games.items()
+                if len(game_cache.players) == 0 and now - game_cache.last_access > timeout]
+            for url in idle:
+                self.evict(url)
+            return len(self.games)
+
+    def flush(self):
+        """ Write pending changes of all games to the GM's database. """
+        with self.lock:
+            games = list(self.games.values())
+        for game_cache in games:
+            game_cache.flush()
 
 
 # ---------------------------------------------------------------------
@@ -1044,22 +1720,22 @@ class EngineCache(object):
     """ Thread-safe gms dict using gm-url as key. """
     
     def __init__(self, engine):
-        self.engine = engine
-        self.lock   = lock.RLock()
-        self.gms    = dict()
+        self.engine  = engine
+        self.lock    = lock.RLock()
+        self.gms     = dict()
+        self.sweeper = None # greenlet for evicting idle games
+        
+        # GMs with open databases in LRU order: url => GmCache
+        self.databases = collections.OrderedDict()
         
         # add all GMs from database
+        # @NOTE: their databases are opened on demand (see GmCache.db)
         with db_session:
             gms = self.engine.main_db.GM.select()
             for i, gm in enumerate(gms):
                 self.engine.logging.info('Creating GM {0}/{1} #{2}'.format(i+1, len(gms), gm.url))
                 self.insert(gm)
         
-        # initialize GMs databases
-        for i, gm in enumerate(self.gms):
-            self.gms[gm].connect_db()
-            self.engine.logging.info('Loaded GM {0}/{1} #{2}'.format(i+1, len(self.gms), gm))
-        
         self.engine.logging.info('EngineCache created')
         
     # --- cache implementation ----------------------------------------
@@ -1069,8 +1745,12 @@ class EngineCache(object):
         with self.lock:
             # @NOTE: existing GmCache is replaced
             # (e.g. relogin by user)
-            self.gms[url] = GmCache(self.engine, gm)
-            return self.gms[url]
+            old = self.gms.get(url)
+            gm_cache = GmCache(self.engine, gm)
+            self.gms[url] = gm_cache
+        if old is not None:
+            old.close_db()
+        return gm_cache
         
     def get(self, gm):
         if gm:
@@ -1078,6 +1758,9 @@ class EngineCache(object):
         
     def getFromUrl(self, url):
         with self.lock:
+            # mark GM's database as recently used (if open)
+            if url in self.databases:
+                self.databases.move_to_end(url)
             try:
                 return self.gms[url]
             except KeyError:
@@ -1085,7 +1768,72 @@ class EngineCache(object):
         
     def remove(self, gm):
         with self.lock:
-            del self.gms[gm.url]
+            gm_cache = self.gms.pop(gm.url)
+        gm_cache.close_db()
+
+    def flush(self):
+        """ Write pending changes of all games to the databases. """
+        with self.lock:
+            gms = list(self.gms.values())
+        for gm_cache in gms:
+            gm_cache.flush()
+        
+    def useDatabase(self, gm_cache):
+        """ Add GM's opened database to the pool. If too many databases are
+        open, the least recently used ones of GMs without players are
+        closed. """
+        idle = list()
+        with self.lock:
+            if gm_cache._db is None:
+                # closed in the meantime
+                return
+            self.databases[gm_cache.url] = gm_cache
+            self.databases.move_to_end(gm_cache.url)
+            
+            excess = len(self.databases) - self.engine.storage['max_databases']
+            for url, other in self.databases.items():
+                if len(idle) >= excess:
+                    break
+                if other is gm_cache or other.hasPlayers():
+                    continue
+                idle.append(other)
+            for other in idle:
+                del self.databases[other.url]
+        
+        # @NOTE: closing writes pending changes, so this is done without
+        # holding the engine's lock
+        for other in idle:
+            with other.lock:
+                if other.hasPlayers():
+                    # a player joined in the meantime
+                    with self.lock:
+                        self.databases.setdefault(other.url, other)
+                    continue
+                other.close_db()
+        
+    def releaseDatabase(self, gm_cache):
+        """ Remove GM's closed database from the pool. """
+        with self.lock:
+            if gm_cache._db is None and self.databases.get(gm_cache.url) is gm_cache:
+                del self.databases[gm_cache.url]
+        
+    def scheduleSweep(self):
+        """ Evict idle games later (if not already scheduled). """
+        with self.lock:
+            if self.sweeper is None:
+                self.sweeper = gevent.spawn_later(self.engine.storage['idle_timeout'], self.sweep)
+        
+    def sweep(self):
+        """ Evict idle games of all GMs. """
+        with self.lock:
+            self.sweeper = None
+            gms = list(self.gms.values())
+        now = time.time()
+        loaded = 0
+        for gm_cache in gms:
+            loaded += gm_cache.evictIdle(now)
+        if loaded > 0:
+            self.scheduleSweep()
     
     # --- websocket implementation ------------------------------------
     
@@ -1095,7 +1843,7 @@ class EngineCache(object):
         raw = socket.receive()
         if raw is None:
             return
-        data = json.loads(raw)
+        data = codec.loads(raw)
         name     = data['name']
         gm_url   = data['gm_url']
         game_url = data['game_url']
@@ -1116,6 +1864,7 @@ class EngineCache(object):
         
         #with player_cache.lock: # note: atm deadlocking
         player_cache.socket = socket
+        player_cache.codec  = codec.negotiate(data.get('codecs'), self.engine.websocket['codecs'])
         game_cache.login(player_cache)
         
         # handle incomming data
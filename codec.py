@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import json
+
+# optional fast JSON libraries, the stdlib is used as fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+__author__ = 'Christian Glöckner'
+__licence__ = 'MIT'
+
+
+# --- JSON backend ----------------------------------------------------
+
+if orjson is not None:
+    backend = 'orjson'
+
+    def dumps(data, indent=False):
+        """ Return JSON string of data. """
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        # @NOTE: orjson yields bytes, but websocket text frames need str
+        return orjson.dumps(data, option=option).decode('utf-8')
+
+    def loads(raw):
+        """ Return data from JSON string or bytes. """
+        return orjson.loads(raw)
+
+elif ujson is not None:
+    backend = 'ujson'
+
+    def dumps(data, indent=False):
+        """ Return JSON string of data. """
+        return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False,
+            indent=4 if indent else 0)
+
+    def loads(raw):
+        """ Return data from JSON string or bytes. """
+        return ujson.loads(raw)
+
+else:
+    backend = 'json'
+
+    def dumps(data, indent=False):
+        """ Return JSON string of data. """
+        if indent:
+            return json.dumps(data, indent=4)
+        return json.dumps(data, separators=(',', ':'))
+
+    def loads(raw):
+        """ Return data from JSON string or bytes. """
+        return json.loads(raw)
+
+# @NOTE: all backends raise a subclass of ValueError on invalid input
+DecodeError = ValueError
+
+
+# positional layout of token records inside compact frames
+TOKEN_FIELDS = ['id', 'uuid', 'posx', 'posy', 'zorder', 'size', 'rotate',
+    'flipx', 'locked', 'text', 'color', 'url', 'scene', 'timeid', 'back']
+
+TOKEN_INDEX = {key: i for i, key in enumerate(TOKEN_FIELDS)}
+
+# positional layout of compact frames per OPID (server to client)
+OUTBOUND_FIELDS = {
+    'PING'    : [],
+    'UPDATE'  : ['tokens'],
+    'CREATE'  : ['tokens'],
+    'REFRESH' : ['tokens', 'background']
+}
+
+# positional layout of compact frames per OPID (client to server)
+INBOUND_FIELDS = {
+    'PING'    : [],
+    'UPDATE'  : ['changes']
+}
+
+# frame fields which hold lists of token records
+RECORD_FIELDS = ['tokens', 'changes']
+
+
+# ---------------------------------------------------------------------
+
+class JsonCodec(object):
+    """ Default websocket encoding: one JSON object per frame.
+    """
+    name = 'json'
+
+    def encode(self, data):
+        """ Return frame for the given JSON object. """
+        return dumps(data)
+
+    def decode(self, raw):
+        """ Return JSON object from the given frame. """
+        return loads(raw)
+
+
+# ---------------------------------------------------------------------
+
+class CompactCodec(JsonCodec):
+    """ Compact websocket encoding: Frames of well-known OPIDs are sent
+    as JSON arrays, starting with the OPID and followed by the values in
+    the order given by the OPID's layout. Token records are arrays in
+    TOKEN_FIELDS order, with null for missing fields. Other frames are
+    sent as plain JSON objects.
+    """
+    name = 'compact'
+
+    # record's keys (in order) => TOKEN_FIELDS up to its last key, or None
+    # if it holds unknown fields
+    # @NOTE: records are built by the server, so there are only few layouts
+    layouts = dict()
+
+    @staticmethod
+    def getLayout(keys):
+        """ Return the fields needed to encode records with the given keys
+        (see layouts). """
+        try:
+            last = max((TOKEN_INDEX[key] for key in keys), default=-1)
+        except KeyError:
+            fields = None
+        else:
+            fields = tuple(TOKEN_FIELDS[:last + 1])
+        CompactCodec.layouts[keys] = fields
+        return fields
+
+    @staticmethod
+    def encodeRecord(record):
+        """ Return token record as array or None if it holds unknown
+        fields. """
+        keys = tuple(record)
+        try:
+            fields = CompactCodec.layouts[keys]
+        except KeyError:
+            fields = CompactCodec.getLayout(keys)
+        if fields is None:
+            return None
+        values = list(map(record.get, fields))
+        # drop missing fields at the end
+        while len(values) > 0 and values[-1] is None:
+            values.pop()
+        return values
+
+    @staticmethod
+    def decodeRecord(values):
+        """ Return token record from the given array. """
+        return {key: value for key, value in zip(TOKEN_FIELDS, values) if value is not None}
+
+    def encode(self, data):
+        fields = OUTBOUND_FIELDS.get(data.get('OPID')) if isinstance(data, dict) else None
+        if fields is None or len(data) > len(fields) + 1:
+            return dumps(data)
+
+        frame = [data['OPID']]
+        for key in fields:
+            if key not in data:
+                return dumps(data)
+            value = data[key]
+            if key in RECORD_FIELDS:
+                value = [CompactCodec.encodeRecord(r) for r in value]
+                if None in value:
+                    return dumps(data)
+            frame.append(value)
+        return dumps(frame)
+
+    def decode(self, raw):
+        data = loads(raw)
+        if not isinstance(data, list):
+            return data
+
+        opid   = data[0]
+        fields = INBOUND_FIELDS[opid]
+        result = {'OPID': opid}
+        for key, value in zip(fields, data[1:]):
+            if key in RECORD_FIELDS:
+                value = [CompactCodec.decodeRecord(r) for r in value]
+            result[key] = value
+        return result
+
+
+# ---------------------------------------------------------------------
+
+codecs = {
+    JsonCodec.name    : JsonCodec(),
+    CompactCodec.name : CompactCodec()
+}
+
+def negotiate(names, preferred=None):
+    """ Return the first supported codec out of the given names. If the
+    server's preferred names are given, their order is used instead. JSON
+    is used as fallback. """
+    if isinstance(names, list):
+        for name in names if preferred is None else preferred:
+            if name in codecs and name in names:
+                return codecs[name]
+    return codecs[JsonCodec.name]
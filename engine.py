@@ -17,6 +17,8 @@ from cache import EngineCache
 
 from buildnumber import BuildNumber
 
+import codec
+
 import utils 
 
 
@@ -46,6 +48,7 @@ class Engine(object):
         
         # setup per-game stuff
         self.checksums = dict()
+        self.assets    = dict() # game url => utils.AssetIndex
         self.locks     = dict()
         
         # webserver stuff
@@ -77,6 +80,64 @@ class Engine(object):
         }
         self.playercolors = ['#FF0000', '#00FF00', '#0000FF', '#FFFF00', '#FF00FF']
         
+        # in-memory game state
+        self.storage = {
+            "flush_delay"  : 1.0, # seconds until changed tokens are written to disk
+            "idle_timeout" : 600, # seconds until a game without players is unloaded
+            "max_databases" : 128 # number of GM databases kept open
+        }
+        
+        # outbound websocket traffic
+        self.websocket = {
+            "queue_size" : 256,         # max. number of pending frames per player
+            "overflow"   : "disconnect", # 'disconnect' or 'drop' frames if queue is full
+            "tick_rate"  : 25,           # token updates are broadcast per tick (in Hz), 0 = immediately
+            "ephemeral_size" : 32,       # max. number of pending beacons, selections etc. per player
+            # websocket encodings by preference (see codec.negotiate)
+            # @NOTE: 'compact' frames are about half the size, but take
+            # longer to encode than JSON frames
+            "codecs"     : ["json", "compact"]
+        }
+        
+        # incoming websocket actions per player: OPID => [rate per second, burst]
+        # @NOTE: exceeding PING, SELECT, RANGE and BEACON actions are dropped,
+        # others are deferred; OPIDs without limit (or rate 0) are not limited
+        self.ratelimit = {
+            "PING"        : [2, 10],
+            "ROLL"        : [5, 20],
+            "SELECT"      : [20, 50],
+            "RANGE"       : [20, 50],
+            "ORDER"       : [5, 20],
+            "UPDATE"      : [30, 100],
+            "CREATE"      : [5, 20],
+            "CLONE"       : [5, 20],
+            "DELETE"      : [5, 20],
+            "BEACON"      : [10, 30],
+            "MUSIC"       : [2, 10],
+            "GM-CREATE"   : [2, 10],
+            "GM-MOVE"     : [5, 20],
+            "GM-ACTIVATE" : [2, 10],
+            "GM-CLONE"    : [2, 10],
+            "GM-DELETE"   : [2, 10]
+        }
+        
+        # IP to country resolution (see utils.GeoIpApi)
+        self.geoip = {
+            "cache_size" : 1024,  # number of cached ips
+            "remote"     : False  # query ips missing in the table from ip-api.com in the background
+        }
+        
+        # checksums of images (see utils.HashingApi)
+        self.hashing = {
+            "threads" : 4 # number of threads used for hashing files
+        }
+        
+        # downscaled scene backgrounds (see utils.ThumbnailApi)
+        self.thumbnails = {
+            "width"   : 256, # in pixels
+            "threads" : 2    # number of threads used for creating thumbnails
+        }
+        
         self.local_gm       = False
         self.localhost      = False
         self.title          = appname
@@ -90,6 +151,7 @@ class Engine(object):
         self.notify_api     = None   # notify api instance
         
         self.cache         = None   # later engine cache
+        self.metrics       = utils.MetricsApi() # websocket latency histograms
 
         # handle commandline arguments
         self.debug     = '--debug' in argv
@@ -97,6 +159,7 @@ class Engine(object):
         self.local_gm  = '--local-gm' in argv
         self.localhost = '--localhost' in argv
         self.no_logs   = '--no-logs' in argv
+        self.sync_logs = '--sync-logs' in argv
         
         if self.localhost:
             assert(not self.local_gm)
@@ -110,7 +173,8 @@ class Engine(object):
             logins_file  = self.paths.getLogPath('logins'),
             auth_file    = self.paths.getLogPath('auth'),
             stdout_only  = self.no_logs,
-            loglevel     = self.log_level
+            loglevel     = self.log_level,
+            queued       = not self.sync_logs
         )
         
         self.logging.info('Started Modes: debug={0}, quiet={1}, local_gm={2} localhost={3}'.format(self.debug, self.quiet, self.local_gm, self.localhost))
@@ -131,7 +195,13 @@ class Engine(object):
                 'expire'       : self.expire,
                 'hosting'      : self.hosting,
                 'login'        : self.login,
-                'notify'       : self.notify
+                'notify'       : self.notify,
+                'storage'      : self.storage,
+                'websocket'    : self.websocket,
+                'geoip'        : self.geoip,
+                'hashing'      : self.hashing,
+                'thumbnails'   : self.thumbnails,
+                'ratelimit'    : self.ratelimit
             }
             with open(settings_path, 'w') as h:
                 json.dump(settings, h, indent=4)
@@ -149,8 +219,31 @@ class Engine(object):
                 self.hosting      = settings['hosting']
                 self.login        = settings['login']
                 self.notify       = settings['notify']
+                # @NOTE: optional sections fall back to their defaults
+                self.storage.update(settings.get('storage', dict()))
+                self.websocket.update(settings.get('websocket', dict()))
+                self.geoip.update(settings.get('geoip', dict()))
+                self.hashing.update(settings.get('hashing', dict()))
+                self.thumbnails.update(settings.get('thumbnails', dict()))
+                self.ratelimit.update(settings.get('ratelimit', dict()))
             self.logging.info('Settings loaded')
+        
+        # @NOTE: a burst below a single action would defer actions forever
+        for opid, limit in self.ratelimit.items():
+            rate, burst = limit
+            if rate < 0 or (rate > 0 and burst < 1):
+                raise ValueError('Invalid ratelimit for {0}: {1} (expected rate > 0 and burst >= 1, or rate 0 for no limit)'.format(opid, limit))
 
+        # load offline ip to country table
+        self.geoip_api = utils.GeoIpApi(self.paths.getGeoIpPath(),
+            logging    = self.logging,
+            cache_size = self.geoip['cache_size'],
+            remote     = self.geoip['remote'])
+        
+        # hash files without blocking the hub
+        self.hashing_api = utils.HashingApi(threads=self.hashing['threads'])
+        self.thumbnail_api = utils.ThumbnailApi(width=self.thumbnails['width'], threads=self.thumbnails['threads'])
+        
         # add this server to the shards list
         self.shards.append(self.getUrl())
         
@@ -158,6 +251,10 @@ class Engine(object):
         self.constants = utils.ConstantExport()
         self.constants(self)
         
+        # lookup (and precompress) static files once
+        # @NOTE: files in the preference directory shadow the shipped ones
+        self.static_files = utils.StaticIndex([self.paths.getStaticPath(), pathlib.Path('static')])
+        
         # show argv help
         if '--help' in argv:
             print('Commandline args:')
@@ -165,11 +262,13 @@ class Engine(object):
             print('    --quiet       Starts in quiet mode.')
             print('    --local-gm    Starts in local-GM-mode.')
             print('    --localhost   Starts in localhost mode.')
+            print('    --sync-logs   Writes log records immediately.')
             print('')
             print('Debug Mode:     Enables debug level logging.')
             print('Quiet Mode:     Disables verbose outputs.')
             print('Local-GM Mode:  Replaces `localhost` in all created links by the public ip.')
             print('Localhost Mode: Restricts server for being used via localhost only. CANNOT BE USED WITH --local-gm')
+            print('Sync Logs:      Disables batched writing of log records in the background.')
             print('')
             print('See {0} for custom settings.'.format(settings_path))
             sys.exit(0)
@@ -214,6 +313,10 @@ class Engine(object):
         # setup db_session to all routes
         self.app.install(db_session)
         
+        # use fast JSON codec for all routes returning dicts
+        self.app.uninstall(bottle.JSONPlugin)
+        self.app.install(bottle.JSONPlugin(json_dumps=codec.dumps))
+        
         # setup error catching
         if self.debug:
             # let bottle catch exceptions
@@ -252,17 +355,22 @@ class Engine(object):
         if self.notify_api is not None:
             self.notify_api.notifyStart()
         
-        bottle.run(
-            host       = self.listen,
-            port       = self.hosting['port'],
-            debug      = self.debug,
-            quiet      = self.quiet,
-            server     = VttServer,
-            # VttServer-specific
-            unixsocket = self.hosting['socket'],
-            # SSL-specific
-            **ssl_args
-        )
+        try:
+            bottle.run(
+                host       = self.listen,
+                port       = self.hosting['port'],
+                debug      = self.debug,
+                quiet      = self.quiet,
+                server     = VttServer,
+                # VttServer-specific
+                unixsocket = self.hosting['socket'],
+                # SSL-specific
+                **ssl_args
+            )
+        finally:
+            # write pending game state to the databases
+            self.cache.flush()
+            self.logging.flush()
         
     def getDomain(self):
         if self.localhost:
@@ -314,16 +422,19 @@ class Engine(object):
     def getClientAgent(self, request):
         return request.environ.get('HTTP_USER_AGENT')
         
-    def getCountryFromIp(self, ip, timeout=3):
-        result = '?' # fallback case
-        try:
-            html = requests.get('http://ip-api.com/json/{0}'.format(ip), timeout=timeout)
-            d = json.loads(html.text)
-            if 'countryCode' in d:
-                result = d['countryCode'].lower()
-        except requests.exceptions.ReadTimeout as e:
-            self.logging.warning('Cannot query location of IP {0}'.format(ip))
-        return result
+    def getAssets(self, gm_url, game_url):
+        """ Return the game's asset index, which is loaded on demand. """
+        url = '{0}/{1}'.format(gm_url, game_url)
+        index = self.assets.get(url)
+        if index is None:
+            index = utils.AssetIndex()
+            index.scan(self.paths.getGamePath(gm_url, game_url))
+            self.assets[url] = index
+        return index
+        
+    def getCountryFromIp(self, ip):
+        # @NOTE: never waits for the network
+        return self.geoip_api(ip)
         
     def getPublicIp(self):
         try:
@@ -343,12 +454,13 @@ class Engine(object):
                 self.num_players = num_players
         
         records = list()
+        self.logging.flush()
         with open(self.paths.getLogPath('logins'), 'r') as h:
             content = h.read()
             for line in content.split('\n'):
                 if line == '':
                     continue
-                args = json.loads(line)
+                args = codec.loads(line)
                 records.append(LoginRecord(*args))
         return records
 
@@ -366,8 +478,9 @@ class Engine(object):
     def getSize(self, file_upload):
         """ Determine size of a file upload.
         """
+        # @NOTE: seeking avoids reading the entire file
         offset = file_upload.file.tell()
-        size = len(file_upload.file.read())
+        size = file_upload.file.seek(0, os.SEEK_END) - offset
         file_upload.file.seek(offset)
         return size
         
@@ -381,6 +494,9 @@ class Engine(object):
         """
         now = time.time()
         
+        # write pending game state before touching the databases
+        self.cache.flush()
+        
         with db_session:
             for gm in self.main_db.GM.select():
                 gm_cache = self.cache.get(gm)
@@ -417,6 +533,7 @@ class Engine(object):
                 gms.append(gm.to_dict())
         
         # dump each GM's games
+        self.cache.flush()
         for gm in gms:         
             gm_cache = self.cache.getFromUrl(gm['url'])
             gm['games'] = dict()
@@ -30,9 +30,86 @@ let my_uuid = ''
 let my_name = ''
 let my_color = ''
 
+// --- compact encoding (see codec.py) ----------------------------------------
+
+const socket_codecs = ['compact', 'json'] // supported encodings, by preference
+let socket_codec = 'json' // encoding negotiated with the server
+
+// positional layout of token records inside compact frames
+const token_fields = ['id', 'uuid', 'posx', 'posy', 'zorder', 'size', 'rotate', 'flipx', 'locked', 'text', 'color', 'url', 'scene', 'timeid', 'back']
+
+// positional layout of compact frames per OPID (server to client)
+const inbound_fields = {
+  PING: [],
+  UPDATE: ['tokens'],
+  CREATE: ['tokens'],
+  REFRESH: ['tokens', 'background'],
+}
+
+// positional layout of compact frames per OPID (client to server)
+const outbound_fields = {
+  PING: [],
+  UPDATE: ['changes'],
+}
+
+// frame fields which hold lists of token records
+const record_fields = ['tokens', 'changes']
+
+/// Expand compact frame into a JSON object
+function expandFrame(frame) {
+  const data = { OPID: frame[0] }
+  $.each(inbound_fields[frame[0]], function (i, key) {
+    let value = frame[i + 1]
+    if (record_fields.includes(key)) {
+      value = value.map(function (values) {
+        const record = {}
+        $.each(values, function (j, v) {
+          if (v !== null) {
+            record[token_fields[j]] = v
+          }
+        })
+        return record
+      })
+    }
+    data[key] = value
+  })
+  return data
+}
+
+/// Pack JSON object into a compact frame (or return it as it is)
+function packFrame(data) {
+  const fields = outbound_fields[data.OPID]
+  if (fields === undefined || Object.keys(data).length > fields.length + 1) {
+    return data
+  }
+  const frame = [data.OPID]
+  for (const key of fields) {
+    if (!(key in data)) {
+      return data
+    }
+    let value = data[key]
+    if (record_fields.includes(key)) {
+      value = value.map(function (record) {
+        const values = token_fields.map(function (field) {
+          return field in record ? record[field] : null
+        })
+        while (values.length > 0 && values[values.length - 1] === null) {
+          values.pop()
+        }
+        return values
+      })
+    }
+    frame.push(value)
+  }
+  return frame
+}
+
 /// Handle function for interaction via socket
 function onSocketMessage(event) {
-  const data = JSON.parse(event.data)
+  let data = JSON.parse(event.data)
+  if (Array.isArray(data)) {
+    data = expandFrame(data)
+  }
   const opid = data.OPID
 
   if (!quiet && opid !== 'PING') {
@@ -85,6 +162,10 @@ function onSocketMessage(event) {
 }
 
 function onAccept(data) {
+  if (data.codec !== undefined) {
+    socket_codec = data.codec
+  }
+
   // show all players
   $.each(data.players, function (i, details) {
     const p = new Player(
@@ -122,10 +203,37 @@ function onAccept(data) {
   onRefresh(data)
 }
 
+/// Merge partial token record (id plus changed fields) with known token data
+function mergeToken(delta) {
+  const known = tokens[delta.id]
+  if (known === null || known === undefined) {
+    return null
+  }
+  const token = {
+    id: known.id,
+    url: known.url,
+    posx: known.newx,
+    posy: known.newy,
+    zorder: known.zorder,
+    size: known.size,
+    rotate: known.rotate,
+    flipx: known.flipx,
+    locked: known.locked,
+    text: known.text,
+    color: known.color
+  }
+  return Object.assign(token, delta)
+}
+
 function onUpdate(data) {
   let is_primary = false
 
-  $.each(data.tokens, function (index, token) {
+  $.each(data.tokens, function (index, delta) {
+    // server only sends changed fields
+    const token = mergeToken(delta)
+    if (token === null) {
+      return
+    }
     updateToken(token)
 
     if (token.id === primary_id) {
@@ -274,7 +382,7 @@ function onRefresh(data) {
 
 /// Send data JSONified to server via the websocket
 function writeSocket(data) {
-  const raw = JSON.stringify(data)
+  const raw = JSON.stringify(socket_codec === 'compact' ? packFrame(data) : data)
   if (!quiet && data['OPID'] !== 'PING') {
     console.info('SEND', data)
   }
@@ -485,6 +593,7 @@ function start(gmname, url, playername, color) {
     name: playername,
     gm_url: gmname,
     game_url: url,
+    codecs: socket_codecs,
   })
 
   my_name = playername
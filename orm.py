@@ -7,12 +7,16 @@ Copyright (c) 2020-2021 Christian Glöckner
 License: MIT (see LICENSE for details)
 """
 
-import os, pathlib, time, uuid, tempfile, shutil, zipfile, json, math
+import os, pathlib, time, uuid, tempfile, shutil, zipfile, math, weakref
 
+import gevent
 from gevent import lock
 from PIL import Image, UnidentifiedImageError
 
 from pony.orm import *
+from pony.orm.dbproviders.sqlite import SQLitePool
+
+import codec, utils
 
 
 __author__ = 'Christian Glöckner'
@@ -26,6 +30,73 @@ MAX_SCENE_HEIGHT = 567
 MIN_TOKEN_SIZE   = 1
 MAX_TOKEN_SIZE   = 1000
 
+def isImage(path):
+    """ Return whether the file is a supported image. Only its header is
+    parsed. """
+    try:
+        with Image.open(path):
+            return True
+    except UnidentifiedImageError:
+        return False
+
+
+class ConnectionTracker(object):
+    """ Connections of all greenlets to a single database. """
+    
+    def __init__(self):
+        self.open = weakref.WeakKeyDictionary() # greenlet => connection
+        self.busy = weakref.WeakSet() # greenlets inside a transaction
+
+
+class GreenletPool(SQLitePool):
+    """ SQLite connection pool which keeps track of the connections of all
+    greenlets, so they can be closed at once (see closeConnections).
+    """
+    
+    def __init__(self, tracker, *args, **kwargs):
+        # @NOTE: called separately in each greenlet with the same arguments
+        super().__init__(*args, **kwargs)
+        self.tracker = tracker
+        
+    def connect(self):
+        current = gevent.getcurrent()
+        if self.con is not None and self.tracker.open.get(current) is not self.con:
+            # connection was closed by closeConnections
+            self.con = None
+        con, is_new_connection = super().connect()
+        self.tracker.open[current] = con
+        self.tracker.busy.add(current)
+        return con, is_new_connection
+        
+    def release(self, con):
+        try:
+            super().release(con)
+        finally:
+            self.tracker.busy.discard(gevent.getcurrent())
+        
+    def drop(self, con):
+        try:
+            super().drop(con)
+        finally:
+            self.tracker.open.pop(gevent.getcurrent(), None)
+            self.tracker.busy.discard(gevent.getcurrent())
+
+
+def closeConnections(db):
+    """ Close all connections to the given GM database, which are not used
+    by a transaction right now. The database's mapping stays intact and
+    reconnects on demand. Returns the number of connections left open. """
+    tracker = getattr(db.provider.pool, 'tracker', None)
+    if tracker is None:
+        # in-memory database
+        return 0
+    for greenlet, con in list(tracker.open.items()):
+        if greenlet not in tracker.busy:
+            del tracker.open[greenlet]
+            con.close()
+    return len(tracker.open)
+
+
 def createGmDatabase(engine, filename):
     """ Creates a new database for with GM entities such as Tokens,
     Scenes etc.
@@ -52,51 +123,56 @@ def createGmDatabase(engine, filename):
             """Handle update of several data fields. The timeid is set if anything
             has actually changed.
             """
-            updated = False
+            changes = Token.getChanges({'locked': self.locked}, timeid, pos=pos,
+                zorder=zorder, size=size, rotate=rotate, flipx=flipx,
+                locked=locked, label=label)
+            
+            for key in changes:
+                setattr(self, key, changes[key])
+            
+            return len(changes) > 0
+        
+        @staticmethod
+        def getChanges(record, timeid, pos=None, zorder=None, size=None, rotate=None, flipx=None, locked=None, label=None):
+            """Determine which data fields an update would change. The given
+            record only needs to provide the token's current locking state,
+            so this can be applied to in-memory token data as well.
+            Returns a dict of changed fields (including the timeid).
+            """
+            changes = dict()
             
-            if self.locked and locked is None:
+            if record['locked'] and locked is None:
                 # token is locked and not unlocked
-                return updated
+                return changes
             
-            if locked is not None and self.locked != locked:
-                self.timeid = timeid
-                self.locked = locked
-                updated = True
+            if locked is not None and record['locked'] != locked:
+                changes['locked'] = locked
             
             if pos != None:
                 # force position onto scene (canvas)
-                self.posx = min(MAX_SCENE_WIDTH, max(0, pos[0]))
-                self.posy = min(MAX_SCENE_HEIGHT, max(0, pos[1]))
-                self.timeid = timeid 
-                updated = True
+                changes['posx'] = min(MAX_SCENE_WIDTH, max(0, pos[0]))
+                changes['posy'] = min(MAX_SCENE_HEIGHT, max(0, pos[1]))
             
             if zorder != None:
-                self.zorder = zorder
-                self.timeid = timeid
-                updated = True
+                changes['zorder'] = zorder
             
             if size != None:
-                self.size = min(MAX_TOKEN_SIZE, max(MIN_TOKEN_SIZE, size))
-                self.timeid = timeid 
-                updated = True
+                changes['size'] = min(MAX_TOKEN_SIZE, max(MIN_TOKEN_SIZE, size))
                 
             if rotate != None:
-                self.rotate = rotate
-                self.timeid = timeid
-                updated = True
+                changes['rotate'] = rotate
         
             if flipx != None:
-                self.flipx  = flipx
-                self.timeid = timeid
-                updated = True
+                changes['flipx'] = flipx
 
             if label != None:
-                self.text   = label[0][:15]
-                self.color  = label[1]
-                self.timeid = timeid
-                updated = True
+                changes['text']  = label[0][:15]
+                changes['color'] = label[1]
+
+            if len(changes) > 0:
+                changes['timeid'] = timeid
 
-            return updated
+            return changes
         
         @staticmethod
         def getPosByDegree(origin, k, n):
@@ -120,6 +196,11 @@ def createGmDatabase(engine, filename):
             y = min(MAX_SCENE_HEIGHT, max(0, y))
             
             return (x, y)
+        
+        @staticmethod
+        def getPosInCircle(origin, n):
+            """ Get positions in circle around origin for all n items. """
+            return [Token.getPosByDegree(origin, k, n) for k in range(n)]
 
 
     # -----------------------------------------------------------------------------
@@ -135,6 +216,37 @@ def createGmDatabase(engine, filename):
             for t in self.tokens:
                 t.delete()
             self.backing = None
+        
+        def cloneTokens(self, clone, timeid):
+            """ Copy all tokens (except the background) to the given scene
+            using a single set-based insert. Returns the data of all copied
+            tokens (see Token.to_dict).
+            """
+            # make sure both scenes and all tokens are in the database
+            db.flush()
+            
+            fields  = ['url', 'posx', 'posy', 'zorder', 'size', 'rotate', 'flipx', 'locked', 'text', 'color']
+            columns = ', '.join(fields)
+            args = {
+                'source' : self.id,
+                'target' : clone.id,
+                'timeid' : timeid
+            }
+            db.execute('INSERT INTO "Token" (scene, timeid, {0}) SELECT $target, $timeid, {0} FROM "Token" WHERE scene = $source AND size != -1'.format(columns), args)
+            
+            # @NOTE: the rows are read without creating entities, because
+            # pony considers the new scene's token set to be empty
+            tokens = list()
+            for row in db.select('SELECT id, {0} FROM "Token" WHERE scene = $target ORDER BY id'.format(columns), args):
+                data = dict(zip(['id'] + fields, row))
+                data['rotate'] = float(data['rotate'])
+                data['flipx']  = bool(data['flipx'])
+                data['locked'] = bool(data['locked'])
+                data['scene']  = clone.id
+                data['timeid'] = timeid
+                data['back']   = None
+                tokens.append(data)
+            return tokens
 
     # -----------------------------------------------------------------------------
 
@@ -169,54 +281,48 @@ def createGmDatabase(engine, filename):
         def getUrl(self):
             return '{0}/{1}'.format(self.gm_url, self.url)
         
-        def makeMd5s(self):                 
+        def makeMd5s(self):
+            """ Update the game's checksum index. Only new or modified
+            images are hashed and the manifest file is only written if
+            something changed. Returns the number of hashed images. """
             md5_path = engine.paths.getMd5Path(self.gm_url, self.url)
             root = engine.paths.getGamePath(self.gm_url, self.url)
-            all_images = self.getAllImages()
-            
-            # load md5 hashes from json-file
-            data = dict()
-            if os.path.exists(md5_path):
-                with open(md5_path, 'r') as handle:
-                    data = json.load(handle)
-            
-            # check if image exists for all md5s
-            for md5 in data.copy():
-                fname = '{0}.png'.format(data[md5])
-                if not os.path.exists(root / fname):
-                    del data[md5]
-            
-            # check for images without md5
-            missing = list()
-            for fname in all_images:
-                fname_id = int(fname.split('.')[0])
-                if fname_id not in data.values():
-                    missing.append(fname)
-
-            # create missing md5s
-            for fname in missing:
-                # create md5 of file (assumed to be images)
-                with open(root / fname, "rb") as handle:
-                    md5 = engine.getMd5(handle)
-                    data[md5] = int(fname.split('.')[0])
-            engine.checksums[self.getUrl()] = data
-
-            # save md5 hashes to json-file
-            with open(md5_path, 'w') as handle:
-                json.dump(data, handle)
-
-            return len(missing)
+            
+            index = engine.checksums.get(self.getUrl())
+            if index is None:
+                index = utils.ChecksumIndex()
+                index.load(md5_path)
+                engine.checksums[self.getUrl()] = index
+            
+            with engine.locks[self.gm_url]: # make IO access safe
+                assets = self.refreshAssets()
+                stale = index.scan(root, assets.images)
+                # create md5 of files (assumed to be images) in parallel
+                md5s = engine.hashing_api.getMd5s([path for img_id, path, stat in stale])
+                for (img_id, path, stat), md5 in zip(stale, md5s):
+                    index.add(img_id, md5, stat)
+                index.save(md5_path)
+
+            return len(stale)
+
+        def getMd5s(self):
+            """ Return the game's checksum index, which is loaded on
+            demand. """
+            data = engine.checksums.get(self.getUrl())
+            if data is None:
+                self.makeMd5s()
+                data = engine.checksums[self.getUrl()]
+            return data
 
         def getIdByMd5(self, md5):
-            return engine.checksums[self.getUrl()].get(md5, None) 
+            return self.getMd5s().get(md5, None) 
 
         def removeMd5(self, img_id):
-            cache = engine.checksums[self.getUrl()]
-            # linear search for image hash
-            for k, v in cache.items():
-                if v == img_id:
-                    del cache[k]
-                    return
+            index = engine.checksums.get(self.getUrl())
+            if index is None:
+                # @NOTE: not loaded, outdated hashes are dropped when loading
+                return
+            index.remove(img_id)
 
         def postSetup(self):
             """ Adds the game's directory and prepare the md5 cache.
@@ -242,75 +348,84 @@ def createGmDatabase(engine, filename):
             self.order = [s.id for s in self.scenes]
             self.order.sort()
         
+        def getAssets(self):
+            """ Return the game's asset index, which is loaded on demand. """
+            return engine.getAssets(self.gm_url, self.url)
+
+        def refreshAssets(self):
+            """ Scan the game's directory again, e.g. after files were
+            added without using the game. """
+            assets = self.getAssets()
+            assets.scan(engine.paths.getGamePath(self.gm_url, self.url))
+            return assets
+        
         def getAllImages(self):
-            """Note: needs to be called from a threadsafe context."""
-            root   = engine.paths.getGamePath(self.gm_url, self.url)
-            return [f for f in os.listdir(root) if f.endswith('.png')]
+            return self.getAssets().getImages()
         
         def getNextId(self):
-            """Note: needs to be called from a threadsafe context."""
-            max_id = 0
-            fnames = self.getAllImages()
-            split = lambda s: int(s.split('.png')[0])
-            if len(fnames) > 0:
-                last_png = max(fnames, key=split)
-                max_id   = split(last_png) + 1
-            return max_id
+            return self.getAssets().next_id
 
         def getImageUrl(self, image_id):
             return '/asset/{0}/{1}/{2}.png'.format(self.gm_url, self.url, image_id)
 
         def getFileSize(self, url):
-            game_root  = engine.paths.getGamePath(self.gm_url, self.url)
-            img_fname  = url.split('/')[-1]
-            local_path = os.path.join(game_root, img_fname)
-            return os.path.getsize(local_path)
+            stat = self.getAssets().images.get(self.getIdFromUrl(url))
+            if stat is None:
+                raise FileNotFoundError(url)
+            return stat.st_size
 
         def upload(self, handle):
             """Save the given image via file handle and return the url to the image.
+            The upload is hashed while it is written to a temporary file
+            inside the game's directory, which is then moved in place.
             """
-            suffix  = '.{0}'.format(handle.filename.split(".")[-1])
-            with tempfile.NamedTemporaryFile(suffix=suffix) as tmpfile:
-                # save image to tempfile
-                handle.save(tmpfile.name, overwrite=True)
-
-                # check file format
-                try:
-                    Image.open(tmpfile.name)
-                except UnidentifiedImageError:
+            game_root = engine.paths.getGamePath(self.gm_url, self.url)
+            fd, tmp_path = tempfile.mkstemp(dir=game_root, prefix='upload-', suffix='.tmp')
+            os.close(fd)
+            # @NOTE: mkstemp creates private files, but images are public
+            os.chmod(tmp_path, 0o644)
+            try:
+                # save image to tempfile and create md5 checksum for
+                # duplication test
+                new_md5 = engine.hashing_api.saveWithMd5(handle.file, tmp_path)
+                
+                # check file format (only the header is parsed)
+                if not engine.hashing_api.run(isImage, tmp_path):
                     # unsupported file format
                     return None
                 
-                # create md5 checksum for duplication test
-                new_md5 = engine.getMd5(tmpfile.file)
-                
-                game_root  = engine.paths.getGamePath(self.gm_url, self.url)
-                image_id   = self.getNextId()
-                local_path = game_root / '{0}.png'.format(image_id)
+                checksums = self.getMd5s()
+                assets    = self.getAssets()
                 with engine.locks[self.gm_url]: # make IO access safe
-                    if new_md5 not in engine.checksums[self.getUrl()]:
-                        # copy image to target
-                        shutil.copyfile(tmpfile.name, local_path)
+                    image_id = checksums.get(new_md5)
+                    if image_id is None:
+                        # move image to target
+                        image_id   = self.getNextId()
+                        local_path = game_root / '{0}.png'.format(image_id)
+                        os.replace(tmp_path, local_path)
                         
                         # store pair: checksum => image_id
-                        engine.checksums[self.getUrl()][new_md5] = image_id
-
-                # fetch remote path (query image_id via by checksum)
-                remote_path = self.getImageUrl(engine.checksums[self.getUrl()][new_md5])
-
-                # assure image file exists
-                img_id = int(remote_path.split('/')[-1].split('.png')[0])
-                local_path = game_root / '{0}.png'.format(img_id)
-                with engine.locks[self.gm_url]: # make IO access safe
-                    if not os.path.exists(local_path):
-                        # copy image to target
-                        shutil.copyfile(tmpfile.name, local_path)
-
+                        stat = os.stat(local_path)
+                        checksums.add(image_id, new_md5, stat)
+                        assets.addImage(image_id, stat)
+                        
+                    elif not os.path.exists(game_root / '{0}.png'.format(image_id)):
+                        # assure image file exists
+                        local_path = game_root / '{0}.png'.format(image_id)
+                        os.replace(tmp_path, local_path)
+                        assets.addImage(image_id, os.stat(local_path))
+                        
+                        remote_path = self.getImageUrl(image_id)
                         engine.logging.warning('Image got re-uploaded to fix a cache error')
                         if engine.notify_api is not None:
                             engine.notify_api(remote_path, 'Image got re-uploaded to fix a cache error:\n {0}'.format(remote_path))
                 
-                return remote_path
+                return self.getImageUrl(image_id)
+            
+            finally:
+                # remove tempfile if it wasn't moved
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
         
         @staticmethod
         def getIdFromUrl(url):
@@ -343,9 +458,9 @@ def createGmDatabase(engine, filename):
 
         def getBrokenTokens(self):
             # query all images
-            all_images = list()
+            all_images = set()
             with engine.locks[self.gm_url]: # make IO access safe
-                all_images = self.getAllImages()
+                all_images = set(self.getAllImages())
 
             # query all tokens without valid image
             broken = list()
@@ -360,11 +475,15 @@ def createGmDatabase(engine, filename):
         def removeMusic(self):
             """ Remove music. """
             root = engine.paths.getGamePath(self.gm_url, self.url)
+            assets = self.getAssets()
             with engine.locks[self.gm_url]: # make IO access safe
-                for n in range(engine.file_limit['num_music']):
-                    fname = root / '{0}.mp3'.format(n)
-                    if os.path.exists(fname):
-                        os.remove(fname)
+                for n in assets.getSlots():
+                    try:
+                        os.remove(root / '{0}.mp3'.format(n))
+                    except FileNotFoundError:
+                        # @NOTE: the index may be stale
+                        pass
+                    assets.removeMusic(n)
         
         def cleanup(self, now):
             """ Cleanup game's unused image and token data. """   
@@ -372,12 +491,23 @@ def createGmDatabase(engine, filename):
             
             # query and remove all images that are not used as tokens
             relevant = self.getAbandonedImages()
+            thumb_root = engine.paths.getThumbnailPath(self.gm_url, self.url)
             with engine.locks[self.gm_url]: # make IO access safe
                 for fname in relevant:
                     engine.logging.info('     |--x Removing {0}'.format(fname))
-                    os.remove(fname)
-                    # remove image's md5 hash from cache
-                    self.removeMd5(self.getIdFromUrl(fname))
+                    try:
+                        os.remove(fname)
+                    except FileNotFoundError:
+                        # @NOTE: the index may be stale
+                        pass
+                    # remove image's md5 hash and file from cache
+                    img_id = self.getIdFromUrl(fname)
+                    self.removeMd5(img_id)
+                    self.getAssets().removeImage(img_id)
+                    # remove image's thumbnail (if any)
+                    thumb_path = thumb_root / engine.thumbnail_api.getFilename(img_id)
+                    if os.path.exists(thumb_path):
+                        os.remove(thumb_path)
 
             # delete all outdated rolls
             rolls = db.Roll.select(lambda r: r.game == self and r.timeid < now - engine.latest_rolls)
@@ -395,15 +525,15 @@ def createGmDatabase(engine, filename):
             the GM's database. """
             engine.logging.info('|--x Removing {0}'.format(self.url))
             
+            # remove game from GM's cache (if loaded)
+            gm_cache = engine.cache.getFromUrl(self.gm_url)
+            gm_cache.drop(self.url)
+            
             # remove game directory (including all images)
             game_path = engine.paths.getGamePath(self.gm_url, self.url)
             with engine.locks[self.gm_url]: # make IO access safe
                 shutil.rmtree(game_path)
             
-            # remove game from GM's cache
-            gm_cache = engine.cache.getFromUrl(self.gm_url)
-            gm_cache.remove(self)
-            
             # remove all scenes
             for s in self.scenes:
                 s.preDelete()
@@ -473,7 +603,7 @@ def createGmDatabase(engine, filename):
             with zipfile.ZipFile(zip_path / zip_file, "w") as h:
                 # create temporary file and add it to the zip
                 with tempfile.NamedTemporaryFile() as tmp:
-                    s = json.dumps(data, indent=4)
+                    s = codec.dumps(data, indent=True)
                     tmp.write(s.encode('utf-8'))
                     tmp.seek(0) # rewind!
                     h.write(tmp.name, 'game.json')
@@ -578,9 +708,9 @@ def createGmDatabase(engine, filename):
                 if not os.path.exists(json_path):
                     return None
                 try:
-                    with open(json_path , 'r') as h:
-                        data = json.load(h)
-                except json.decoder.JSONDecodeError:
+                    with open(json_path , 'rb') as h:
+                        data = codec.loads(h.read())
+                except codec.DecodeError:
                     # json is corrupted
                     return None
                 
@@ -601,6 +731,9 @@ def createGmDatabase(engine, filename):
                         dst_path = img_path / fname
                         shutil.copyfile(src_path, dst_path)
                 
+                # create md5 of all images
+                game.makeMd5s()
+                
                 # create scenes
                 try:
                     game.fromDict(data)
@@ -618,6 +751,14 @@ def createGmDatabase(engine, filename):
     db.bind('sqlite', filename, create_db=True)
     db.generate_mapping(create_tables=True)
     
+    # replace pony's pool to keep track of all connections
+    # @NOTE: in-memory databases only exist as long as their connection
+    pool = db.provider.pool
+    if not pool.is_shared_memory_db and pool.filename != ':memory:':
+        pool.disconnect()
+        db.provider.pool = GreenletPool(ConnectionTracker(), pool.is_shared_memory_db,
+            pool.filename, pool.create_db, **pool.kwargs)
+    
     return db
 
 
@@ -676,15 +817,16 @@ def createMainDatabase(engine):
             """  
             engine.logging.info('Removing GM {0} <{1}>'.format(self.name, self.url))
             
+            # remove GM from engine's cache
+            # @NOTE: this closes his database, which may write pending changes
+            engine.cache.remove(self)
+            
             # remove GM's directory (including his database, all games and images)
             root_path = engine.paths.getGmsPath(self.url)
             
             with engine.locks[self.url]: # make IO access safe
                 shutil.rmtree(root_path)
             
-            # remove GM from engine's cache
-            engine.cache.remove(self)
-            
         def refreshSession(self, response):
             """ Refresh session id. """
             now = time.time()
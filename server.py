@@ -21,6 +21,40 @@ __licence__ = 'MIT'
 
 
 
+class FileWrapper(object):
+    """ wsgi.file_wrapper, which allows VttHandler to send the file using
+    sendfile instead of reading it in python. """
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize  = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+    
+    def __iter__(self):
+        return iter(lambda: self.filelike.read(self.blksize), b'')
+
+
+class VttHandler(WebSocketHandler):
+    """ WebSocketHandler which sends files via sendfile (zero-copy) if
+    possible. """
+    
+    def get_environ(self):
+        environ = super().get_environ()
+        environ['wsgi.file_wrapper'] = FileWrapper
+        return environ
+    
+    def process_result(self):
+        if not isinstance(self.result, FileWrapper) or self.response_use_chunked:
+            return super().process_result()
+        
+        # send headers, then the file's content
+        # @NOTE: the socket falls back to regular sends if sendfile is not
+        # available (e.g. via SSL)
+        self.write(b'')
+        self.response_length += self.socket.sendfile(self.result.filelike)
+
+
 # Server adapter providing support for WebSockets and UnixSocket
 class VttServer(bottle.ServerAdapter):
     
@@ -45,11 +79,11 @@ class VttServer(bottle.ServerAdapter):
             print('Listening on unixsocket: {0}'.format(self.unixsocket))
             
             # run server using unix socket
-            server = WSGIServer(self.listener, handler, handler_class=WebSocketHandler, **self.options)
+            server = WSGIServer(self.listener, handler, handler_class=VttHandler, **self.options)
             
         else:
             # start server using a regular host-port-configuration
-            server = WSGIServer((self.host, self.port), handler, handler_class=WebSocketHandler, **self.options)
+            server = WSGIServer((self.host, self.port), handler, handler_class=VttHandler, **self.options)
         
         # run server
         server.serve_forever()
@@ -0,0 +1,71 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, tempfile, pathlib, os
+
+import utils
+
+class AssetIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root   = pathlib.Path(self.tmpdir.name)
+        self.index  = utils.AssetIndex()
+        
+    def tearDown(self):
+        del self.index
+        self.tmpdir.cleanup()
+        
+    def touch(self, fname, content=''):
+        path = self.root / fname
+        with open(path, 'w') as h:
+            h.write(content)
+        return path
+        
+    def test_scan(self):
+        self.index.scan(self.root)
+        self.assertEqual(self.index.next_id, 0)
+        self.assertEqual(self.index.getImages(), list())
+        
+        for fname in ['0.png', '10.png', '2.png', '1.mp3', '0.mp3', 'gm.md5', 'foo.png']:
+            self.touch(fname, 'demo')
+        self.index.scan(self.root)
+        self.assertEqual(self.index.getImages(), ['0.png', '2.png', '10.png'])
+        self.assertEqual(self.index.getSlots(), [0, 1])
+        self.assertEqual(self.index.getMusic(), ['0.mp3', '1.mp3'])
+        self.assertEqual(self.index.images[2].st_size, 4)
+        # gaps are ignored
+        self.assertEqual(self.index.next_id, 11)
+        
+    def test_images(self):
+        p = self.touch('0.png')
+        self.index.addImage(0, os.stat(p))
+        self.index.addImage(3, os.stat(p))
+        self.assertEqual(self.index.next_id, 4)
+        self.index.addImage(1, os.stat(p))
+        self.assertEqual(self.index.next_id, 4)
+        
+        # next id is based on the highest remaining id
+        self.index.removeImage(3)
+        self.assertEqual(self.index.next_id, 2)
+        self.index.removeImage(0)
+        self.assertEqual(self.index.next_id, 2)
+        self.index.removeImage(1)
+        self.assertEqual(self.index.next_id, 0)
+        # removing unknown images is fine
+        self.index.removeImage(5)
+        
+    def test_music(self):
+        p = self.touch('2.mp3')
+        self.index.addMusic(2, os.stat(p))
+        self.index.addMusic(0, os.stat(p))
+        self.assertEqual(self.index.getSlots(), [0, 2])
+        self.index.removeMusic(2)
+        self.index.removeMusic(4)
+        self.assertEqual(self.index.getSlots(), [0])
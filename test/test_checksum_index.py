@@ -0,0 +1,104 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, tempfile, pathlib, os, json
+
+import utils
+
+class ChecksumIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root   = pathlib.Path(self.tmpdir.name)
+        self.path   = self.root / 'gm.md5'
+        self.index  = utils.ChecksumIndex()
+        
+    def tearDown(self):
+        del self.index
+        self.tmpdir.cleanup()
+        
+    def scan(self, index):
+        assets = utils.AssetIndex()
+        assets.scan(self.root)
+        return index.scan(self.root, assets.images)
+        
+    def write(self, img_id, content):
+        path = self.root / '{0}.png'.format(img_id)
+        with open(path, 'w') as h:
+            h.write(content)
+        return path
+        
+    def test_add_remove(self):
+        p = self.write(3, 'foo')
+        self.index.add(3, 'abc', os.stat(p))
+        self.assertIn('abc', self.index)
+        self.assertEqual(self.index['abc'], 3)
+        self.assertEqual(self.index.getDigest(3), 'abc')
+        self.assertEqual(len(self.index), 1)
+        
+        # replacing the image drops its old digest
+        self.index.add(3, 'def', os.stat(p))
+        self.assertNotIn('abc', self.index)
+        self.assertEqual(self.index.get('def'), 3)
+        
+        self.index.remove(3)
+        self.assertEqual(len(self.index), 0)
+        self.assertIsNone(self.index.getDigest(3))
+        # removing unknown images is fine
+        self.index.remove(7)
+        
+    def test_scan(self):
+        self.write(0, 'foo')
+        self.write(1, 'bar')
+        with open(self.root / '0.mp3', 'w') as h:
+            h.write('music')
+        
+        # all images need to be hashed
+        stale = self.scan(self.index)
+        self.assertEqual({s[0] for s in stale}, {0, 1})
+        for img_id, path, stat in stale:
+            self.index.add(img_id, 'md5-{0}'.format(img_id), stat)
+        self.assertEqual(self.scan(self.index), list())
+        
+        # modified images need to be hashed again
+        self.write(1, 'foobar')
+        stale = self.scan(self.index)
+        self.assertEqual([s[0] for s in stale], [1])
+        
+        # removed images are dropped
+        os.remove(self.root / '0.png')
+        self.scan(self.index)
+        self.assertNotIn('md5-0', self.index)
+        
+    def test_save_load(self):
+        # missing manifest needs to be created
+        self.index.load(self.path)
+        self.assertTrue(self.index.save(self.path))
+        self.assertFalse(self.index.save(self.path))
+        
+        p = self.write(2, 'foo')
+        self.index.add(2, 'abc', os.stat(p))
+        self.assertTrue(self.index.save(self.path))
+        
+        other = utils.ChecksumIndex()
+        other.load(self.path)
+        self.assertFalse(other.dirty)
+        self.assertEqual(other.get('abc'), 2)
+        self.assertEqual(self.scan(other), list())
+        
+    def test_load_legacy(self):
+        p = self.write(2, 'foo')
+        with open(self.path, 'w') as h:
+            json.dump({'abc': 2}, h)
+        
+        # legacy entries are hashed again
+        self.index.load(self.path)
+        self.assertTrue(self.index.dirty)
+        self.assertEqual(len(self.index), 0)
+        self.assertEqual(len(self.scan(self.index)), 1)
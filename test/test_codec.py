@@ -0,0 +1,116 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, json
+
+import codec
+
+
+class CodecTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.token = {
+            'id': 12, 'scene': 3, 'url': '/token/5', 'posx': 120, 'posy': 80,
+            'zorder': 2, 'size': 60, 'rotate': 0.0, 'flipx': False,
+            'locked': False, 'timeid': 1000.5, 'back': None, 'text': '',
+            'color': ''
+        }
+        
+    def test_dumps(self):
+        data = {'OPID': 'UPDATE', 'tokens': [self.token], 'text': 'Über'}
+        raw = codec.dumps(data)
+        # websocket frames are text
+        self.assertIsInstance(raw, str)
+        self.assertEqual(json.loads(raw), data)
+        
+        raw = codec.dumps(data, indent=True)
+        self.assertIn('\n', raw)
+        self.assertEqual(json.loads(raw), data)
+        
+    def test_loads(self):
+        data = {'OPID': 'UPDATE', 'tokens': [self.token], 'text': 'Über'}
+        raw = json.dumps(data)
+        self.assertEqual(codec.loads(raw), data)
+        self.assertEqual(codec.loads(raw.encode('utf-8')), data)
+        
+        with self.assertRaises(codec.DecodeError):
+            codec.loads('{"broken": ')
+        
+    def test_negotiate(self):
+        self.assertEqual(codec.negotiate(None).name, 'json')
+        self.assertEqual(codec.negotiate('compact').name, 'json')
+        self.assertEqual(codec.negotiate([]).name, 'json')
+        self.assertEqual(codec.negotiate(['msgpack']).name, 'json')
+        self.assertEqual(codec.negotiate(['msgpack', 'compact']).name, 'compact')
+        self.assertEqual(codec.negotiate(['json', 'compact']).name, 'json')
+        
+        # server's preference is used if given
+        self.assertEqual(codec.negotiate(['compact', 'json'], ['json', 'compact']).name, 'json')
+        self.assertEqual(codec.negotiate(['json', 'compact'], ['compact', 'json']).name, 'compact')
+        self.assertEqual(codec.negotiate(['json'], ['compact']).name, 'json')
+        self.assertEqual(codec.negotiate(None, ['compact']).name, 'json')
+        
+    def test_json(self):
+        c = codec.JsonCodec()
+        data = {'OPID': 'UPDATE', 'tokens': [self.token]}
+        self.assertEqual(json.loads(c.encode(data)), data)
+        self.assertEqual(c.decode(json.dumps(data)), data)
+        
+    def test_compact_encode(self):
+        c = codec.CompactCodec()
+        
+        # token records become arrays
+        raw = c.encode({'OPID': 'REFRESH', 'tokens': [self.token], 'background': 12})
+        frame = json.loads(raw)
+        self.assertEqual(frame[0], 'REFRESH')
+        self.assertEqual(frame[2], 12)
+        self.assertEqual(len(frame[1]), 1)
+        self.assertEqual(frame[1][0][0], 12)
+        self.assertEqual(frame[1][0][2], 120)
+        # missing fields at the end are dropped
+        self.assertEqual(len(frame[1][0]), codec.TOKEN_FIELDS.index('timeid') + 1)
+        
+        # partial records are filled with null
+        raw = c.encode({'OPID': 'UPDATE', 'tokens': [{'id': 12, 'posx': 20, 'posy': 30}]})
+        self.assertEqual(json.loads(raw), ['UPDATE', [[12, None, 20, 30]]])
+        
+        # compact frames are smaller
+        data = {'OPID': 'REFRESH', 'tokens': [self.token] * 50, 'background': None}
+        self.assertLess(len(c.encode(data)), len(json.dumps(data)) / 2)
+        
+        # unknown OPIDs are sent as JSON objects
+        data = {'OPID': 'ROLL', 'color': 'red', 'sides': 20, 'result': 3}
+        self.assertEqual(json.loads(c.encode(data)), data)
+        
+        # so are frames with unknown fields
+        data = {'OPID': 'PING', 'foo': 'bar'}
+        self.assertEqual(json.loads(c.encode(data)), data)
+        data = {'OPID': 'UPDATE', 'tokens': [{'id': 12, 'foo': 'bar'}]}
+        self.assertEqual(json.loads(c.encode(data)), data)
+        data = {'OPID': 'REFRESH', 'tokens': []}
+        self.assertEqual(json.loads(c.encode(data)), data)
+        
+    def test_compact_decode(self):
+        c = codec.CompactCodec()
+        
+        # client's changes are expanded to records
+        data = c.decode(json.dumps(['UPDATE', [[12, None, 20, 30], [13, None, None, None, None, 50]]]))
+        self.assertEqual(data, {'OPID': 'UPDATE', 'changes': [
+            {'id': 12, 'posx': 20, 'posy': 30},
+            {'id': 13, 'size': 50}
+        ]})
+        self.assertEqual(c.decode('["PING"]'), {'OPID': 'PING'})
+        
+        # JSON objects are accepted as well
+        data = {'OPID': 'ROLL', 'sides': 20}
+        self.assertEqual(c.decode(json.dumps(data)), data)
+        
+        # unknown OPIDs cannot be decoded
+        with self.assertRaises(KeyError):
+            c.decode('["ROLL", 20]')
@@ -137,6 +137,23 @@ class EngineTest(EngineBaseTest):
         settings['login']['domain'] = 'dummy.us.auth0.com' 
         self.reloadEngine(settings=settings)  
 
+    def test_cannotCreateEngineWithInvalidRatelimit(self):
+        # burst must allow a single action
+        settings = EngineTest.defaultSettings()
+        settings['ratelimit'] = {'UPDATE': [30, 0.5]}
+        with self.assertRaises(ValueError):
+            self.reloadEngine(settings=settings)
+        
+        # rate must not be negative
+        settings['ratelimit'] = {'UPDATE': [-1, 10]}
+        with self.assertRaises(ValueError):
+            self.reloadEngine(settings=settings)
+        
+        # ... but limits can be disabled
+        settings['ratelimit'] = {'UPDATE': [0, 0]}
+        self.reloadEngine(settings=settings)
+        self.assertEqual(self.engine.ratelimit['UPDATE'], [0, 0])
+
     def test_getUrl(self):
         settings = EngineTest.defaultSettings()
         self.reloadEngine(settings=settings)
@@ -265,6 +282,13 @@ class EngineTest(EngineBaseTest):
             fupload = FileUpload(h, 'demo.dat', 'demo.dat')
             size = self.engine.getSize(fupload)
             self.assertEqual(size, 4953)
+            self.assertEqual(h.tell(), 0)
+            
+            # size is counted from the current offset
+            h.seek(953)
+            size = self.engine.getSize(fupload)
+            self.assertEqual(size, 4000)
+            self.assertEqual(h.tell(), 953)
         
     def test_getSupportedDice(self):
         dice = self.engine.getSupportedDice()
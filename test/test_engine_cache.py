@@ -25,7 +25,16 @@ class EngineCacheTest(EngineBaseTest):
         
         # 2nd insertion is fine (GmCache is replaced)
         # @NOTE: the user may delete cookies and relogin
-        cache.insert(gm1)
+        old = cache.get(gm1)
+        old.connect_db()
+        db = old.db
+        self.assertIn('foo', cache.databases)
+        gm_cache = cache.insert(gm1)
+        self.assertIsNot(gm_cache, old)
+        
+        # ... and the old database is closed
+        self.assertNotIn('foo', cache.databases)
+        self.assertEqual(len(db.provider.pool.tracker.open), 0)
         
     def test_get(self):  
         cache = self.engine.cache
@@ -68,12 +77,19 @@ class EngineCacheTest(EngineBaseTest):
             gm1.postSetup()
             gm2.postSetup()
         
+        gm1_cache = cache.get(gm1)
+        gm1_cache.connect_db()
+        db = gm1_cache.db
         cache.remove(gm1)
         
         # cannot query removed gm
         unknown_cache = cache.get(gm1)
         self.assertIsNone(unknown_cache)
         
+        # ... and its database is closed
+        self.assertNotIn('foo', cache.databases)
+        self.assertEqual(len(db.provider.pool.tracker.open), 0)
+        
         # cannot delete twice
         with self.assertRaises(KeyError):
             cache.remove(gm1)
@@ -149,6 +165,9 @@ class EngineCacheTest(EngineBaseTest):
         cache.listen(socket)
         self.assertEqual(player_cache.socket, socket)
         self.assertIsNotNone(player_cache.greenlet)
+        # expect JSON encoding by default
+        self.assertEqual(player_cache.codec.name, 'json')
+        self.assertEqual(socket.pop_send()['codec'], 'json')
         
         # @NOTE: The async handle() will terminate, because the dummy
         # socket yields None and hence mimics socket to be closed by
@@ -158,3 +177,22 @@ class EngineCacheTest(EngineBaseTest):
         # expect player to be disconnected
         player_cache = game_cache.get('arthur')
         self.assertIsNone(player_cache)
+        
+        # listening negotiates the websocket encoding
+        player_cache = game_cache.insert('arthur', 'red', is_gm=False)
+        socket = SocketDummy()
+        socket.block = False
+        socket.push_receive({'name': 'arthur', 'gm_url': 'foo', 'game_url': 'bar', 'codecs': ['msgpack', 'compact', 'json']})
+        cache.listen(socket)
+        self.assertEqual(player_cache.codec.name, 'json')
+        player_cache.greenlet.join()
+        
+        # ... by the server's preference
+        self.engine.websocket['codecs'] = ['compact', 'json']
+        player_cache = game_cache.insert('arthur', 'red', is_gm=False)
+        socket = SocketDummy()
+        socket.block = False
+        socket.push_receive({'name': 'arthur', 'gm_url': 'foo', 'game_url': 'bar', 'codecs': ['msgpack', 'compact', 'json']})
+        cache.listen(socket)
+        self.assertEqual(player_cache.codec.name, 'compact')
+        player_cache.greenlet.join()
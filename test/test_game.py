@@ -81,6 +81,7 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
 
         # assume md5 file to be empty 
         md5_path = self.engine.paths.getMd5Path(game.gm_url, game.url)
@@ -106,17 +107,25 @@ class GameTest(EngineBaseTest):
         p2 = img_path / '{0}.png'.format(id2)
         with open(p2, 'w') as h: # write different content because of hashing
             h.write('2')
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         with open(p3, 'w') as h: # write different content because of hashing
             h.write('3')
+        game.refreshAssets()
         id4 = game.getNextId()
         p4 = img_path / '{0}.png'.format(id4)
         with open(p4, 'w') as h: # write different content because of hashing
             h.write('4')
+        game.refreshAssets()
 
-        # update md5s
-        game.makeMd5s()
+        # update md5s (only new files are hashed)
+        self.assertEqual(game.makeMd5s(), 3)
+        mtime = os.stat(md5_path).st_mtime_ns
+        
+        # unchanged files are neither hashed nor written
+        self.assertEqual(game.makeMd5s(), 0)
+        self.assertEqual(os.stat(md5_path).st_mtime_ns, mtime)
 
         # expect md5 file with multiple hashs
         self.assertTrue(os.path.exists(md5_path))
@@ -150,18 +159,22 @@ class GameTest(EngineBaseTest):
         p1 = img_path / '{0}.png'.format(id1)
         with open(p1, 'w') as h: # write different content because of hashing
             h.write('FOO')
+        game.refreshAssets()
         id2 = game.getNextId()
         p2 = img_path / '{0}.png'.format(id2)
         with open(p2, 'w') as h: # write different content because of hashing
             h.write('A')
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         with open(p3, 'w') as h: # write different content because of hashing
             h.write('AAAA')
+        game.refreshAssets()
         id4 = game.getNextId()
         p4 = img_path / '{0}.png'.format(id4)
         with open(p4, 'w') as h: # write different content because of hashing
             h.write('ABAAB')
+        game.refreshAssets()
         
         # assume empty cache
         cache_instance = self.engine.checksums[game.getUrl()]
@@ -190,18 +203,22 @@ class GameTest(EngineBaseTest):
         p1 = img_path / '{0}.png'.format(id1)
         with open(p1, 'w') as h: # write different content because of hashing
             h.write('FOO')
+        game.refreshAssets()
         id2 = game.getNextId()
         p2 = img_path / '{0}.png'.format(id2)
         with open(p2, 'w') as h: # write different content because of hashing
             h.write('A')
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         with open(p3, 'w') as h: # write different content because of hashing
             h.write('AAAA')
+        game.refreshAssets()
         id4 = game.getNextId()
         p4 = img_path / '{0}.png'.format(id4)
         with open(p4, 'w') as h: # write different content because of hashing
             h.write('ABAAB')
+        game.refreshAssets()
         
         # assume empty cache
         cache_instance = self.engine.checksums[game.getUrl()]
@@ -266,19 +283,24 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         id2 = game.getNextId()
         p2 = img_path / '{0}.png'.format(id2)
         p2.touch()
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         p3.touch()
+        game.refreshAssets()
         id4 = game.getNextId()
         p4 = img_path / '{0}.png'.format(id4)
         p4.touch()
+        game.refreshAssets()
 
         # create music file (not expected to be picked up)
         p5 = img_path / '2.mp3'
         p5.touch()
+        game.refreshAssets()
         
         # test files being detected
         files = set(game.getAllImages())
@@ -301,12 +323,14 @@ class GameTest(EngineBaseTest):
         for i in [0, 1, 2, 3, 4, 6, 7, 8, 10, 11, 12]:
             p = img_path / '{0}.png'.format(i)
             p.touch()
+            game.refreshAssets()
         i = game.getNextId()
         self.assertEqual(i, 13)
         
         # first unused id
         p = img_path / '5.png'
         p.touch()     
+        game.refreshAssets()
         i = game.getNextId()
         self.assertEqual(i, 13)
     
@@ -328,18 +352,22 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         id2 = game.getNextId()
         p2 = img_path / '{0}.png'.format(id2)
         with open(p2, 'w') as h:
             h.write('test')
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         with open(p3, 'w') as h:
             h.write('xy')
+        game.refreshAssets()
         id4 = game.getNextId()
         p4 = img_path / '{0}.png'.format(id4)
         with open(p4, 'w') as h:
             h.write('abc')
+        game.refreshAssets()
         
         # test file sizes
         size1 = game.getFileSize(str(p1))
@@ -438,6 +466,14 @@ class GameTest(EngineBaseTest):
                 old_id = game.getNextId()
                 url = game.upload(fupload)
                 self.assertIsNone(url)
+                self.assertEqual(game.getNextId(), old_id)
+        
+        # no temporary files are left and images are readable by others
+        img_path = self.engine.paths.getGamePath(game.gm_url, game.url)
+        fnames = [f for f in os.listdir(img_path) if f != 'gm.md5']
+        self.assertEqual(set(fnames), set(game.getAllImages()))
+        for fname in fnames:
+            self.assertEqual(os.stat(img_path / fname).st_mode & 0o777, 0o644)
         
     def test_getIdFromUrl(self):
         self.assertEqual(self.db.Game.getIdFromUrl('/foo/bar/3.17.png'), 3)
@@ -455,15 +491,19 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         id2 = game.getNextId()
         p2 = img_path / '{0}.png'.format(id2)
         p2.touch()
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         p3.touch()
+        game.refreshAssets()
         id4 = game.getNextId()
         p4 = img_path / '{0}.png'.format(id4)
         p4.touch()
+        game.refreshAssets()
         
         # assign second file to token
         demo_scene = self.db.Scene(game=game)
@@ -489,6 +529,7 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         
         # create tokens with and without valid image
         demo_scene = self.db.Scene(game=game)
@@ -514,8 +555,19 @@ class GameTest(EngineBaseTest):
         img_path = self.engine.paths.getGamePath(game.gm_url, game.url)
         p3 = img_path / '3.mp3'
         p3.touch()
+        game.refreshAssets()
+        game.removeMusic()
+        self.assertFalse(os.path.exists(p3))
+        
+        # files which are already gone are skipped
+        p2 = img_path / '2.mp3'
+        p2.touch()
+        p3.touch()
+        game.refreshAssets()
+        os.remove(p2)
         game.removeMusic()
         self.assertFalse(os.path.exists(p3))
+        self.assertEqual(game.getAssets().getSlots(), [])
     
     @db_session
     def test_cleanup(self):
@@ -528,16 +580,19 @@ class GameTest(EngineBaseTest):
         p1 = img_path / '{0}.png'.format(id1)
         with open(p1, 'w') as h: # write different content because of hashing
             h.write('FOOBAR')
+        game.refreshAssets()
         id2 = game.getNextId()
         p2 = img_path / '{0}.png'.format(id2)
         with open(p2, 'w') as h: # write different content because of hashing
             h.write('AAB')
         p2.touch()   
+        game.refreshAssets()
         id3 = game.getNextId()
         p3 = img_path / '{0}.png'.format(id3)
         with open(p3, 'w') as h: # write different content because of hashing
             h.write('AB234')
         p3.touch()
+        game.refreshAssets()
         
         game.makeMd5s() 
 
@@ -579,6 +634,7 @@ class GameTest(EngineBaseTest):
         # expect music to still be present
         p3 = img_path / '4.mp3'    
         p3.touch()
+        game.refreshAssets()
         game.cleanup(now)
         self.assertTrue(os.path.exists(p3))
         
@@ -592,6 +648,7 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         url = game.getImageUrl(id1)
         
         # create two demo scenes with tokens
@@ -677,11 +734,13 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         url = game.getImageUrl(id1)
 
         # create dummy music
         p2 = img_path / '0.mp3'    
         p2.touch()
+        game.refreshAssets()
 
         # create two demo scenes with tokens
         scene1 = self.db.Scene(game=game)
@@ -797,6 +856,7 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         url = game.getImageUrl(id1)
         
         # create two demo scenes with tokens
@@ -878,6 +938,7 @@ class GameTest(EngineBaseTest):
         id1 = game.getNextId()
         p1 = img_path / '{0}.png'.format(id1)
         p1.touch()
+        game.refreshAssets()
         url = game.getImageUrl(id1)
         
         # create two demo scenes with tokens
@@ -927,6 +988,11 @@ class GameTest(EngineBaseTest):
                 img_fname = new_img_path / img_id
                 self.assertTrue(os.path.exists(img_fname))
             
+            # assert imported images being hashed
+            with open(p1, 'rb') as h:
+                md5 = self.engine.getMd5(h)
+            self.assertEqual(game2.getIdByMd5(md5), id1)
+            
             # @NOTE: exact token data (position etc.) isn't tested here
         
         # create corrupt json file inside zip
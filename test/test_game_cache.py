@@ -126,14 +126,14 @@ class GameCacheTest(EngineBaseTest):
         self.cache.insert('bob', 'blue', True)
         
         # set selections
-        self.cache.get('arthur').selected = [236, 154]
-        self.cache.get('carlos').selected = [12]
-        self.cache.get('bob').selected = [124, 236, 12]
+        self.cache.get('arthur').selected = {236, 154}
+        self.cache.get('carlos').selected = {12}
+        self.cache.get('bob').selected = {124, 236, 12}
         
         # expect selections per player name
         selections = self.cache.getSelections()
         for name in selections:
-            self.assertEqual(selections[name], self.cache.get(name).selected)
+            self.assertEqual(set(selections[name]), self.cache.get(name).selected)
         
     def test_remove(self):  
         # create some players
@@ -0,0 +1,82 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, tempfile, pathlib
+
+import utils
+
+class GeoIpApiTest(unittest.TestCase):
+    
+    def setUp(self):            
+        # create temporary directory
+        self.tmpdir = tempfile.TemporaryDirectory()
+        root = pathlib.Path(self.tmpdir.name)
+        
+        self.paths = utils.PathApi(appname='unittest', root=root)
+        
+        # mixed dotted and integer ranges, unsorted
+        with open(self.paths.getGeoIpPath(), 'w') as h:
+            h.write('"ip_from","ip_to","country"\n')
+            h.write('"5.0.0.0","5.0.0.255","DE"\n')
+            h.write('"16777216","16777471","AU"\n') # 1.0.0.0 - 1.0.0.255
+            h.write('"1.0.1.0","1.0.3.255","-"\n')
+            h.write('"2001:db8::","2001:db8::ffff","FR"\n')
+        self.geoip = utils.GeoIpApi(self.paths.getGeoIpPath(), cache_size=2)
+        
+    def tearDown(self):
+        del self.geoip
+        del self.paths
+        del self.tmpdir
+        
+    def test_search(self):
+        self.assertEqual(self.geoip('1.0.0.0'), 'au')
+        self.assertEqual(self.geoip('1.0.0.255'), 'au')
+        self.assertEqual(self.geoip('5.0.0.17'), 'de')
+        self.assertEqual(self.geoip('2001:db8::1'), 'fr')
+        # unassigned range
+        self.assertEqual(self.geoip('1.0.2.0'), '?')
+        # outside of all ranges
+        self.assertEqual(self.geoip('0.0.0.1'), '?')
+        self.assertEqual(self.geoip('4.255.255.255'), '?')
+        self.assertEqual(self.geoip('5.0.1.0'), '?')
+        self.assertEqual(self.geoip('127.0.0.1'), '?')
+        # no ip at all
+        self.assertEqual(self.geoip('localhost'), '?')
+        self.assertEqual(self.geoip(None), '?')
+        
+    def test_cache(self):
+        self.geoip('1.0.0.1')
+        self.geoip('5.0.0.1')
+        self.assertEqual(list(self.geoip.cache), ['1.0.0.1', '5.0.0.1'])
+        # recently used ip is kept
+        self.geoip('1.0.0.1')
+        self.geoip('2001:db8::1')
+        self.assertEqual(list(self.geoip.cache), ['1.0.0.1', '2001:db8::1'])
+        # cached code is used
+        self.geoip.cache['1.0.0.1'] = 'xy'
+        self.assertEqual(self.geoip('1.0.0.1'), 'xy')
+        
+    def test_remote(self):
+        queried = list()
+        self.geoip.queryRemote = lambda ip: queried.append(ip)
+        # remote lookup is disabled by default
+        self.assertEqual(self.geoip('8.8.8.8'), '?')
+        self.assertEqual(queried, [])
+        # public ips are queried in the background
+        self.geoip.remote = True
+        self.assertEqual(self.geoip('8.8.8.8'), '?')
+        self.assertEqual(self.geoip('127.0.0.1'), '?')
+        self.assertEqual(self.geoip('1.0.0.1'), 'au')
+        self.assertIn('8.8.8.8', self.geoip.pending)
+        utils.gevent.idle()
+        self.assertEqual(queried, ['8.8.8.8'])
+        
+    def test_missing_table(self):
+        geoip = utils.GeoIpApi(self.paths.root / 'missing.csv')
+        self.assertEqual(geoip('1.0.0.1'), '?')
@@ -136,6 +136,7 @@ class GmTest(EngineBaseTest):
         self.assertFalse(os.path.exists(p))
         gm_cache = self.engine.cache.get(gm)
         self.assertIsNone(gm_cache)
+        self.assertNotIn(gm.url, self.engine.cache.databases)
         
         # delete GM
         with db_session:
@@ -7,6 +7,8 @@ Copyright (c) 2020-2021 Christian Glöckner
 License: MIT (see LICENSE for details)
 """
 
+import time
+
 from pony.orm import db_session
 
 import cache, orm
@@ -95,3 +97,143 @@ class GmCacheTest(EngineBaseTest):
         # can re-insert game
         game_cache = self.cache.insert(game1)
         self.assertIsNotNone(game_cache)
+        
+    def test_load(self):
+        self.cache.connect_db()
+        with db_session:
+            game = self.cache.db.Game(url='bar', gm_url='foo')
+            game.postSetup()
+        self.cache.evict('bar')
+        self.assertEqual(self.cache.games, dict())
+        self.assertNotIn('foo/bar', self.engine.checksums)
+        
+        # games are loaded on first access
+        game_cache = self.cache.getFromUrl('bar')
+        self.assertIsNotNone(game_cache)
+        self.assertEqual(game_cache.url, 'bar')
+        self.assertIn('foo/bar', self.engine.checksums)
+        self.assertEqual(self.cache.getFromUrl('bar'), game_cache)
+        
+        # unknown games are not loaded
+        self.assertIsNone(self.cache.getFromUrl('lol'))
+        self.assertEqual(list(self.cache.games), ['bar'])
+        
+    def test_evictIdle(self):
+        self.cache.connect_db()
+        with db_session:
+            for url in ['bar', 'lol']:
+                game = self.cache.db.Game(url=url, gm_url='foo')
+                game.postSetup()
+        bar_cache = self.cache.getFromUrl('bar')
+        lol_cache = self.cache.getFromUrl('lol')
+        bar_cache.insert('arthur', 'red', False)
+        
+        # recently used games are kept
+        now = time.time()
+        self.assertEqual(self.cache.evictIdle(now), 2)
+        
+        # idle games are evicted unless players are connected
+        later = now + self.engine.storage['idle_timeout'] + 1
+        self.assertEqual(self.cache.evictIdle(later), 1)
+        self.assertEqual(list(self.cache.games), ['bar'])
+        self.assertNotIn('foo/lol', self.engine.checksums)
+        self.assertIn('foo/bar', self.engine.checksums)
+        
+        # ... and loaded again if necessary
+        self.assertNotEqual(self.cache.getFromUrl('lol'), lol_cache)
+        
+        # evicting unknown games is ignored
+        self.cache.evict('more-crap')
+        
+    def test_sweep(self):
+        self.cache.connect_db()
+        self.engine.storage['idle_timeout'] = 0.01
+        with db_session:
+            game = self.cache.db.Game(url='bar', gm_url='foo')
+            game.postSetup()
+        self.assertIsNotNone(self.engine.cache.sweeper)
+        
+        # idle games are evicted in the background
+        time.sleep(0.05)
+        self.assertEqual(self.cache.games, dict())
+        self.assertIsNone(self.engine.cache.sweeper)
+        
+    def test_hasGame(self):
+        with db_session:
+            game = self.cache.db.Game(url='bar', gm_url='foo')
+            game.postSetup()
+        self.assertTrue(self.cache.hasGame('bar'))
+        self.assertFalse(self.cache.hasGame('lol'))
+        
+        # new games are added without querying the database
+        with db_session:
+            game = self.cache.db.Game(url='lol', gm_url='foo')
+            game.postSetup()
+        self.assertTrue(self.cache.hasGame('lol'))
+        
+        # deleted games are dropped
+        with db_session:
+            game = self.cache.db.Game.select(lambda g: g.url == 'bar').first()
+            game.preDelete()
+            game.delete()
+        self.assertFalse(self.cache.hasGame('bar'))
+        self.assertNotIn('bar', self.cache.games)
+        
+    def test_close_db(self):
+        self.cache.connect_db()
+        with db_session:
+            game = self.cache.db.Game(url='bar', gm_url='foo')
+            game.postSetup()
+        db = self.cache.db
+        
+        # games are unloaded, connections are closed and the mapping is dropped
+        self.cache.close_db()
+        self.assertEqual(self.cache.games, dict())
+        self.assertEqual(len(db.provider.pool.tracker.open), 0)
+        self.assertNotIn('foo', self.engine.cache.databases)
+        
+        # ... but the database can be used again
+        game_cache = self.cache.getFromUrl('bar')
+        self.assertIsNotNone(game_cache)
+        self.assertIsNot(self.cache.db, db)
+        self.assertIn('foo', self.engine.cache.databases)
+        
+        # connections used by a transaction are kept
+        db = self.cache.db
+        with db_session:
+            db.Game.select().count()
+            self.cache.close_db()
+            self.assertEqual(len(db.provider.pool.tracker.open), 1)
+            db.Game.select().count()
+        
+    def test_useDatabase(self):
+        self.engine.storage['max_databases'] = 1
+        with db_session:
+            gm = self.engine.main_db.GM(name='user456', url='lol', sid='654321')
+            gm.postSetup()
+        other = self.engine.cache.get(gm)
+        with db_session:
+            game = self.cache.db.Game(url='bar', gm_url='foo')
+            game.postSetup()
+            game = other.db.Game(url='bar', gm_url='lol')
+            game.postSetup()
+        
+        # least recently used database was closed
+        self.assertEqual(list(self.engine.cache.databases), ['lol'])
+        self.assertEqual(self.cache.games, dict())
+        
+        # databases of GMs with players are kept open
+        self.cache.getFromUrl('bar').insert('arthur', 'red', False)
+        other.getFromUrl('bar')
+        self.assertEqual(list(self.engine.cache.databases), ['foo', 'lol'])
+        
+        # recently requested GMs are kept open
+        self.cache.getFromUrl('bar').players.clear()
+        self.engine.storage['max_databases'] = 2
+        self.engine.cache.getFromUrl('foo')
+        self.assertEqual(list(self.engine.cache.databases), ['lol', 'foo'])
+        with db_session:
+            gm = self.engine.main_db.GM(name='user789', url='rofl', sid='987654')
+            gm.postSetup()
+        self.engine.cache.get(gm).connect_db()
+        self.assertEqual(list(self.engine.cache.databases), ['foo', 'rofl'])
@@ -0,0 +1,68 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, tempfile, pathlib, hashlib
+
+import utils
+
+class HashingApiTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir  = tempfile.TemporaryDirectory()
+        self.root    = pathlib.Path(self.tmpdir.name)
+        # @NOTE: small chunks to test reading multiple chunks
+        self.hashing = utils.HashingApi(threads=2, chunk_size=16)
+        
+    def tearDown(self):
+        del self.hashing
+        self.tmpdir.cleanup()
+        
+    def write(self, fname, content):
+        path = self.root / fname
+        with open(path, 'wb') as h:
+            h.write(content)
+        return path
+        
+    def test_getMd5(self):
+        content = b'some longer content to be hashed in chunks'
+        path = self.write('foo.png', content)
+        with open(path, 'rb') as h:
+            h.read(5)
+            # hash remaining content and rewind
+            md5 = self.hashing.getMd5(h)
+            self.assertEqual(h.tell(), 5)
+        self.assertEqual(md5, hashlib.md5(content[5:]).hexdigest())
+        
+    def test_saveWithMd5(self):
+        content = b'some longer content to be hashed in chunks'
+        src = self.write('foo.png', content)
+        with open(src, 'rb') as h:
+            h.read(5)
+            # copy remaining content and rewind
+            md5 = self.hashing.saveWithMd5(h, self.root / 'bar.png')
+            self.assertEqual(h.tell(), 5)
+        self.assertEqual(md5, hashlib.md5(content[5:]).hexdigest())
+        with open(self.root / 'bar.png', 'rb') as h:
+            self.assertEqual(h.read(), content[5:])
+        
+    def test_run(self):
+        self.assertEqual(self.hashing.run(max, 3, 7), 7)
+        with self.assertRaises(ValueError):
+            self.hashing.run(int, 'foo')
+        
+    def test_getMd5s(self):
+        contents = [b'', b'foo', b'bar' * 100]
+        paths = [self.write('{0}.png'.format(i), c) for i, c in enumerate(contents)]
+        md5s = self.hashing.getMd5s(paths)
+        self.assertEqual(md5s, [hashlib.md5(c).hexdigest() for c in contents])
+        self.assertEqual(self.hashing.getMd5s(list()), list())
+        
+    def test_getMd5s_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.hashing.getMd5s([self.root / 'missing.png'])
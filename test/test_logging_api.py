@@ -7,7 +7,7 @@ Copyright (c) 2020-2021 Christian Glöckner
 License: MIT (see LICENSE for details)
 """
 
-import unittest, tempfile, pathlib, os
+import unittest, tempfile, pathlib, os, sys, subprocess
 
 import utils
 
@@ -107,3 +107,66 @@ class LoggingApiTest(unittest.TestCase):
         self.assertLastLine('logins', str(data))
 
 
+
+    def test_queued(self):
+        # NOTE: manual setUp to make sure logs are cleared
+        
+        # create temporary directory
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root   = pathlib.Path(self.tmpdir.name)
+        
+        self.logging = utils.LoggingApi(
+            quiet        = True,
+            info_file    = self.root / 'info.log',
+            error_file   = self.root / 'error.log',
+            access_file  = self.root / 'access.log',
+            warning_file = self.root / 'warning.log',
+            logins_file  = self.root / 'logins.log',
+            auth_file    = self.root / 'auth.log',
+            queued       = True
+        )
+        self.logging.flush()
+        
+        # records are written by the background writer
+        self.logging.warning('hello warning world')
+        self.logging.logins('hello logins world')
+        self.assertEqual(self.logging.writer.queue.qsize(), 2)
+        utils.gevent.idle()
+        self.assertEqual(self.logging.writer.queue.qsize(), 0)
+        self.assertLastLine('warning', 'hello warning world')
+        self.assertLastLine('logins', 'hello logins world')
+        
+        # records can be written on demand (e.g. on shutdown)
+        self.logging.info('hello info world')
+        self.logging.flush()
+        self.assertLastLine('info', 'hello info world')
+        
+        # full queue is written synchronously
+        self.logging.writer.queue = utils.queue.Queue(2)
+        for i in range(5):
+            self.logging.error('hello error {0}'.format(i))
+        self.assertEqual(self.logging.writer.queue.qsize(), 1)
+        self.assertLastLine('error', 'hello error 3')
+        self.logging.flush()
+        self.assertLastLine('error', 'hello error 4')
+        
+        # filters of the target handler are applied
+        target = self.logging.error_logger.handlers[-1].target
+        target.addFilter(lambda record: 'secret' not in record.getMessage())
+        self.logging.error('hello secret')
+        self.logging.flush()
+        self.assertLastLine('error', 'hello error 4')
+        
+    def test_queued_atexit(self):
+        # pending records are written when the process exits
+        script = '\n'.join([
+            'import sys, pathlib, utils',
+            'root = pathlib.Path(sys.argv[1])',
+            'logging = utils.LoggingApi(True, root / "info.log", root / "error.log", root / "access.log",',
+            '    root / "warning.log", root / "logins.log", root / "auth.log", queued=True)',
+            'logging.warning("hello exit world")',
+            'sys.exit(0)'
+        ])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.run([sys.executable, '-c', script, str(self.root)], cwd=root, check=True)
+        self.assertLastLine('warning', 'hello exit world')
@@ -0,0 +1,59 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest
+
+import utils
+
+class MetricsApiTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.metrics = utils.MetricsApi()
+        
+    def tearDown(self):
+        del self.metrics
+        
+    def test_Histogram(self):
+        h = utils.Histogram([1, 10, 100])
+        for value in [0.5, 1, 2, 50, 100, 1000]:
+            h.record(value)
+        data = h.getData()
+        self.assertEqual(data['counts'], [2, 1, 2, 1])
+        self.assertEqual(data['count'], 6)
+        self.assertAlmostEqual(data['mean'], 1153.5 / 6)
+        self.assertEqual(data['max'], 1000)
+        
+        # empty histogram
+        data = utils.Histogram([1]).getData()
+        self.assertEqual(data['counts'], [0, 0])
+        self.assertEqual(data['mean'], 0.0)
+        
+    def test_recordAction(self):
+        self.metrics.recordAction('UPDATE', 'foo/bar', 0.002, 0.001, 100)
+        self.metrics.recordAction('UPDATE', 'foo/bar', 0.004, 0.0, 5000)
+        self.metrics.recordAction('ROLL', 'foo/baz', 0.1, 0.05, 50)
+        data = self.metrics.getData()
+        self.assertEqual(set(data['opids']), {'UPDATE', 'ROLL'})
+        self.assertEqual(data['opids']['UPDATE']['wall']['count'], 2)
+        self.assertAlmostEqual(data['opids']['UPDATE']['wall']['mean'], 3.0)
+        self.assertAlmostEqual(data['opids']['UPDATE']['db']['max'], 1.0)
+        self.assertEqual(data['opids']['UPDATE']['size']['max'], 5000)
+        # slowest game first
+        self.assertEqual(list(data['games']), ['foo/baz', 'foo/bar'])
+        
+        # games can be forgotten
+        self.metrics.forgetGame('foo/baz')
+        self.assertEqual(list(self.metrics.getData()['games']), ['foo/bar'])
+        
+    def test_recordBroadcast(self):
+        self.metrics.recordBroadcast(0.0005, 300)
+        data = self.metrics.getData()
+        self.assertEqual(data['broadcast']['wall']['count'], 1)
+        self.assertAlmostEqual(data['broadcast']['wall']['max'], 0.5)
+        self.assertEqual(data['broadcast']['size']['max'], 300)
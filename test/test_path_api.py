@@ -44,6 +44,7 @@ class PathApiTest(unittest.TestCase):
         self.paths.getMainDatabasePath() 
         self.paths.getSslPath()
         self.paths.getLogPath('foo')
+        self.paths.getGeoIpPath()
         
     def test_advanced_path_getter(self):
         # test GM(s) Path(s)
@@ -69,6 +70,12 @@ class PathApiTest(unittest.TestCase):
         self.assertEqual(md5_path.parts[-2], 'bar')
         self.assertEqual(md5_path.parts[-1], 'gm.md5')
         
+        # test thumbnail paths
+        thumb_path = self.paths.getThumbnailPath('foo', 'bar')
+        self.assertEqual(thumb_path.parts[-3], 'foo')
+        self.assertEqual(thumb_path.parts[-2], 'bar')
+        self.assertEqual(thumb_path.parts[-1], 'thumbnails')
+        
         # test game paths
         game_path = self.paths.getGamePath('foo', 'bar')
         self.assertEqual(game_path.parts[-2], 'foo')
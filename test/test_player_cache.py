@@ -7,11 +7,12 @@ Copyright (c) 2020-2021 Christian Glöckner
 License: MIT (see LICENSE for details)
 """
 
-import time, copy
+import time, copy, gevent
+from unittest import mock
 
 from pony.orm import db_session
 
-import cache, orm
+import cache, orm, codec
 
 from test.utils import EngineBaseTest, SocketDummy
 
@@ -20,6 +21,9 @@ class PlayerCacheTest(EngineBaseTest):
     def setUp(self):
         super().setUp()
         
+        # broadcast token updates immediately
+        self.engine.websocket['tick_rate'] = 0
+        
         with db_session:
             gm = self.engine.main_db.GM(name='user123', url='foo', sid='123456')
             gm.postSetup()
@@ -264,6 +268,172 @@ class PlayerCacheTest(EngineBaseTest):
         foobar = socket2.pop_send()
         self.assertEqual(foobar['foo'], 'bar')
         
+        # expect each player getting his encoding
+        player_cache2.codec = codec.negotiate(['compact'])
+        game_cache.broadcast({'OPID': 'UPDATE', 'tokens': [{'id': 5, 'posx': 1, 'posy': 2}]})
+        answer = socket1.pop_send()
+        self.assertEqual(answer['tokens'][0]['id'], 5)
+        answer = socket2.pop_send()
+        self.assertEqual(answer, ['UPDATE', [[5, None, 1, 2]]])
+        
+    def test_outbox(self):
+        class SlowSocketDummy(SocketDummy):
+            def send(self, s):
+                gevent.sleep(0.05)
+                SocketDummy.send(self, s)
+        
+        socket1 = SlowSocketDummy()
+        socket2 = SocketDummy()
+        
+        # insert players
+        game_cache = self.engine.cache.getFromUrl('foo').getFromUrl('bar')
+        player_cache1 = game_cache.insert('arthur', 'red', False)
+        player_cache1.socket = socket1
+        player_cache2 = game_cache.insert('bob', 'yellow', False)
+        player_cache2.socket = socket2
+        
+        # slow client does not delay broadcasting
+        start = time.time()
+        for i in range(3):
+            game_cache.broadcast({'foo': i})
+        self.assertLess(time.time() - start, 0.05)
+        for i in range(3):
+            self.assertEqual(socket2.pop_send()['foo'], i)
+        
+        # ... but receives all frames in order
+        gevent.sleep(0.2)
+        for i in range(3):
+            self.assertEqual(socket1.pop_send()['foo'], i)
+        
+        # overflowing frames can be dropped
+        self.engine.websocket['queue_size'] = 2
+        self.engine.websocket['overflow']   = 'drop'
+        socket3 = SocketDummy()
+        player_cache3 = game_cache.insert('gabriel', 'blue', False)
+        player_cache3.socket = socket3
+        for i in range(5):
+            player_cache3.write({'foo': i})
+        self.assertEqual(player_cache3.dropped, 3)
+        self.assertEqual(socket3.pop_send()['foo'], 0)
+        self.assertEqual(socket3.pop_send()['foo'], 1)
+        self.assertIsNone(socket3.pop_send())
+        self.assertTrue(player_cache3.isOnline())
+        
+        # ... or disconnect the client
+        self.engine.websocket['overflow'] = 'disconnect'
+        for i in range(5):
+            player_cache3.write({'foo': i})
+        self.assertFalse(player_cache3.isOnline())
+        self.assertTrue(socket3.closed)
+        self.assertIsNone(player_cache3.writer)
+        
+        # nothing is sent to a disconnected player
+        player_cache3.write({'foo': 'bar'})
+        self.assertIsNone(socket3.pop_send())
+        
+    def test_sendEphemeral(self):
+        socket1 = SocketDummy()
+        socket2 = SocketDummy()
+
+        # insert players
+        game_cache = self.engine.cache.getFromUrl('foo').getFromUrl('bar')
+        player_cache1 = game_cache.insert('arthur', 'red', False)
+        player_cache1.socket = socket1
+        player_cache2 = game_cache.insert('bob', 'yellow', False)
+        player_cache2.socket = socket2
+
+        # beacons are coalesced per sender and sent after state frames
+        for i in range(3):
+            game_cache.onBeacon(player_cache1, {'OPID': 'BEACON', 'x': i, 'y': i})
+            game_cache.onBeacon(player_cache2, {'OPID': 'BEACON', 'x': 10 + i, 'y': i})
+            game_cache.broadcast({'OPID': 'foo', 'i': i})
+        for i in range(3):
+            self.assertEqual(socket1.pop_send()['i'], i)
+        answer = socket1.pop_send()
+        self.assertEqual(answer['uuid'], player_cache1.uuid)
+        self.assertEqual(answer['x'], 2)
+        answer = socket1.pop_send()
+        self.assertEqual(answer['uuid'], player_cache2.uuid)
+        self.assertEqual(answer['x'], 12)
+        self.assertIsNone(socket1.pop_send())
+        self.assertEqual(player_cache1.discarded, 4)
+
+        # selections are coalesced as well
+        game_cache.onSelect(player_cache1, {'selected': [1]})
+        game_cache.onSelect(player_cache1, {'selected': [2, 3]})
+        answer = socket2.pop_send()
+        while answer['OPID'] != 'SELECT':
+            answer = socket2.pop_send()
+        self.assertEqual(answer['selected'], [2, 3])
+        self.assertIsNone(socket2.pop_send())
+
+        # oldest ephemeral frames are dropped if too many are pending
+        self.engine.websocket['ephemeral_size'] = 2
+        socket1.clearAll()
+        for i in range(4):
+            player_cache1.sendEphemeral(('BEACON', i), player_cache1.codec.encode({'OPID': 'BEACON', 'i': i}))
+        self.assertEqual(len(player_cache1.ephemeral), 2)
+        self.assertEqual(socket1.pop_send()['i'], 2)
+        self.assertEqual(socket1.pop_send()['i'], 3)
+        self.assertIsNone(socket1.pop_send())
+
+        # nothing is sent to a disconnected player
+        player_cache1.hangup()
+        player_cache1.sendEphemeral(('BEACON', 0), '{}')
+        self.assertEqual(len(player_cache1.ephemeral), 0)
+
+    def test_throttle(self):
+        game_cache = self.engine.cache.getFromUrl('foo').getFromUrl('bar')
+        player_cache = game_cache.insert('arthur', 'red', False)
+        self.engine.ratelimit['BEACON'] = [10, 2]
+        self.engine.ratelimit['UPDATE'] = [50, 2]
+        self.engine.ratelimit['ROLL']   = [0, 0]
+        del self.engine.ratelimit['MUSIC']
+
+        # exceeding ephemeral actions are dropped
+        allowed = [player_cache.throttle('BEACON') for i in range(4)]
+        self.assertEqual(allowed, [True, True, False, False])
+        self.assertEqual(player_cache.limited['dropped']['BEACON'], 2)
+        gevent.sleep(0.1)
+        self.assertTrue(player_cache.throttle('BEACON'))
+
+        # exceeding state actions are deferred
+        start = time.time()
+        allowed = [player_cache.throttle('UPDATE') for i in range(4)]
+        self.assertEqual(allowed, [True, True, True, True])
+        self.assertEqual(player_cache.limited['deferred']['UPDATE'], 2)
+        self.assertGreaterEqual(time.time() - start, 0.03)
+
+        # other actions are not limited
+        for i in range(10):
+            self.assertTrue(player_cache.throttle('ROLL'))
+            self.assertTrue(player_cache.throttle('MUSIC'))
+        self.assertEqual(sum(player_cache.limited['dropped'].values()), 2)
+        self.assertEqual(sum(player_cache.limited['deferred'].values()), 2)
+
+    def test_dispatch(self):
+        socket = SocketDummy()
+        game_cache = self.engine.cache.getFromUrl('foo').getFromUrl('bar')
+        player_cache = game_cache.insert('arthur', 'red', False)
+        player_cache.socket = socket
+        player_cache.read_size = 42
+
+        # latency of action and its broadcast is recorded
+        player_cache.dispatch('ROLL', game_cache.onRoll, {'OPID': 'ROLL', 'sides': 20})
+        self.assertEqual(socket.pop_send()['OPID'], 'ROLL')
+        data = self.engine.metrics.getData()
+        self.assertEqual(data['opids']['ROLL']['wall']['count'], 1)
+        self.assertGreater(data['opids']['ROLL']['db']['max'], 0.0)
+        self.assertLessEqual(data['opids']['ROLL']['db']['max'], data['opids']['ROLL']['wall']['max'])
+        self.assertEqual(data['opids']['ROLL']['size']['max'], 42)
+        self.assertEqual(data['broadcast']['wall']['count'], 1)
+        self.assertIn('foo/bar', data['games'])
+
+        # failing actions are recorded as well
+        with self.assertRaises(KeyError):
+            player_cache.dispatch('ROLL', game_cache.onRoll, {'OPID': 'ROLL'})
+        self.assertEqual(self.engine.metrics.opids['ROLL']['wall'].count, 2)
+
     def test_broadcastTokenUpdate(self):
         socket1 = SocketDummy()
         socket2 = SocketDummy()
@@ -386,6 +556,60 @@ class PlayerCacheTest(EngineBaseTest):
             self.assertEqual(data['OPID'], 'REFRESH')
             self.assertEqual(data['background'], None)
         
+    def test_sendRefresh(self):
+        socket1 = SocketDummy()
+        socket2 = SocketDummy()
+        
+        # insert players
+        gm_cache   = self.engine.cache.getFromUrl('foo')
+        game_cache = gm_cache.getFromUrl('bar')
+        player_cache1 = game_cache.insert('arthur', 'red', False)
+        player_cache1.socket = socket1
+        player_cache2 = game_cache.insert('bob', 'yellow', False)
+        player_cache2.socket = socket2
+        
+        with db_session:
+            game = gm_cache.db.Game.select(lambda g: g.url == 'bar').first()
+            active_id = game.active
+            other_id  = [s.id for s in game.scenes if s.id != active_id][0]
+        
+        # refresh of the active scene is serialized once
+        game_cache.sendRefresh([player_cache1], active_id)
+        game_cache.sendRefresh([player_cache2], active_id)
+        scene = game_cache.getScene()
+        frame = scene.getRefreshFrame(player_cache1.codec)
+        answer1 = socket1.pop_send()
+        answer2 = socket2.pop_send()
+        self.assertEqual(answer1, game_cache.fetchRefresh(active_id))
+        self.assertEqual(answer1, answer2)
+        self.assertIs(scene.getRefreshFrame(player_cache1.codec), frame)
+        
+        # ... once per codec
+        player_cache2.codec = codec.negotiate(['compact'])
+        game_cache.sendRefresh([player_cache2], active_id)
+        answer2 = socket2.pop_send()
+        self.assertEqual(answer2[0], 'REFRESH')
+        self.assertEqual(len(scene.frames), 2)
+        
+        # changing a token invalidates the frame
+        version = scene.version
+        token_id = [t['id'] for t in scene.getData() if t['size'] != -1][0]
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token_id, 'posx': 77, 'posy': 66}]})
+        socket1.clearAll()
+        socket2.clearAll()
+        self.assertGreater(scene.version, version)
+        game_cache.sendRefresh([player_cache1], active_id)
+        answer1 = socket1.pop_send()
+        tokens = {t['id']: t for t in answer1['tokens']}
+        self.assertEqual(tokens[token_id]['posx'], 77)
+        self.assertIsNot(scene.getRefreshFrame(player_cache1.codec), frame)
+        
+        # other scenes are served from the database
+        game_cache.sendRefresh([player_cache1], other_id)
+        answer1 = socket1.pop_send()
+        self.assertEqual(answer1, game_cache.fetchRefresh(other_id))
+        self.assertIsNone(answer1['background'])
+        
     def test_onPing(self):
         socket = SocketDummy()
         
@@ -464,9 +688,9 @@ class PlayerCacheTest(EngineBaseTest):
         
         self.assertEqual(answer1['OPID'], 'SELECT')
         self.assertEqual(answer1['color'], player_cache1.color)
-        self.assertEqual(answer1['selected'], player_cache1.selected)
+        self.assertEqual(set(answer1['selected']), player_cache1.selected)
         # expect player's selection being updated
-        self.assertEqual(player_cache1.selected, selected)
+        self.assertEqual(player_cache1.selected, set(selected))
         
         socket1.clearAll()
         socket2.clearAll()
@@ -484,9 +708,9 @@ class PlayerCacheTest(EngineBaseTest):
         
         self.assertEqual(answer1['OPID'], 'SELECT')
         self.assertEqual(answer1['color'], player_cache1.color)
-        self.assertEqual(answer1['selected'], player_cache1.selected)
+        self.assertEqual(set(answer1['selected']), player_cache1.selected)
         # expect player's selection being updated
-        self.assertEqual(player_cache1.selected, selected)
+        self.assertEqual(player_cache1.selected, set(selected))
         
     def test_onRange(self): 
         socket1 = SocketDummy()
@@ -579,7 +803,7 @@ class PlayerCacheTest(EngineBaseTest):
         socket3.clearAll()
 
         # trigger adding range query on empty space
-        player_cache1.selected = [145634]  
+        player_cache1.selected = {145634}
         query = {
             'adding' : True,
             'left'   : 0,
@@ -623,6 +847,36 @@ class PlayerCacheTest(EngineBaseTest):
         self.assertEqual(len(player_cache1.selected), 2)
         self.assertIn(145634,    player_cache1.selected)
         self.assertIn(inside.id, player_cache1.selected)
+        
+        socket1.clearAll()
+        socket2.clearAll()
+        socket3.clearAll()
+        
+        # repeated adding range query does not duplicate selections
+        game_cache.onRange(player_cache1, query) 
+        answer1 = socket1.pop_send()
+        self.assertEqual(len(answer1['selected']), 2)
+        self.assertEqual(player_cache1.selected, {145634, inside.id})
+        
+        # moved tokens are found at their new position
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': outside.id, 'posx': 110, 'posy': 140}]})
+        query['adding'] = False
+        game_cache.onRange(player_cache1, query)
+        self.assertEqual(player_cache1.selected, {inside.id, outside.id})
+        
+        # deleted tokens are not found anymore
+        game_cache.onDeleteToken(player_cache1, {'tokens': [outside.id]})
+        game_cache.onRange(player_cache1, query)
+        self.assertEqual(player_cache1.selected, {inside.id})
+        
+        # backgrounds are never selected
+        game_cache.onRange(player_cache1, {'adding': False, 'left': 0, 'top': 0, 'width': orm.MAX_SCENE_WIDTH, 'height': orm.MAX_SCENE_HEIGHT})
+        self.assertNotIn(game_cache.getScene().background, player_cache1.selected)
+        self.assertEqual(len(player_cache1.selected), len(game_cache.getScene().tokens) - 1)
+        
+        socket1.clearAll()
+        socket2.clearAll()
+        socket3.clearAll()
 
         # incomplete queries are ignored
         for missing in ['left', 'top', 'width', 'height']:
@@ -793,6 +1047,8 @@ class PlayerCacheTest(EngineBaseTest):
             token = gm_cache.db.Token(scene=scene, url='/test', posx=30, posy=15, size=20)
         
         def query_token(tid=token.id):
+            # @NOTE: token changes are written to the database lazily
+            game_cache.flush()
             with db_session:
                 game = gm_cache.db.Game.select(lambda g: g.url == 'bar').first()
                 last_update = game.timeid
@@ -846,6 +1102,13 @@ class PlayerCacheTest(EngineBaseTest):
         self.assertEqual(answer1, answer3)
         self.assertEqual(answer1['OPID'], 'UPDATE')
         self.assertEqual(len(answer1['tokens']), 1)
+        # expect only changed fields being sent
+        self.assertEqual(answer1['tokens'][0], {
+            'id'   : token.id,
+            'uuid' : player_cache1.uuid,
+            'posx' : 38,
+            'posy' : 43
+        })
         token = query_token()
         self.assertEqual(token.posx, 38)
         self.assertEqual(token.posy, 43)
@@ -1074,6 +1337,143 @@ class PlayerCacheTest(EngineBaseTest):
         socket2.clearAll()
         socket3.clearAll()
         
+    def test_tick(self):
+        socket1 = SocketDummy()
+        socket2 = SocketDummy()
+        
+        # insert players
+        game_cache = self.engine.cache.getFromUrl('foo').getFromUrl('bar')
+        player_cache1 = game_cache.insert('arthur', 'red', False)
+        player_cache1.socket = socket1
+        player_cache2 = game_cache.insert('bob', 'yellow', False)
+        player_cache2.socket = socket2
+        
+        with db_session:
+            scene  = self.active_scene()
+            token1 = self.engine.cache.getFromUrl('foo').db.Token(scene=scene, url='/test', posx=30, posy=15, size=20)
+            token2 = self.engine.cache.getFromUrl('foo').db.Token(scene=scene, url='/test', posx=50, posy=15, size=20)
+        
+        # updates within a tick are merged per token
+        self.engine.websocket['tick_rate'] = 20
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token1.id, 'posx': 100, 'posy': 100}]})
+        game_cache.onUpdateToken(player_cache2, {'changes': [{'id': token2.id, 'posx': 110, 'posy': 100}]})
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token1.id, 'posx': 120, 'posy': 100}]})
+        self.assertEqual(len(game_cache.pending), 2)
+        self.assertEqual(len(socket1.write_buffer), 0)
+        
+        # ... and broadcast as a single frame
+        gevent.sleep(0.1)
+        for s in [socket1, socket2]:
+            answer = s.pop_send()
+            self.assertEqual(answer['OPID'], 'UPDATE')
+            self.assertEqual(len(answer['tokens']), 2)
+            tokens = {t['id']: t for t in answer['tokens']}
+            self.assertEqual(tokens[token1.id]['posx'], 120)
+            self.assertNotIn('url', tokens[token1.id])
+            self.assertEqual(tokens[token1.id]['uuid'], player_cache1.uuid)
+            self.assertEqual(tokens[token2.id]['posx'], 110)
+            self.assertEqual(tokens[token2.id]['uuid'], player_cache2.uuid)
+            self.assertIsNone(s.pop_send())
+        self.assertIsNone(game_cache.ticker)
+        
+        # pending updates are sent before other frames
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token1.id, 'posx': 130, 'posy': 100}]})
+        game_cache.onDeleteToken(player_cache1, {'tokens': [token1.id]})
+        answer = socket2.pop_send()
+        self.assertEqual(answer['OPID'], 'UPDATE')
+        self.assertEqual(answer['tokens'][0]['posx'], 130)
+        answer = socket2.pop_send()
+        self.assertEqual(answer['OPID'], 'DELETE')
+        gevent.sleep(0.1)
+        self.assertIsNone(socket2.pop_send())
+        
+        # partial records of the same token and sender are merged field by field
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token2.id, 'posx': 115, 'posy': 100}]})
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token2.id, 'size': 60}]})
+        gevent.sleep(0.1)
+        answer = socket2.pop_send()
+        self.assertEqual(answer['tokens'], [{'id': token2.id, 'uuid': player_cache1.uuid, 'posx': 115, 'posy': 100, 'size': 60}])
+        self.assertIsNone(socket2.pop_send())
+        
+        # ... but another sender's changes are sent as a separate record
+        socket1.clearAll()
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token2.id, 'posx': 125, 'posy': 100}]})
+        game_cache.onUpdateToken(player_cache2, {'changes': [{'id': token2.id, 'size': 70}]})
+        gevent.sleep(0.1)
+        for s in [socket1, socket2]:
+            answer = s.pop_send()
+            self.assertEqual(answer['tokens'], [{'id': token2.id, 'uuid': player_cache1.uuid, 'posx': 125, 'posy': 100}])
+            answer = s.pop_send()
+            self.assertEqual(answer['tokens'], [{'id': token2.id, 'uuid': player_cache2.uuid, 'size': 70}])
+            self.assertIsNone(s.pop_send())
+        
+        # ticking can be disabled
+        self.engine.websocket['tick_rate'] = 0
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token2.id, 'posx': 140, 'posy': 100}]})
+        answer = socket2.pop_send()
+        self.assertEqual(answer['OPID'], 'UPDATE')
+        self.assertEqual(answer['tokens'][0]['posx'], 140)
+        
+    def test_flush(self):
+        socket1 = SocketDummy()
+        
+        # insert player
+        gm_cache   = self.engine.cache.getFromUrl('foo')
+        game_cache = gm_cache.getFromUrl('bar')
+        player_cache1 = game_cache.insert('arthur', 'red', False)
+        player_cache1.socket = socket1
+        
+        with db_session:
+            scene = self.active_scene()
+            token = gm_cache.db.Token(scene=scene, url='/test', posx=30, posy=15, size=20)
+        
+        # token update is applied in memory and broadcast immediately
+        self.engine.storage['flush_delay'] = 0.05
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token.id, 'posx': 200, 'posy': 100}]})
+        self.assertEqual(game_cache.getScene().get(token.id)['posx'], 200)
+        self.assertIn(token.id, game_cache.getScene().dirty)
+        
+        # ... but written to the database later
+        with db_session:
+            self.assertEqual(self.get_token(token.id).posx, 30)
+        answer = socket1.pop_send()
+        self.assertEqual(answer['tokens'][0]['posx'], 200)
+        gevent.sleep(0.1)
+        with db_session:
+            self.assertEqual(self.get_token(token.id).posx, 200)
+            self.assertEqual(self.get_token(token.id).posy, 100)
+        self.assertEqual(len(game_cache.getScene().dirty), 0)
+        self.assertIsNone(game_cache.flusher)
+        
+        # failed writes keep the changes for the next flush
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token.id, 'posx': 200, 'posy': 90}]})
+        with mock.patch.object(gm_cache.db.Token, 'select', side_effect=IOError('disk full')):
+            with self.assertRaises(IOError):
+                game_cache.flush()
+        self.assertIn(token.id, game_cache.getScene().dirty)
+        game_cache.flush()
+        with db_session:
+            self.assertEqual(self.get_token(token.id).posy, 90)
+        self.assertEqual(len(game_cache.getScene().dirty), 0)
+        
+        # locked tokens are not moved in memory either
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token.id, 'locked': True}]})
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token.id, 'posx': 10, 'posy': 10}]})
+        self.assertEqual(game_cache.getScene().get(token.id)['posx'], 200)
+        
+        # positions are forced onto the scene
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token.id, 'locked': False}]})
+        game_cache.onUpdateToken(player_cache1, {'changes': [{'id': token.id, 'posx': -5, 'posy': 9999}]})
+        self.assertEqual(game_cache.getScene().get(token.id)['posx'], 0)
+        self.assertEqual(game_cache.getScene().get(token.id)['posy'], orm.MAX_SCENE_HEIGHT)
+        
+        # last player leaving writes pending changes and frees the table
+        game_cache.logout(player_cache1)
+        self.assertIsNone(game_cache.scene)
+        with db_session:
+            self.assertEqual(self.get_token(token.id).posx, 0)
+            self.assertFalse(self.get_token(token.id).locked)
+        
     def test_onCreateToken(self):
         socket1 = SocketDummy()
         socket2 = SocketDummy()
@@ -1185,6 +1585,43 @@ class PlayerCacheTest(EngineBaseTest):
             for t in tokens:
                 if t.size == -1:
                     self.assertEqual(t.id, scene.backing.id)
+        
+        # multiple backgrounds: only the last one is kept
+        create_data = copy.deepcopy(default_data)
+        create_data['size'] = -1
+        create_data['urls'] = ['/foo/1.png', '/foo/2.png', '/foo/3.png']
+        game_cache.onCreateToken(player_cache1, create_data)
+        answer1 = socket1.pop_send()
+        socket2.clearAll()
+        socket3.clearAll()
+        self.assertEqual(len(answer1['tokens']), 1)
+        self.assertEqual(answer1['tokens'][0]['url'], '/foo/3.png')
+        self.assertEqual(answer1['tokens'][0]['size'], -1)
+        with db_session:
+            scene = self.active_scene()
+            self.assertEqual(scene.backing.id, answer1['tokens'][0]['id'])
+            self.assertEqual(gm_cache.db.Token.select(lambda t: t.scene == scene and t.size == -1).count(), 1)
+        self.assertEqual(game_cache.getScene().background, answer1['tokens'][0]['id'])
+        
+        # many tokens are created at once
+        with db_session:
+            self.purge_scene(self.active_scene())
+        game_cache.dropScene() # reload purged scene
+        create_data = copy.deepcopy(default_data)
+        create_data['urls'] = ['/foo/{0}.png'.format(i) for i in range(40)]
+        game_cache.onCreateToken(player_cache1, create_data)
+        answer1 = socket1.pop_send()
+        self.assertEqual(len(answer1['tokens']), 40)
+        self.assertIsNone(socket1.pop_send())
+        # first token became the background
+        self.assertEqual(answer1['tokens'][0]['size'], -1)
+        for t in answer1['tokens'][1:]:
+            self.assertEqual(t['size'], create_data['size'])
+        with db_session:
+            scene = self.active_scene()
+            self.assertEqual(scene.backing.id, answer1['tokens'][0]['id'])
+            self.assertEqual(len(scene.tokens), 40)
+        self.assertEqual(len(game_cache.getScene().tokens), 40)
     
     def test_onDeleteToken(self):
         socket1 = SocketDummy()
@@ -1273,6 +1710,20 @@ class PlayerCacheTest(EngineBaseTest):
         with db_session:
             t = gm_cache.db.Token.select(lambda tkn: tkn.id == t3.id).first()
         self.assertIsNotNone(t)
+        
+        # duplicate and vanished ids are ignored
+        ids = [t2.id, 67546345, t2.id, t1.id]
+        game_cache.onDeleteToken(player_cache1, {'tokens': ids})
+        answer1 = socket1.pop_send()
+        socket2.clearAll()
+        socket3.clearAll()
+        self.assertEqual(answer1['tokens'], [t2.id])
+        with db_session:
+            self.assertIsNone(gm_cache.db.Token.select(lambda tkn: tkn.id == t2.id).first())
+        
+        # nothing happens for no ids
+        game_cache.onDeleteToken(player_cache1, {'tokens': []})
+        self.assertIsNone(socket1.pop_send())
 
     def test_onBeacon(self):
         socket1 = SocketDummy()
@@ -1467,6 +1918,28 @@ class PlayerCacheTest(EngineBaseTest):
         min_dist = min(distances)
         max_dist = max(distances)
         self.assertLess(max_dist - min_dist, 10)
+        
+        socket1.clearAll()
+        socket2.clearAll()
+        socket3.clearAll()
+        
+        # vanished tokens are skipped but keep their place in the circle
+        data = {
+            'ids': [t1.id, 67546345, t4.id],
+            'posx': 100,
+            'posy': 80
+        }
+        game_cache.onCloneToken(player_cache1, data) 
+        answer1 = socket1.pop_send()
+        self.assertEqual(len(answer1['tokens']), 2)
+        positions = self.engine.cache.getFromUrl('foo').db.Token.getPosInCircle((100, 80), 3)
+        self.assertEqual(answer1['tokens'][0]['url'], 'test1')
+        self.assertEqual((answer1['tokens'][0]['posx'], answer1['tokens'][0]['posy']), positions[0])
+        self.assertEqual(answer1['tokens'][1]['url'], 'test4')
+        self.assertEqual((answer1['tokens'][1]['posx'], answer1['tokens'][1]['posy']), positions[2])
+        # clones are part of the active scene's table
+        for tdata in answer1['tokens']:
+            self.assertIsNotNone(game_cache.getScene().get(tdata['id']))
     
     def test_onCreateScene(self):
         socket1 = SocketDummy()
@@ -1772,6 +2245,11 @@ class PlayerCacheTest(EngineBaseTest):
                 self.assertTrue(t.locked) 
                 self.assertEqual(t.text, 'foo')
                 self.assertEqual(t.color, '#FF0000')
+            # expect REFRESH to contain exactly the cloned tokens
+            self.assertEqual(len(active.tokens), 3)
+            expect = sorted([t.to_dict() for t in active.tokens], key=lambda t: t['id'])
+            self.assertEqual(answer1['tokens'], expect)
+            self.assertIsNone(answer1['background'])
         # ... but no background
         self.assertIsNone(active.backing)
         # expect scene at end of the order list
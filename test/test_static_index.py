@@ -0,0 +1,65 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, tempfile, pathlib, gzip, hashlib
+
+import utils
+
+class StaticIndexTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.first  = pathlib.Path(self.tmpdir.name) / 'first'
+        self.second = pathlib.Path(self.tmpdir.name) / 'second'
+        self.first.mkdir()
+        self.second.mkdir()
+        
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        
+    def write(self, root, fname, content):
+        with open(root / fname, 'wb') as h:
+            h.write(content)
+        
+    def test_init(self):
+        self.write(self.first, 'constants.js', b'var FOO = 1;')
+        self.write(self.second, 'constants.js', b'var FOO = 2;')
+        self.write(self.second, 'logo.png', b'png')
+        (self.second / 'subdir').mkdir()
+        index = utils.StaticIndex([self.first, self.second, self.first / 'missing'])
+        
+        # earlier roots shadow later roots
+        static = index.get('constants.js')
+        self.assertEqual(static.root, str(self.first))
+        self.assertEqual(static.md5, hashlib.md5(b'var FOO = 1;').hexdigest())
+        self.assertIn('javascript', static.mimetype)
+        self.assertEqual(gzip.decompress(static.variants['gzip']), b'var FOO = 1;')
+        
+        # only text files are compressed
+        static = index.get('logo.png')
+        self.assertEqual(static.root, str(self.second))
+        self.assertEqual(static.variants, dict())
+        self.assertIsNone(static.getEncoding({'gzip'}))
+        
+        self.assertIsNone(index.get('subdir'))
+        self.assertIsNone(index.get('missing.js'))
+        
+    def test_parseEncodings(self):
+        parse = utils.StaticIndex.parseEncodings
+        self.assertEqual(parse(''), set())
+        self.assertEqual(parse('gzip, deflate, br'), {'gzip', 'deflate', 'br'})
+        self.assertEqual(parse('gzip;q=0.5, br;q=0, x;q=foo'), {'gzip'})
+        
+    def test_getEncoding(self):
+        static = utils.StaticFile('/', 'foo.js', 'abc')
+        static.variants['gzip'] = b''
+        self.assertEqual(static.getEncoding({'gzip', 'br'}), 'gzip')
+        static.variants['br'] = b''
+        self.assertEqual(static.getEncoding({'gzip', 'br'}), 'br')
+        self.assertIsNone(static.getEncoding({'deflate'}))
@@ -0,0 +1,64 @@
+#!/usr/bin/python3 
+# -*- coding: utf-8 -*- 
+"""
+https://github.com/cgloeckner/pyvtt/
+
+Copyright (c) 2020-2021 Christian Glöckner
+License: MIT (see LICENSE for details)
+"""
+
+import unittest, tempfile, pathlib, os, time
+
+from PIL import Image
+
+import utils
+
+class ThumbnailApiTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root   = pathlib.Path(self.tmpdir.name)
+        self.thumbs = self.root / 'thumbnails'
+        self.api    = utils.ThumbnailApi(width=64, threads=1)
+        
+    def tearDown(self):
+        del self.api
+        self.tmpdir.cleanup()
+        
+    def makeImage(self, img_id, size, mode='RGB'):
+        path = self.root / '{0}.png'.format(img_id)
+        Image.new(mode=mode, size=size).save(path, 'PNG')
+        return path
+        
+    def test_call(self):
+        src = self.makeImage(3, (256, 128))
+        fname = self.api(src, self.thumbs, 3)
+        self.assertEqual(fname, self.api.getFilename(3))
+        with Image.open(self.thumbs / fname) as img:
+            self.assertEqual(img.size, (64, 32))
+        
+        # cached thumbnail is reused
+        mtime = os.stat(self.thumbs / fname).st_mtime_ns
+        self.assertEqual(self.api(src, self.thumbs, 3), fname)
+        self.assertEqual(os.stat(self.thumbs / fname).st_mtime_ns, mtime)
+        
+        # outdated thumbnail is recreated
+        self.makeImage(3, (128, 128))
+        os.utime(src, ns=(mtime + 10**9, mtime + 10**9))
+        self.assertEqual(self.api(src, self.thumbs, 3), fname)
+        with Image.open(self.thumbs / fname) as img:
+            self.assertEqual(img.size, (64, 64))
+        
+    def test_small_images(self):
+        # small or palette images are not upscaled
+        src = self.makeImage(0, (16, 8), mode='P')
+        fname = self.api(src, self.thumbs, 0)
+        with Image.open(self.thumbs / fname) as img:
+            self.assertEqual(img.size, (16, 8))
+        
+    def test_invalid_images(self):
+        self.assertIsNone(self.api(self.root / '7.png', self.thumbs, 7))
+        with open(self.root / '8.png', 'w') as h:
+            h.write('not an image')
+        self.assertIsNone(self.api(self.root / '8.png', self.thumbs, 8))
+        self.assertEqual(os.listdir(self.thumbs), list())
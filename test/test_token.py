@@ -215,4 +215,12 @@ class TokenTest(unittest.TestCase):
         origin = (456, 123)
         p = self.db.Token.getPosByDegree(origin, 0, 1)
         self.assertEqual(p, origin)
+        
+    def test_getPosInCircle(self):
+        origin = (100, 100)
+        p = self.db.Token.getPosInCircle(origin, 4)
+        self.assertEqual(p, [self.db.Token.getPosByDegree(origin, k, 4) for k in range(4)])
+        
+        self.assertEqual(self.db.Token.getPosInCircle(origin, 1), [origin])
+        self.assertEqual(self.db.Token.getPosInCircle(origin, 0), [])
 
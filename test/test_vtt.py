@@ -634,13 +634,13 @@ class VttTest(EngineBaseTest):
         expect = {
             "urls": ["/asset/arthur/test-game-1/0.png"]
         }
-        self.assertEqual(ret.body, json.dumps(expect).encode('utf-8'))
+        self.assertEqual(json.loads(ret.body), expect)
         
         # non-GM can hashtest for missing assets
         ret = self.app.post('/vtt/hashtest/arthur/test-game-1', {'hashs[]': ['deadbeef']}, xhr=True)
         self.assertEqual(ret.status_int, 200)
         expect = {"urls": []}
-        self.assertEqual(ret.body, json.dumps(expect).encode('utf-8'))
+        self.assertEqual(json.loads(ret.body), expect)
 
     def test_vtt_api_queries(self):
         ret = self.app.get('/vtt/api/users', expect_errors=True)
@@ -648,6 +648,11 @@ class VttTest(EngineBaseTest):
         
         ret = self.app.get('/vtt/api/logins', expect_errors=True)
         self.assertEqual(ret.status_int, 200)
+        
+        ret = self.app.get('/vtt/api/latency', expect_errors=True)
+        self.assertEqual(ret.status_int, 200)
+        self.assertIn('opids', ret.json)
+        self.assertIn('broadcast', ret.json)
 
         # auth0 analysis is not routed when not loaded
         ret = self.app.get('/vtt/api/auth0', expect_errors=True)
@@ -665,6 +670,18 @@ class VttTest(EngineBaseTest):
         gm_sid = self.app.cookies['session']
         self.app.reset()
         
+        # games of GMs with open databases are counted
+        ret = self.app.get('/vtt/api/users')
+        self.assertEqual(ret.json['gms']['open'], 1)
+        self.assertEqual(ret.json['games']['total'], 1)
+        
+        # ... but closed databases are not opened
+        self.engine.cache.getFromUrl('arthur').close_db()
+        ret = self.app.get('/vtt/api/users')
+        self.assertEqual(ret.json['gms']['open'], 0)
+        self.assertEqual(ret.json['games']['total'], 0)
+        self.assertEqual(len(self.engine.cache.databases), 0)
+        
         ret = self.app.get('/vtt/api/games-list/arthur', expect_errors=True)
         self.assertEqual(ret.status_int, 200)
 
@@ -728,6 +745,35 @@ class VttTest(EngineBaseTest):
         ret = self.app.get('/vtt/shard')
         self.assertEqual(ret.status_int, 200)
     
+    def test_static_encoding(self):
+        # javascript is sent precompressed
+        ret = self.app.get('/static/assets.js', headers={'Accept-Encoding': 'deflate, gzip;q=0.5'})
+        self.assertEqual(ret.status_int, 200)
+        self.assertEqual(ret.headers['Vary'], 'Accept-Encoding')
+        self.assertIn('javascript', ret.content_type)
+        # @NOTE: webtest decodes the body and drops Content-Encoding
+        etag = ret.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        with open('static/assets.js', 'rb') as h:
+            self.assertEqual(ret.body, h.read())
+        ret = self.app.get('/static/assets.js', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(ret.status_int, 304)
+        
+        # ... unless the client doesn't accept it
+        ret = self.app.get('/static/assets.js', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertEqual(ret.status_int, 200)
+        self.assertFalse(ret.headers['ETag'].endswith('-gzip"'))
+        
+        # images are not compressed
+        ret = self.app.get('/static/d20.png', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(ret.status_int, 200)
+        self.assertFalse(ret.headers['ETag'].endswith('-gzip"'))
+        self.assertEqual(ret.headers['Cache-Control'], 'no-cache')
+        
+        # versioned urls are cached
+        ret = self.app.get('/static/d20.png?v={0}'.format(self.engine.version))
+        self.assertIn('immutable', ret.headers['Cache-Control'])
+        
     def test_static_fname(self):
         # cannot query non existing files
         ret = self.app.get('/static/fantasy-file.txt', expect_errors=True)
@@ -772,6 +818,46 @@ class VttTest(EngineBaseTest):
         ret = self.app.get('/static/sub/test.txt', expect_errors=True)  
         self.assertEqual(ret.status_int, 404)
 
+    def test_thumbnail(self):
+        # register arthur
+        ret = self.app.post('/vtt/join', {'gmname': 'arthur'}, xhr=True)
+        self.assertEqual(ret.status_int, 200)
+        
+        # create game with large background
+        img_large = makeImage(1024, 576)
+        ret = self.app.post('/vtt/import-game/test-game-1',
+            upload_files=[('file', 'test.png', img_large)], xhr=True) 
+        self.assertEqual(ret.status_int, 200)
+        self.app.reset()
+        
+        # game thumbnail redirects to its active scene's thumbnail
+        ret = self.app.get('/vtt/thumbnail/arthur/test-game-1')
+        self.assertEqual(ret.status_int, 302)
+        
+        # scene thumbnail is downscaled
+        ret = ret.follow()
+        self.assertEqual(ret.status_int, 200)
+        self.assertEqual(ret.content_type, self.engine.thumbnail_api.mimetype)
+        self.assertEqual(ret.headers['Cache-Control'], 'no-cache')
+        with tempfile.NamedTemporaryFile('wb') as h:
+            h.write(ret.body)
+            h.flush()
+            with Image.open(h.name) as img:
+                self.assertEqual(img.size, (self.engine.thumbnails['width'], 144))
+        
+        # thumbnail is cached on disk
+        root = self.engine.paths.getThumbnailPath('arthur', 'test-game-1')
+        self.assertEqual(len(os.listdir(root)), 1)
+        ret = self.app.get(ret.request.path)
+        self.assertEqual(ret.status_int, 200)
+        self.assertEqual(len(os.listdir(root)), 1)
+        
+        # cannot query unknown games
+        ret = self.app.get('/vtt/thumbnail/arthur/test-game-2', expect_errors=True)
+        self.assertEqual(ret.status_int, 404)
+        ret = self.app.get('/vtt/thumbnail/carlos/test-game-1/1', expect_errors=True)
+        self.assertEqual(ret.status_int, 404)
+
     def test_token_fname(self):
         # register arthur
         ret = self.app.post('/vtt/join', {'gmname': 'arthur'}, xhr=True)
@@ -796,6 +882,13 @@ class VttTest(EngineBaseTest):
         ret = self.app.get('/asset/arthur/test-game-1/0.png')
         self.assertEqual(ret.status_int, 200)
         self.assertEqual(ret.content_type, 'image/png')
+        self.assertEqual(ret.headers['Cache-Control'], 'no-cache')
+        
+        # image is tagged by its checksum
+        md5 = self.engine.checksums['arthur/test-game-1'].getDigest(0)
+        self.assertEqual(ret.headers['ETag'], '"{0}"'.format(md5))
+        ret = self.app.get('/asset/arthur/test-game-1/0.png', headers={'If-None-Match': '"{0}"'.format(md5)})
+        self.assertEqual(ret.status_int, 304)
         ret = self.app.get('/asset/arthur/test-game-1/1.png')
         self.assertEqual(ret.status_int, 200)
         self.assertEqual(ret.content_type, 'image/png')
@@ -1275,6 +1368,7 @@ class VttTest(EngineBaseTest):
         for slot_id in data['music']:
             ret = self.app.get('/asset/arthur/test-game-1/{0}.mp3?update=0815'.format(slot_id))
             self.assertEqual(ret.status_int, 200)
+            self.assertEqual(ret.headers['Cache-Control'], 'no-cache')
 
         # cannot query invalid slot
         ret = self.app.get('/asset/arthur/test-game-1/14.mp3?update=0815', expect_errors=True)
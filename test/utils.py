@@ -9,7 +9,7 @@ License: MIT (see LICENSE for details)
 
 import unittest, webtest, sys, tempfile, pathlib, json, time
 
-import bottle
+import bottle, gevent
 from geventwebsocket.exceptions import WebSocketError
 
 from utils import PathApi
@@ -57,9 +57,14 @@ class SocketDummy(object):
     """
     
     def __init__(self):
-        self.clearAll()
+        self.reset()
         
     def clearAll(self):
+        # let writer greenlets finish pending frames
+        gevent.idle()
+        self.reset()
+        
+    def reset(self):
         self.read_buffer  = list()
         self.write_buffer = list()
         
@@ -86,6 +91,8 @@ class SocketDummy(object):
         self.write_buffer.append(s)
         
     def pop_send(self):
+        # let writer greenlets send pending frames
+        gevent.idle()
         if len(self.write_buffer) > 0:
             return json.loads(self.write_buffer.pop(0))
         return None
@@ -7,12 +7,14 @@ Copyright (c) 2020-2021 Christian Glöckner
 License: MIT (see LICENSE for details)
 """
 
-import sys, os, logging, smtplib, pathlib, tempfile, traceback, uuid, random, base64, json
+import sys, os, time, atexit, logging, smtplib, pathlib, tempfile, traceback, uuid, random, base64, json, csv, bisect, ipaddress, collections, hashlib, gzip, mimetypes
 
 import bottle
 import patreon         
+import requests
+import gevent, gevent.threadpool
 
-from gevent import lock
+from gevent import lock, queue
 
 from google.oauth2 import id_token
 from google_auth_oauthlib.flow import Flow
@@ -21,6 +23,13 @@ import google.auth.transport.requests
 from authlib.integrations.requests_client import OAuth2Session
 from authlib.oidc.core import CodeIDToken
 from authlib.jose import jwt
+from PIL import Image, UnidentifiedImageError, features
+
+# optional brotli compression for static files
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 
 __author__ = 'Christian Glöckner'
@@ -102,6 +111,375 @@ class PathApi(object):
     def getMd5Path(self, gm, game):
         return self.getGamePath(gm, game) / 'gm.md5'
 
+    def getThumbnailPath(self, gm, game):
+        return self.getGamePath(gm, game) / 'thumbnails'
+
+    def getGeoIpPath(self):
+        return self.root / 'geoip.csv'
+
+
+# ---------------------------------------------------------------------
+
+class ChecksumIndex(object):
+    """ Checksums of a game's images, which can be queried by digest and
+    by image id. Each entry also stores the file's size and mtime, so only
+    new or modified files need to be hashed again. The index is saved as a
+    manifest file: image id => [size, mtime_ns, digest].
+    """
+
+    def __init__(self):
+        self.files   = dict() # image id => (size, mtime_ns, digest)
+        self.digests = dict() # digest => image id
+        self.dirty   = False
+
+    # --- dict-like access via digest ---------------------------------
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __iter__(self):
+        return iter(self.digests)
+
+    def __contains__(self, digest):
+        return digest in self.digests
+
+    def __getitem__(self, digest):
+        return self.digests[digest]
+
+    def get(self, digest, default=None):
+        return self.digests.get(digest, default)
+
+    def keys(self):
+        return self.digests.keys()
+
+    def values(self):
+        return self.digests.values()
+
+    def items(self):
+        return self.digests.items()
+
+    # --- index maintenance -------------------------------------------
+
+    def add(self, img_id, digest, stat):
+        """ Add or replace the image's checksum using the file's stat. """
+        self.remove(img_id)
+        self.files[img_id]    = (stat.st_size, stat.st_mtime_ns, digest)
+        self.digests[digest] = img_id
+        self.dirty = True
+
+    def remove(self, img_id):
+        """ Remove the image's checksum (if known). """
+        entry = self.files.pop(img_id, None)
+        if entry is None:
+            return
+        if self.digests.get(entry[2]) == img_id:
+            del self.digests[entry[2]]
+        self.dirty = True
+
+    def getDigest(self, img_id):
+        entry = self.files.get(img_id)
+        if entry is not None:
+            return entry[2]
+
+    def scan(self, root, images):
+        """ Compare the index with the game's images, given as a dict of
+        image id => stat (see AssetIndex). Entries of removed images are
+        dropped. Returns a list of (img_id, path, stat) for all images
+        which need to be hashed.
+        """
+        stale = list()
+        for img_id, stat in images.items():
+            known = self.files.get(img_id)
+            if known is None or known[:2] != (stat.st_size, stat.st_mtime_ns):
+                stale.append((img_id, os.path.join(root, '{0}.png'.format(img_id)), stat))
+
+        for img_id in set(self.files) - set(images):
+            self.remove(img_id)
+
+        return stale
+
+    # --- manifest file -----------------------------------------------
+
+    def load(self, path):
+        """ Load manifest file (if present). """
+        if not os.path.exists(path):
+            # @NOTE: create manifest even if there are no images
+            self.dirty = True
+            return
+        with open(path, 'r') as handle:
+            data = json.load(handle)
+        for key, value in data.items():
+            if isinstance(value, int):
+                # @NOTE: legacy format (digest => image id) without stat,
+                # hence those images are hashed again by the next scan
+                self.dirty = True
+                continue
+            size, mtime_ns, digest = value
+            img_id = int(key)
+            self.files[img_id]    = (size, mtime_ns, digest)
+            self.digests[digest] = img_id
+
+    def save(self, path):
+        """ Atomically write manifest file if the index was modified. """
+        if not self.dirty:
+            return False
+        data = {str(img_id): list(entry) for img_id, entry in self.files.items()}
+        tmp_path = '{0}.tmp'.format(path)
+        with open(tmp_path, 'w') as handle:
+            json.dump(data, handle)
+        os.replace(tmp_path, path)
+        self.dirty = False
+        return True
+
+
+# ---------------------------------------------------------------------
+
+class AssetIndex(object):
+    """ In-memory listing of a game's directory: images and music slots.
+    It is populated by a single scan and kept up to date by all code
+    paths which add or remove files, so the directory isn't listed
+    again.
+    """
+
+    def __init__(self):
+        self.images  = dict() # image id => stat
+        self.music   = dict() # slot id => stat
+        self.next_id = 0      # next free image id
+
+    def scan(self, root):
+        """ Replace the index by the current content of the directory. """
+        self.images.clear()
+        self.music.clear()
+        with os.scandir(root) as entries:
+            for entry in entries:
+                name, ext = os.path.splitext(entry.name)
+                if not name.isdigit():
+                    continue
+                if ext == '.png':
+                    self.images[int(name)] = entry.stat()
+                elif ext == '.mp3':
+                    self.music[int(name)] = entry.stat()
+        self.next_id = max(self.images) + 1 if len(self.images) > 0 else 0
+
+    def addImage(self, img_id, stat):
+        self.images[img_id] = stat
+        self.next_id = max(self.next_id, img_id + 1)
+
+    def removeImage(self, img_id):
+        self.images.pop(img_id, None)
+        if img_id + 1 == self.next_id:
+            # @NOTE: gaps are ignored, so the next id is based on the
+            # highest remaining id
+            self.next_id = max(self.images) + 1 if len(self.images) > 0 else 0
+
+    def addMusic(self, slot_id, stat):
+        self.music[slot_id] = stat
+
+    def removeMusic(self, slot_id):
+        self.music.pop(slot_id, None)
+
+    def getImages(self):
+        """ Return sorted list of all image filenames. """
+        return ['{0}.png'.format(img_id) for img_id in sorted(self.images)]
+
+    def getSlots(self):
+        """ Return sorted list of all used music slots. """
+        return sorted(self.music)
+
+    def getMusic(self):
+        """ Return sorted list of all music filenames. """
+        return ['{0}.mp3'.format(slot_id) for slot_id in self.getSlots()]
+
+
+# ---------------------------------------------------------------------
+
+class StaticIndex(object):
+    """ Filename => file lookup for the static directories, which are
+    scanned once. Files in earlier roots shadow files in later roots.
+    Text files are compressed once, so they can be sent precompressed.
+    """
+
+    compressible = ['.js', '.css', '.html', '.svg', '.json', '.txt', '.map']
+
+    def __init__(self, roots):
+        self.files = dict() # fname => StaticFile
+        for root in reversed(roots):
+            if not os.path.isdir(root):
+                continue
+            with os.scandir(root) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        self.files[entry.name] = self.load(root, entry.name)
+
+    def load(self, root, fname):
+        path = os.path.join(root, fname)
+        with open(path, 'rb') as handle:
+            content = handle.read()
+        static = StaticFile(str(root), fname, hashlib.md5(content).hexdigest())
+        static.mimetype = mimetypes.guess_type(fname)[0]
+        if static.mimetype is not None and (static.mimetype.startswith('text/') or static.mimetype == 'application/javascript'):
+            static.mimetype += '; charset=UTF-8'
+        if os.path.splitext(fname)[1] in self.compressible:
+            static.variants['gzip'] = gzip.compress(content, compresslevel=9)
+            if brotli is not None:
+                static.variants['br'] = brotli.compress(content)
+        return static
+
+    def get(self, fname):
+        return self.files.get(fname)
+
+    @staticmethod
+    def parseEncodings(header):
+        """ Return set of encodings accepted by the Accept-Encoding
+        header. """
+        accepted = set()
+        for token in header.split(','):
+            parts = token.strip().split(';')
+            q = 1.0
+            for param in parts[1:]:
+                key, _, value = param.strip().partition('=')
+                if key == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            encoding = parts[0].strip().lower()
+            if encoding != '' and q > 0.0:
+                accepted.add(encoding)
+        return accepted
+
+
+class StaticFile(object):
+    """ Static file with its checksum and precompressed variants. """
+
+    def __init__(self, root, fname, md5):
+        self.root     = root
+        self.fname    = fname
+        self.md5      = md5
+        self.mimetype = None
+        self.variants = dict() # encoding => compressed content
+
+    def getEncoding(self, accepted):
+        """ Return best precompressed encoding or None. """
+        for encoding in ['br', 'gzip']:
+            if encoding in self.variants and encoding in accepted:
+                return encoding
+
+
+# ---------------------------------------------------------------------
+
+class HashingApi(object):
+    """ Creates MD5 checksums of files using a threadpool, so the hub is
+    not blocked while hashing. Because hashlib releases the GIL for
+    larger chunks, multiple files are hashed in parallel. """
+
+    def __init__(self, threads=4, chunk_size=1 << 20):
+        self.pool       = gevent.threadpool.ThreadPool(threads)
+        self.chunk_size = chunk_size
+
+    def hashHandle(self, handle):
+        """ Return MD5 of the file handle's remaining content (blocking).
+        The handle is rewound after reading. """
+        hash_md5 = hashlib.md5()
+        offset = handle.tell()
+        for chunk in iter(lambda: handle.read(self.chunk_size), b""):
+            hash_md5.update(chunk)
+        handle.seek(offset)
+        return hash_md5.hexdigest()
+
+    def hashFile(self, path):
+        """ Return MD5 of the given file (blocking). """
+        with open(path, 'rb') as handle:
+            return self.hashHandle(handle)
+
+    def copyHandle(self, handle, path):
+        """ Write the file handle's remaining content to the given path
+        while hashing it (blocking). Returns the MD5. The handle is
+        rewound after reading. """
+        hash_md5 = hashlib.md5()
+        offset = handle.tell()
+        with open(path, 'wb') as dst:
+            for chunk in iter(lambda: handle.read(self.chunk_size), b""):
+                hash_md5.update(chunk)
+                dst.write(chunk)
+        handle.seek(offset)
+        return hash_md5.hexdigest()
+
+    def run(self, func, *args):
+        """ Run blocking func on the threadpool. Only the calling greenlet
+        waits for the result. """
+        return self.pool.spawn(func, *args).get()
+
+    def getMd5(self, handle):
+        """ Return MD5 of the given file handle. """
+        return self.run(self.hashHandle, handle)
+
+    def saveWithMd5(self, handle, path):
+        """ Save the given file handle to path and return its MD5, which
+        is created while writing. """
+        return self.run(self.copyHandle, handle, path)
+
+    def getMd5s(self, paths):
+        """ Return list of MD5s of all given files, which are hashed in
+        parallel. """
+        results = [self.pool.spawn(self.hashFile, path) for path in paths]
+        return [r.get() for r in results]
+
+
+# ---------------------------------------------------------------------
+
+class ThumbnailApi(object):
+    """ Creates downscaled copies of images using a threadpool, so the hub
+    is not blocked while decoding. Thumbnails are cached on disk and
+    recreated if the image is newer. """
+
+    def __init__(self, width=256, threads=2):
+        self.width = width
+        self.pool  = gevent.threadpool.ThreadPool(threads)
+        # @NOTE: WebP is much smaller, but depends on Pillow's build
+        if features.check('webp'):
+            self.format, self.ext, self.mimetype = 'WEBP', 'webp', 'image/webp'
+        else:
+            self.format, self.ext, self.mimetype = 'PNG', 'png', 'image/png'
+
+    def getFilename(self, img_id):
+        return '{0}_{1}.{2}'.format(img_id, self.width, self.ext)
+
+    def create(self, src_path, dst_path):
+        """ Create thumbnail of the image (blocking). """
+        with Image.open(src_path) as img:
+            if img.mode not in ['RGB', 'RGBA']:
+                img = img.convert('RGBA')
+            if img.width > self.width:
+                height = max(1, round(img.height * self.width / img.width))
+                img = img.resize((self.width, height))
+            tmp_path = '{0}.tmp'.format(dst_path)
+            img.save(tmp_path, self.format)
+        os.replace(tmp_path, dst_path)
+
+    def __call__(self, src_path, root, img_id):
+        """ Return filename of the image's thumbnail inside root, which is
+        created if necessary. Returns None if the image cannot be read.
+        """
+        fname    = self.getFilename(img_id)
+        dst_path = os.path.join(root, fname)
+        try:
+            src_mtime = os.stat(src_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        try:
+            if os.stat(dst_path).st_mtime_ns >= src_mtime:
+                return fname
+        except FileNotFoundError:
+            pass
+        
+        os.makedirs(root, exist_ok=True)
+        try:
+            self.pool.spawn(self.create, src_path, dst_path).get()
+        except (UnidentifiedImageError, OSError):
+            return None
+        return fname
+
 
 # ---------------------------------------------------------------------
 
@@ -455,10 +833,73 @@ class PatreonApi(BaseLoginApi):
 
 # ---------------------------------------------------------------------
 
+class LogWriter(object):
+    """ Writes log records in batches using a background greenlet. The
+    queue is bounded: if it is full, all pending records are written
+    synchronously before the new one is enqueued, so no record is lost.
+    """
+    
+    def __init__(self, queue_size=4096, batch_size=256):
+        self.queue      = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.greenlet   = None
+        
+    def push(self, handler, record):
+        """ Enqueue record to be emitted by the given handler. """
+        if self.queue.full():
+            self.flush()
+        self.queue.put_nowait((handler, record))
+        if self.greenlet is None:
+            self.greenlet = gevent.spawn(self.run)
+        
+    def write(self, batch):
+        """ Emit all records and flush each handler once. """
+        handlers = set()
+        for handler, record in batch:
+            # @NOTE: handle() applies the handler's filters and lock
+            handler.handle(record)
+            handlers.add(handler)
+        for handler in handlers:
+            handler.flush()
+        
+    def run(self):
+        """ Write batches until the queue is empty. """
+        while not self.queue.empty():
+            n = min(self.batch_size, self.queue.qsize())
+            self.write([self.queue.get_nowait() for i in range(n)])
+            # let the hot path continue
+            gevent.idle()
+        self.greenlet = None
+        
+    def flush(self):
+        """ Write all pending records immediately. """
+        n = self.queue.qsize()
+        self.write([self.queue.get_nowait() for i in range(n)])
+
+
+class QueuedHandler(logging.Handler):
+    """ Passes records to a LogWriter instead of emitting them. The
+    target handler is used for formatting and writing later. """
+    
+    def __init__(self, target, writer):
+        super().__init__()
+        self.target = target
+        self.writer = writer
+        
+    def emit(self, record):
+        self.writer.push(self.target, record)
+
+
 class LoggingApi(object):
 
-    def __init__(self, quiet, info_file, error_file, access_file, warning_file, logins_file, auth_file, stdout_only=False, loglevel='INFO'):
+    def __init__(self, quiet, info_file, error_file, access_file, warning_file, logins_file, auth_file, stdout_only=False, loglevel='INFO', queued=False):
         self.log_format = logging.Formatter('[%(asctime)s at %(module)s/%(filename)s:%(lineno)d] %(message)s')
+        # batch writer if records are queued
+        self.writer     = LogWriter() if queued else None
+        if self.writer is not None:
+            # @NOTE: pending records are also written if the process exits
+            # without Engine.run (e.g. scripts, --help or crashes)
+            atexit.register(self.writer.flush)
         
         # setup info logger
         self.info_logger = logging.getLogger('info_log')
@@ -527,18 +968,30 @@ class LoggingApi(object):
             self.access(boot)
             self.warning(boot)
     
+    def link(self, target, handler):
+        """Links the given logger to the handler, either directly or
+        through the batch writer."""
+        if self.writer is not None:
+            handler = QueuedHandler(handler, self.writer)
+        target.addHandler(handler)
+    
     def linkStdout(self, target):
         """Links the given logger to stdout."""
         handler = logging.StreamHandler(sys.stdout)
         handler.setFormatter(self.log_format)
-        target.addHandler(handler)
+        self.link(target, handler)
 
     def linkFile(self, target, fname, skip_format=False):
         """Links the given logger to the provided filename."""
         handler = logging.FileHandler(fname, mode='a')
         if not skip_format:
             handler.setFormatter(self.log_format)
-        target.addHandler(handler)
+        self.link(target, handler)
+    
+    def flush(self):
+        """Writes all queued records."""
+        if self.writer is not None:
+            self.writer.flush()
     
 
 # ---------------------------------------------------------------------
@@ -608,6 +1061,217 @@ class ErrorReporter(object):
         return wrapper
 
 
+# ---------------------------------------------------------------------
+
+class Histogram(object):
+    """ Counts values within fixed buckets. Each bound is the inclusive
+    upper limit of its bucket; larger values go into an extra bucket.
+    """
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count  = 0
+        self.total  = 0.0
+        self.max    = 0.0
+        
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        
+    def getData(self):
+        return {
+            'bounds' : self.bounds,
+            'counts' : self.counts,
+            'count'  : self.count,
+            'mean'   : self.total / self.count if self.count > 0 else 0.0,
+            'max'    : self.max
+        }
+
+
+class MetricsApi(object):
+    """ Collects latency histograms of websocket actions per OPID (wall
+    time, database time and payload size), of broadcasts and of the
+    slowest games.
+    """
+    
+    # bucket bounds in milliseconds and bytes
+    time_bounds = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500]
+    size_bounds = [64, 256, 1024, 4096, 16384, 65536, 262144, 1048576]
+    
+    def __init__(self):
+        self.opids     = dict() # OPID => {'wall', 'db', 'size'}
+        self.broadcast = {
+            'wall' : Histogram(MetricsApi.time_bounds),
+            'size' : Histogram(MetricsApi.size_bounds)
+        }
+        self.games     = dict() # 'gm/game' => histogram of wall time
+        self.since     = time.time()
+        
+    def recordAction(self, opid, game, wall, db, size):
+        """ Record a dispatched action. Times are given in seconds. """
+        h = self.opids.get(opid)
+        if h is None:
+            h = {
+                'wall' : Histogram(MetricsApi.time_bounds),
+                'db'   : Histogram(MetricsApi.time_bounds),
+                'size' : Histogram(MetricsApi.size_bounds)
+            }
+            self.opids[opid] = h
+        h['wall'].record(wall * 1000)
+        h['db'].record(db * 1000)
+        h['size'].record(size)
+        
+        g = self.games.get(game)
+        if g is None:
+            g = Histogram(MetricsApi.time_bounds)
+            self.games[game] = g
+        g.record(wall * 1000)
+        
+    def recordBroadcast(self, wall, size):
+        """ Record a broadcast. Time is given in seconds. """
+        self.broadcast['wall'].record(wall * 1000)
+        self.broadcast['size'].record(size)
+        
+    def forgetGame(self, game):
+        self.games.pop(game, None)
+        
+    def getData(self, num_games=10):
+        """ Return all histograms and the games with the highest mean
+        latency. """
+        games = sorted(self.games.items(), key=lambda i: i[1].total / i[1].count, reverse=True)
+        return {
+            'since'     : self.since,
+            'opids'     : {opid: {key: self.opids[opid][key].getData() for key in self.opids[opid]} for opid in self.opids},
+            'broadcast' : {key: self.broadcast[key].getData() for key in self.broadcast},
+            'games'     : {game: h.getData() for game, h in games[:num_games]}
+        }
+
+
+# ---------------------------------------------------------------------
+
+class GeoIpApi(object):
+    """ Offline IP to country resolver. The table is loaded from a CSV
+    file with one IP range per line: first ip, last ip, country code.
+    Addresses may be given as dotted strings or integers, so both the
+    DB-IP and IP2Location lite tables can be used. Lookups are done by
+    bisecting the sorted ranges and cached in a LRU manner.
+    
+    If enabled, unknown addresses are queried from a remote API in the
+    background; the caller never waits for that.
+    """
+    
+    def __init__(self, path, logging=None, cache_size=1024, remote=False, timeout=3):
+        self.logging    = logging
+        self.cache_size = cache_size
+        self.remote     = remote
+        self.timeout    = timeout
+        self.starts     = {4: list(), 6: list()} # first ip per range (sorted)
+        self.ends       = {4: list(), 6: list()} # last ip per range
+        self.codes      = {4: list(), 6: list()} # country code per range
+        self.cache      = collections.OrderedDict() # ip => country code
+        self.pending    = set() # ips being queried remotely
+        
+        if os.path.exists(path):
+            self.load(path)
+        elif self.logging is not None:
+            self.logging.warning('No GeoIP table found at {0}'.format(path))
+        
+    @staticmethod
+    def parseIp(s):
+        """ Return ip address from dotted or integer string. """
+        s = s.strip()
+        if s.isdigit():
+            n = int(s)
+            return ipaddress.IPv4Address(n) if n < 2 ** 32 else ipaddress.IPv6Address(n)
+        return ipaddress.ip_address(s)
+        
+    def load(self, path):
+        """ Load and sort all ranges from the given CSV file. """
+        ranges = {4: list(), 6: list()}
+        with open(path, 'r', newline='') as h:
+            for row in csv.reader(h):
+                if len(row) < 3:
+                    continue
+                try:
+                    first = GeoIpApi.parseIp(row[0])
+                    last  = GeoIpApi.parseIp(row[1])
+                except ValueError:
+                    # e.g. header line
+                    continue
+                code = row[2].strip().lower()
+                if len(code) != 2:
+                    # e.g. '-' for unassigned ranges
+                    code = '?'
+                ranges[first.version].append((int(first), int(last), code))
+        
+        for version in ranges:
+            ranges[version].sort()
+            self.starts[version] = [r[0] for r in ranges[version]]
+            self.ends[version]   = [r[1] for r in ranges[version]]
+            self.codes[version]  = [r[2] for r in ranges[version]]
+        
+        if self.logging is not None:
+            self.logging.info('GeoIP table loaded with {0} ranges'.format(len(ranges[4]) + len(ranges[6])))
+        
+    def search(self, ip):
+        """ Return country code from the table or None if not found. """
+        version = ip.version
+        n = int(ip)
+        index = bisect.bisect_right(self.starts[version], n) - 1
+        if index >= 0 and n <= self.ends[version][index]:
+            return self.codes[version][index]
+        return None
+        
+    def remember(self, ip, code):
+        """ Cache country code of the given ip. """
+        self.cache[ip] = code
+        self.cache.move_to_end(ip)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        
+    def queryRemote(self, ip):
+        """ Query country code from the remote API. """
+        code = '?'
+        try:
+            html = requests.get('http://ip-api.com/json/{0}'.format(ip), timeout=self.timeout)
+            d = json.loads(html.text)
+            if 'countryCode' in d:
+                code = d['countryCode'].lower()
+        except (requests.exceptions.RequestException, ValueError):
+            if self.logging is not None:
+                self.logging.warning('Cannot query location of IP {0}'.format(ip))
+        self.remember(ip, code)
+        self.pending.discard(ip)
+        
+    def __call__(self, ip):
+        """ Return lower-case country code of the given ip or '?' if it
+        is unknown (yet). """
+        if ip in self.cache:
+            self.cache.move_to_end(ip)
+            return self.cache[ip]
+        
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            # e.g. hostname or None
+            return '?'
+        
+        code = self.search(addr)
+        if code is not None:
+            self.remember(ip, code)
+            return code
+        
+        if self.remote and addr.is_global and ip not in self.pending:
+            # ask remote API in the background, later calls will use it
+            self.pending.add(ip)
+            gevent.spawn(self.queryRemote, ip)
+        return '?'
+
+
 # ---------------------------------------------------------------------
 
 class FancyUrlApi(object):
@@ -10,13 +10,14 @@ License: MIT (see LICENSE for details)
 from gevent import monkey; monkey.patch_all()
 import gevent
 
-import os, json, time, sys, random, subprocess, requests, flag
+import os, time, sys, random, subprocess, requests, flag
 
 from pony import orm
 from bottle import *
 
 from engine import Engine
 from cache import PlayerCache
+import codec
 
 
 __author__ = 'Christian Glöckner'
@@ -308,6 +309,11 @@ def setup_gm_routes(engine):
             engine.logging.warning('GM name="{0}" url="{1}" tried to export game {2} by {3} but game was not found'.format(gm.name, gm.url, url, engine.getClientIp(request)))
             abort(404)
         
+        # write pending token changes before exporting
+        game_cache = gm_cache.get(game)
+        if game_cache is not None:
+            game_cache.flush()
+        
         # export game to zip-file
         zip_file, zip_path = game.toZip()
          
@@ -337,6 +343,7 @@ def setup_gm_routes(engine):
         # load game from cache and clean it up
         now = time.time()
         game_cache = gm_cache.get(game)
+        game_cache.flush() # write pending token changes
         game.cleanup(now) # cleanup old images and tokens
         game_cache.cleanup() # remove all players
         
@@ -516,22 +523,25 @@ def setup_gm_routes(engine):
         abandoned_gms = engine.main_db.GM.select(lambda g: g.timeid < now - engine.expire).count()
 
         # query games
+        # @NOTE: only GMs with open databases are queried, because opening
+        # all databases would evict the ones which are actually used
         threshold     = 10
         total_games   = 0
         running_games = 0
         with engine.cache.lock:
-            for gm in engine.cache.gms:
-                gm_cache = engine.cache.gms[gm]
-                with gm_cache.lock:
-                    total_games   += gm_cache.db.Game.select().count()
-                    running_games += gm_cache.db.Game.select(lambda g: g.timeid >= now - threshold * 60).count()
+            gm_caches = list(engine.cache.databases.values())
+        for gm_cache in gm_caches:
+            with gm_cache.lock:
+                total_games   += gm_cache.db.Game.select().count()
+                running_games += gm_cache.db.Game.select(lambda g: g.timeid >= now - threshold * 60).count()
         done = time.time()
 
         # return data
         return {
             'gms': {
                 'total': total_gms,
-                'abandoned': abandoned_gms
+                'abandoned': abandoned_gms,
+                'open': len(gm_caches)
             },
             'games': {
                 'total': total_games,
@@ -540,6 +550,16 @@ def setup_gm_routes(engine):
             'query_time': done-now
         }
 
+    @get('/vtt/api/latency')
+    def api_query_latency():
+        """Latency histograms of websocket actions and broadcasts."""
+        start = time.time()
+        data  = engine.metrics.getData()
+        done  = time.time()
+        
+        data['query_time'] = done-start
+        return data
+
     @get('/vtt/api/games-list/<gmurl>')
     def api_games_list(gmurl):
         start = time.time()
@@ -576,18 +596,11 @@ def setup_gm_routes(engine):
             # @NOTE: not logged because somebody may play around with this
             abort(404)
         
-        root = engine.paths.getGamePath(gmurl, url)
+        assets = game.getAssets()
         files = {
-            'images': [],
-            'audio': []
+            'images': assets.getImages(),
+            'audio': assets.getMusic()
         }
-        for fname in os.listdir(root):
-            if fname.endswith('.png'):
-                files['images'].append(fname)
-            if fname.endswith('.mp3'):
-                files['audio'].append(fname)
-        files['images'].sort(key=lambda k: int(k.split('.')[0]))
-        files['audio'].sort()
         done = time.time()
 
         files['query_time'] = done-start
@@ -687,36 +700,69 @@ def setup_resource_routes(engine):
     
     @get('/static/<fname>')
     def static_files(fname):
-        root = engine.paths.getStaticPath()
-        if not os.path.isdir(root) or not os.path.exists(root / fname):
-            root = './static'
-
         # @NOTE: no need to check file extension, this directory is
         # meant to be accessable as a whole
-
-        return static_file(fname, root=root)
+        static = engine.static_files.get(fname)
+        if static is None:
+            abort(404)
+        
+        headers = {'Vary': 'Accept-Encoding'}
+        if request.query.get('v') == engine.version:
+            # @NOTE: versioned urls change with each release
+            headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            headers['Cache-Control'] = 'no-cache'
+        
+        accepted = engine.static_files.parseEncodings(request.headers.get('Accept-Encoding', ''))
+        encoding = static.getEncoding(accepted)
+        if encoding is None:
+            etag = '"{0}"'.format(static.md5)
+            return static_file(fname, root=static.root, etag=etag, headers=headers)
+        
+        # send precompressed file
+        etag = '"{0}-{1}"'.format(static.md5, encoding)
+        headers['ETag'] = etag
+        if request.headers.get('If-None-Match') == etag:
+            return HTTPResponse(status=304, **headers)
+        body = static.variants[encoding]
+        headers['Content-Encoding'] = encoding
+        headers['Content-Length']   = len(body)
+        if static.mimetype is not None:
+            headers['Content-Type'] = static.mimetype
+        return HTTPResponse('' if request.method == 'HEAD' else body, **headers)
 
     @get('/asset/<gmurl>/<url>/<fname>')
     def game_asset(gmurl, url, fname):
+        # only allow specific file types
+        if not fname.endswith('.png') and not fname.endswith('.mp3'):
+            abort(404)
+        
         # load GM from cache
         gm_cache = engine.cache.getFromUrl(gmurl)
         if gm_cache is None:
             # @NOTE: not logged because somebody may play around with this
             abort(404)
         
-        # load game from GM's database
-        game = gm_cache.db.Game.select(lambda g: g.url == url).first()
-        if game is None:
+        # check game without querying the GM's database
+        if not gm_cache.hasGame(url):
             # @NOTE: not logged because somebody may play around with this
             abort(404)
-
-        # only allow specific file types
-        if not fname.endswith('.png') and not fname.endswith('.mp3'):
-            abort(404)
+        
+        # @NOTE: asset urls are reused (e.g. image ids after deleting the
+        # latest image, music slots or a re-imported game), so they need to
+        # be revalidated; images are cheaply validated by their checksum
+        etag    = None # generated by bottle
+        headers = {'Cache-Control': 'no-cache'}
+        if fname.endswith('.png'):
+            checksums = engine.checksums.get('{0}/{1}'.format(gmurl, url))
+            if checksums is not None and fname[:-4].isdigit():
+                md5 = checksums.getDigest(int(fname[:-4]))
+                if md5 is not None:
+                    etag = '"{0}"'.format(md5)
         
         # try to load asset file from disk
         root  = engine.paths.getGamePath(gmurl, url)
-        return static_file(fname, root)
+        return static_file(fname, root, etag=etag, headers=headers)
 
 # ---------------------------------------------------------------------
 
@@ -736,13 +782,22 @@ def setup_player_routes(engine):
             # @NOTE: not logged because somebody may play around with this
             abort(404)
 
-        engine.paths.getGamePath(gmurl, url)
-        if scene.backing != None:
-            url = scene.backing.url
-        else:
-            url = '/static/empty.jpg'
+        if scene.backing is None:
+            redirect('/static/empty.jpg')
+        backing_url = scene.backing.url
+        if not backing_url.startswith('/asset/'):
+            redirect(backing_url)
 
-        redirect(url)
+        # create thumbnail of the background image (if necessary)
+        img_id = gm_cache.db.Game.getIdFromUrl(backing_url)
+        src_path = engine.paths.getGamePath(gmurl, url) / '{0}.png'.format(img_id)
+        root = engine.paths.getThumbnailPath(gmurl, url)
+        fname = engine.thumbnail_api(src_path, root, img_id)
+        if fname is None:
+            redirect(backing_url)
+
+        # @NOTE: the scene's background may change, so revalidate
+        return static_file(fname, root, mimetype=engine.thumbnail_api.mimetype, headers={'Cache-Control': 'no-cache'})
 
     @get('/vtt/thumbnail/<gmurl>/<url>')
     def get_game_thumbnail(gmurl, url):
@@ -989,7 +1044,7 @@ def setup_player_routes(engine):
         # return urls
         # @NOTE: request was non-JSON to allow upload, so urls need to be encoded
         
-        return json.dumps(answer)
+        return codec.dumps(answer)
 
 
 # ---------------------------------------------------------------------   